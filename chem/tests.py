@@ -1,5 +1,7 @@
 import os
 import csv
+import shutil
+import tempfile
 import zipfile
 import itertools
 import urllib
@@ -7,6 +9,7 @@ from unittest import skipUnless
 import json
 
 from django.test import Client, TestCase
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.contrib.auth import get_user_model
 from django.conf import settings
@@ -108,7 +111,24 @@ KEYWORDS_SET = ["opt HF/6-31g(d)", "td b3lyp/6-31g(d)", KEYWORDS]
 SUBMIT_ERROR = "You must be a staff user to submit a job."
 CRED_ERROR = "Invalid credential"
 
+# The disk caches are pointed at a temporary folder so the tests do not write
+# into the tree.
+CACHE_PATH = tempfile.mkdtemp()
+CACHE_SETTINGS = {
+    "IMAGE_CACHE": {
+        "PATH": os.path.join(CACHE_PATH, "images"),
+        "MAX_SIZE": 16 * 1024 * 1024,
+    },
+    "ML_FEATURE_CACHE": os.path.join(CACHE_PATH, "features.npz"),
+    "LOG_PARSE_CACHE": os.path.join(CACHE_PATH, "logs"),
+}
+
+
+def tearDownModule():
+    shutil.rmtree(CACHE_PATH, ignore_errors=True)
 
+
+@override_settings(**CACHE_SETTINGS)
 class MainPageTestCase(TestCase):
 
     def setUp(self):
@@ -189,10 +209,30 @@ class MainPageTestCase(TestCase):
         response = self.client.get(reverse(views.multi_molecule_zip,
                                            args=(string, )))
         self.assertEqual(response.status_code, 200)
-        with StringIO(response.content) as f:
+        with StringIO(''.join(response.streaming_content)) as f:
             with zipfile.ZipFile(f, "r") as zfile:
                 self.assertEqual(set(zfile.namelist()), gjf_names)
 
+    def test_multi_molecule_zip_workers(self):
+        string = ','.join(NAMES)
+        url = reverse(views.multi_molecule_zip, args=(string, ))
+        url += "?gjf=true&mol2=true"
+        results = []
+        for workers in (1, 2):
+            with self.settings(MULTI_MOLECULE_WORKERS=workers):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            with StringIO(''.join(response.streaming_content)) as f:
+                with zipfile.ZipFile(f, "r") as zfile:
+                    results.append([(x, zfile.read(x))
+                                    for x in zfile.namelist()])
+        self.assertEqual(len(results[0]), 2 * len(NAMES))
+        self.assertEqual(results[0], results[1])
+        expected = []
+        for name in NAMES:
+            expected.extend([name + ".mol2", name + ".gjf"])
+        self.assertEqual([x for x, _ in results[1]], expected)
+
     def test_multi_molecule_zip_invalid(self):
         names, errors = zip(*BAD_NAMES)
         string = ','.join(names)
@@ -200,7 +240,7 @@ class MainPageTestCase(TestCase):
         response = self.client.get(reverse(views.multi_molecule_zip,
                                            args=(string, )))
         self.assertEqual(response.status_code, 200)
-        with StringIO(response.content) as f:
+        with StringIO(''.join(response.streaming_content)) as f:
             with zipfile.ZipFile(f, "r") as zfile:
                 self.assertEqual(set(zfile.namelist()), filenames)
                 for name in zfile.namelist():
@@ -220,7 +260,7 @@ class MainPageTestCase(TestCase):
             response = self.client.get(url)
             self.assertEqual(response.status_code, 200)
 
-            with StringIO(response.content) as f:
+            with StringIO(''.join(response.streaming_content)) as f:
                 with zipfile.ZipFile(f, "r") as zfile:
                     for gjf_name in zfile.namelist():
                         with zfile.open(gjf_name) as f1:
@@ -237,7 +277,7 @@ class MainPageTestCase(TestCase):
         params = "?new=true"
         response = self.client.get(url + params)
         self.assertEqual(response.status_code, 200)
-        with StringIO(response.content) as f:
+        with StringIO(''.join(response.streaming_content)) as f:
             with zipfile.ZipFile(f, "r") as zfile:
                 self.assertEqual(set(zfile.namelist()), gjf_names)
 
@@ -262,7 +302,7 @@ class MainPageTestCase(TestCase):
 
             response = self.client.get(url)
             self.assertEqual(response.status_code, 200)
-            with StringIO(response.content) as f:
+            with StringIO(''.join(response.streaming_content)) as f:
                 with zipfile.ZipFile(f, "r") as zfile:
                     self.assertEqual(set(zfile.namelist()), comparenames)
 
@@ -289,7 +329,7 @@ class MainPageTestCase(TestCase):
 
             response = self.client.get(url)
             self.assertEqual(response.status_code, 200)
-            with StringIO(response.content) as f:
+            with StringIO(''.join(response.streaming_content)) as f:
                 with zipfile.ZipFile(f, "r") as zfile:
                     self.assertEqual(set(zfile.namelist()), comparenames)
 
@@ -302,7 +342,7 @@ class MainPageTestCase(TestCase):
         response = self.client.get(url + encoded_options)
 
         self.assertEqual(response.status_code, 200)
-        with StringIO(response.content) as f:
+        with StringIO(''.join(response.streaming_content)) as f:
             with zipfile.ZipFile(f, "r") as zf:
                 self.assertEqual(set(zf.namelist()), jobnames)
                 for name in [x for x in zf.namelist() if not x.endswith("/")]:
@@ -367,6 +407,28 @@ class MainPageTestCase(TestCase):
                                                args=(name, )))
             self.assertEqual(response.status_code, 200)
 
+    def test_write_png_etag(self):
+        for func in (views.write_png, views.write_svg):
+            url = reverse(func, args=(NAMES[0], ))
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response["ETag"]
+
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response["ETag"], etag)
+
+            response = self.client.get(url + "?scale=20",
+                                       HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response["ETag"], etag)
+
+    def test_write_png_perturb(self):
+        url = reverse(views.write_png, args=(NAMES[0], ))
+        response = self.client.get(url + "?perturb=0.1")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header("ETag"))
+
     def test_write_job(self):
         options = OPTIONS.copy()
         del options["job"]
@@ -444,13 +506,40 @@ class MainPageTestCase(TestCase):
                                            args=(TIMEOUT_NAMES, )))
         self.assertEqual(response.status_code, 200)
         value = json.loads(response.content)["error"]
-        self.assertEqual(value, "The operation has timed out.")
+        self.assertEqual(value, "Too many molecules (13182), the limit is 10000.")
 
     def test_multi_molecule_zip_timeout(self):
         response = self.client.get(reverse(views.multi_molecule_zip,
                                            args=(TIMEOUT_NAMES, )))
         self.assertEqual(response.status_code, 200)
-        self.assertIn("The operation has timed out.", response.content)
+        self.assertIn("Too many molecules (13182)", response.content)
+
+    def test_molecule_check_large(self):
+        string = "24{$RGROUPS}{$RGROUPS}_TON"
+        with self.settings(MULTI_MOLECULE_LIMIT=20000):
+            response = self.client.get(reverse(views.molecule_check,
+                                               args=(TIMEOUT_NAMES, )))
+        values = json.loads(response.content)
+        self.assertIsNone(values["error"])
+        self.assertEqual(len(values["molecules"]), 13182)
+
+        url = reverse(views.molecule_check, args=(string, ))
+        response = self.client.get(url + "?limit=100")
+        values = json.loads(response.content)
+        self.assertEqual(len(values["molecules"]), 100)
+        self.assertEqual(values["next_offset"], 100)
+
+        response = self.client.get(url + "?offset=100&limit=100")
+        values = json.loads(response.content)
+        self.assertEqual(len(values["molecules"]), 69)
+        self.assertIsNone(values["next_offset"])
+
+    def test_molecule_check_predict(self):
+        string = ','.join(NAMES)
+        url = reverse(views.molecule_check, args=(string, )) + "?predict=true"
+        response = self.client.get(url)
+        values = json.loads(response.content)
+        self.assertEqual(len(values["properties"]), len(values["molecules"]))
 
     def test_molecule_check_specific(self):
         names = [
@@ -533,6 +622,7 @@ class MainPageTestCase(TestCase):
             self.assertIn("Enter a valid email address", response.content)
 
 
+@override_settings(**CACHE_SETTINGS)
 class PostsFailTestCase(TestCase):
 
     def setUp(self):
@@ -773,6 +863,7 @@ class PostsFailTestCase(TestCase):
 
 
 @skipUnless(server_exists(**SERVER), "Requires external test server.")
+@override_settings(**CACHE_SETTINGS)
 class PostsTestCase(TestCase):
 
     def setUp(self):
@@ -952,6 +1043,7 @@ class PostsTestCase(TestCase):
             self.assertIn("Go to jobs list", response.content)
 
 
+@override_settings(**CACHE_SETTINGS)
 class UtilsTestCase(TestCase):
     names = ["24a_TON", "BAD_NAME", "CON_24a", "A_TON_A_A"]
 
@@ -986,6 +1078,62 @@ class UtilsTestCase(TestCase):
         ]
         self.assertEqual(results, expected)
 
+    def test_get_multi_molecule_status_page(self):
+        string = ','.join(self.names)
+        results = utils.get_multi_molecule_status(string, offset=1, limit=2)
+        expected = [
+            tuple(self.names[1:3]),
+            (None, True),
+            ("Bad Substituent Name(s): ['_N']", None),
+            (True, True),
+        ]
+        self.assertEqual(results, expected)
+
+        results = utils.get_multi_molecule_status(string, offset=10)
+        self.assertEqual(results, [(), (), (), ()])
+
+    def test_get_multi_molecule_status_page_limit(self):
+        string = ','.join(self.names)
+        with self.settings(MULTI_MOLECULE_LIMIT=2):
+            with self.assertRaises(ValueError):
+                utils.get_multi_molecule_status(string)
+            results = utils.get_multi_molecule_status(string, offset=2,
+                                                      limit=2)
+            self.assertEqual(results[0], tuple(self.names[2:4]))
+            results = utils.get_multi_molecule_status(string, offset=3)
+            self.assertEqual(results[0], tuple(self.names[3:]))
+
+    def test_iter_multi_molecule_status_offset(self):
+        string = ','.join(self.names)
+        calls = []
+        original = utils.get_molecule_status_batch
+
+        def get_molecule_status_batch(names, **kwargs):
+            calls.append(names)
+            return original(names, **kwargs)
+
+        utils.get_molecule_status_batch = get_molecule_status_batch
+        try:
+            chunks = list(utils.iter_multi_molecule_status(
+                string, chunksize=3, offset=2))
+        finally:
+            utils.get_molecule_status_batch = original
+        self.assertEqual([x[0] for x in chunks[0]], self.names[2:])
+        self.assertEqual(calls, [self.names[2:]])
+
+    def test_iter_multi_molecule_status(self):
+        string = ','.join(self.names)
+        chunks = list(utils.iter_multi_molecule_status(string, chunksize=3))
+        self.assertEqual([len(x) for x in chunks], [3, 1])
+        self.assertEqual([x[0] for x in chunks[0] + chunks[1]], self.names)
+
+    def test_get_image_etag(self):
+        etag = utils.get_image_etag("24a_TON", 10, "png")
+        self.assertEqual(etag, utils.get_image_etag("24a_TON", 10, "png"))
+        self.assertNotEqual(etag, utils.get_image_etag("24a_TON", 10, "svg"))
+        self.assertNotEqual(etag, utils.get_image_etag("24a_TON", 20, "png"))
+        self.assertNotEqual(etag, utils.get_image_etag("24b_TON", 10, "png"))
+
     def test_get_molecule_info(self):
         name = "24a_TON"
         results = utils.get_molecule_info_status(name)
@@ -1025,6 +1173,7 @@ class UtilsTestCase(TestCase):
 
 
 @skipUnless(server_exists(**SERVER), "Requires external test server.")
+@override_settings(**CACHE_SETTINGS)
 class UtilsServerTestCase(TestCase):
 
     def setUp(self):
@@ -1074,6 +1223,7 @@ class UtilsServerTestCase(TestCase):
             self.assertEqual(error, "Bad Substituent Name(s): ['N']")
 
 
+@override_settings(**CACHE_SETTINGS)
 class UploadsTestCase(TestCase):
 
     def setUp(self):
@@ -1116,6 +1266,14 @@ class UploadsTestCase(TestCase):
                 results = lines[1][:4] + lines[1][5:]
                 self.assertEqual(results, expected)
 
+    def test_log_parse_cache(self):
+        cache = utils.get_log_parse_cache()
+        self.assertEqual(cache.path, os.path.join(CACHE_PATH, "logs"))
+        self.assertEqual(cache.store.max_size,
+                         settings.LOG_PARSE_CACHE_MAX_SIZE)
+        with self.settings(LOG_PARSE_CACHE=None):
+            self.assertIsNone(utils.get_log_parse_cache())
+
     def test_log_parse_steps(self):
         test_path = os.path.join(settings.MEDIA_ROOT, "tests")
         with open(os.path.join(test_path, "A.log"), 'r') as f:
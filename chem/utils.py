@@ -1,17 +1,22 @@
-import time
+import hashlib
 import zipfile
 import tarfile
 import re
-import collections
+import itertools
 import logging
 
 from django.shortcuts import redirect
+from django.http import HttpResponse, HttpResponseNotModified
+from django.conf import settings
 
 from models import ErrorReport
 
 from chemtools import gjfwriter
 from chemtools import fileparser
-from chemtools.mol_name import name_expansion, get_exact_name
+from chemtools.structure import get_data_version
+from chemtools.filecache import FileSystemCache
+from chemtools.mol_name import iter_name_expansion, count_name_expansion, \
+    get_exact_name
 from data.models import DataPoint
 from cluster.interface import run_jobs
 from project.utils import StringIO
@@ -19,6 +24,16 @@ from project.utils import StringIO
 
 logger = logging.getLogger(__name__)
 
+# Bump this when the drawing code changes to invalidate the cached images. The
+# images are also invalidated when the fragments change.
+IMAGE_VERSION = 1
+IMAGE_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+}
+_image_caches = {}
+_log_parse_caches = {}
+
 
 def get_molecule_status(name, autoflip=False):
     mol = gjfwriter.NamedMolecule(name, autoflip=autoflip)
@@ -44,23 +59,177 @@ def get_molecule_info_status(name):
     return info
 
 
-def get_multi_molecule_status(string, autoflip=False):
-    unique_molecules = collections.OrderedDict()
+def get_molecule_status_batch(names, autoflip=False):
+    '''Returns the status of each name as (molecule, exact_spacer,
+    error_report, name_error, new).
+
+    Only the grammar of the names is checked, none of the structures are
+    built, and the database is queried once for all the names.'''
+    mols = [gjfwriter.NamedMolecule(x, autoflip=autoflip) for x in names]
+    exact_names = [x.get_exact_name() for x in mols]
+
+    reports = ErrorReport.objects.filter(molecule__in=names)
+    reports = set(reports.values_list("molecule", flat=True))
+    datapoints = DataPoint.objects.filter(exact_name__in=set(exact_names))
+    datapoints = set(datapoints.values_list("exact_name", flat=True))
+
+    results = []
+    for name, mol, exact_name in zip(names, mols, exact_names):
+        results.append((
+            mol,
+            mol.get_exact_name(spacers=True),
+            (name in reports) or None,
+            mol.get_name_error(),
+            exact_name not in datapoints,
+        ))
+    return results
+
 
-    start = time.time()
-    for name in name_expansion(string):
-        if time.time() - start > 1:
-            logger.warn("%s -- The operation timed out" % (string))
-            raise ValueError("The operation has timed out.")
-        mol, name_error, error_report, new = get_molecule_status(name, autoflip=autoflip)
-        exact_spacer = mol.get_exact_name(spacers=True)
-        if not exact_spacer:
-            exact_spacer = name
-        if exact_spacer not in unique_molecules:
-            unique_molecules[exact_spacer] = [mol.name, error_report,
-                                            name_error, new]
+def _get_unique_key(name, autoflip=False):
+    mol = gjfwriter.NamedMolecule(name, autoflip=autoflip)
+    return mol.get_exact_name(spacers=True) or name
+
+
+def iter_multi_molecule_status(string, autoflip=False, chunksize=None,
+                               offset=0, limit=None):
+    '''Yields lists of [name, error_report, name_error, new] for the unique
+    molecules in the expansion of string, checking chunksize names at a
+    time.
+
+    The first offset unique molecules are skipped by only parsing their
+    names, so the database is not queried for them. The molecule limit is
+    applied to the names after offset, or to the limit if it is given.'''
+    if chunksize is None:
+        chunksize = settings.MULTI_MOLECULE_CHUNK_SIZE
+
+    count = max(count_name_expansion(string) - offset, 0)
+    if limit is not None:
+        count = min(count, limit)
+    if count > settings.MULTI_MOLECULE_LIMIT:
+        logger.warn("%s -- Too many molecules (%d)" % (string, count))
+        raise ValueError("Too many molecules (%d), the limit is %d." %
+                         (count, settings.MULTI_MOLECULE_LIMIT))
+
+    seen = set()
+    names = iter_name_expansion(string)
+    skipped = 0
+    while skipped < offset:
+        name = next(names, None)
+        if name is None:
+            return
+        key = _get_unique_key(name, autoflip=autoflip)
+        if key not in seen:
+            seen.add(key)
+            skipped += 1
+
+    while True:
+        chunk = list(itertools.islice(names, chunksize))
+        if not chunk:
+            break
+
+        rows = []
+        for name, status in zip(chunk, get_molecule_status_batch(
+                chunk, autoflip=autoflip)):
+            mol, exact_spacer, error_report, name_error, new = status
+            if not exact_spacer:
+                exact_spacer = name
+            if exact_spacer not in seen:
+                seen.add(exact_spacer)
+                rows.append([mol.name, error_report, name_error, new])
+        yield rows
+
+
+def get_multi_molecule_status(string, autoflip=False, offset=0, limit=None):
+    '''Returns the names, error reports, name errors, and if they are new
+    for the unique molecules in the expansion of string. offset and limit
+    can be used to get the results a page at a time.'''
+    rows = itertools.chain.from_iterable(
+        iter_multi_molecule_status(string, autoflip=autoflip, offset=offset,
+                                   limit=limit))
+    rows = list(itertools.islice(rows, limit))
+    return zip(*rows) or [(), (), (), ()]
+
+
+def get_multi_molecule_predictions(names):
+    '''Returns a list with the predicted homo, lumo, and gap for each name,
+    or None for the names that are not valid.'''
+    mols = [gjfwriter.NamedMolecule(x) for x in names]
+    try:
+        results = gjfwriter.predict_molecule_properties(mols)
+    except Exception as e:
+        logger.warn("Property prediction failed: %s" % e)
+        return [None] * len(names)
+    values = []
+    for row in results.tolist():
+        if any(x != x for x in row):  # nan
+            values.append(None)
+        else:
+            values.append(dict(zip(results.dtype.names, row)))
+    return values
+
+
+def get_image_cache():
+    path = settings.IMAGE_CACHE["PATH"]
+    max_size = settings.IMAGE_CACHE.get("MAX_SIZE")
+    key = (path, max_size)
+    if key not in _image_caches:
+        _image_caches[key] = FileSystemCache(path, max_size=max_size)
+    return _image_caches[key]
+
+
+def get_log_parse_cache():
+    '''Returns the ParseCache for uploaded logs, or None if it is off.'''
+    path = getattr(settings, "LOG_PARSE_CACHE", None)
+    if not path:
+        return None
+    max_size = getattr(settings, "LOG_PARSE_CACHE_MAX_SIZE", None)
+    key = (path, max_size)
+    if key not in _log_parse_caches:
+        _log_parse_caches[key] = fileparser.ParseCache(path,
+                                                       max_size=max_size)
+    return _log_parse_caches[key]
+
+
+def get_image_etag(name, scale, ext):
+    string = "%s|%s|%s|%d|%s" % (name, scale, ext, IMAGE_VERSION,
+                                 get_data_version())
+    return hashlib.sha1(string.encode("utf-8")).hexdigest()
+
+
+def etag_matches(request, etag):
+    header = request.META.get("HTTP_IF_NONE_MATCH", '')
+    values = [x.strip() for x in header.split(',')]
+    return '"%s"' % etag in values or '*' in values
+
+
+def get_image_response(request, name, mol_settings, ext="png"):
+    '''Returns a response with the rendered image of the molecule.
+
+    As long as the geometry is not randomly perturbed, the image only depends
+    on the name and the scale. In that case the image is served from the
+    image cache and conditional requests are answered without rendering.'''
+    out = gjfwriter.NamedMolecule(name, **mol_settings)
+    funcs = {
+        "png": out.get_png,
+        "svg": out.get_svg,
+    }
 
-    return zip(*unique_molecules.values())
+    if out.perturb:
+        response = HttpResponse(funcs[ext](), content_type=IMAGE_TYPES[ext])
+    else:
+        etag = get_image_etag(out.name, out.scale, ext)
+        if etag_matches(request, etag):
+            response = HttpResponseNotModified()
+        else:
+            cache = get_image_cache()
+            data = cache.get(etag)
+            if data is None:
+                data = funcs[ext]()
+                cache.set(etag, data)
+            response = HttpResponse(data, content_type=IMAGE_TYPES[ext])
+        response["ETag"] = '"%s"' % etag
+    response['Content-Disposition'] = 'filename=%s.%s' % (name, ext)
+    return response
 
 
 def run_standard_jobs(credential, string, mol_settings, job_settings):
@@ -82,7 +251,7 @@ def run_standard_jobs(credential, string, mol_settings, job_settings):
 
     names = []
     gjfs = []
-    for mol in name_expansion(string):
+    for mol in iter_name_expansion(string):
         try:
             out = gjfwriter.NamedMolecule(mol, **mol_settings)
             # This instantiation needs to be done here because of the errors
@@ -6,7 +6,9 @@ import json
 from django.shortcuts import render, redirect
 from django.template import RequestContext
 from django.template.loader import render_to_string
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, \
+                        StreamingHttpResponse
+from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core.servers.basehttp import FileWrapper
 from django.core.serializers.json import DjangoJSONEncoder
@@ -15,12 +17,13 @@ from crispy_forms.utils import render_crispy_form
 from models import ErrorReport
 from forms import ErrorReportForm, JobForm, UploadForm, MoleculeForm
 from utils import get_multi_molecule_status, get_molecule_info_status, \
-                autoflip_check, get_molecule_status
+                autoflip_check, get_molecule_status, get_image_response, \
+                get_multi_molecule_predictions, get_log_parse_cache
 
 from chemtools import gjfwriter
 from chemtools import fileparser, dataparser
 from chemtools.mol_name import name_expansion
-from chemtools.interface import get_multi_molecule, get_multi_job
+from chemtools.interface import iter_multi_molecule, get_multi_job
 import cluster.interface
 from project.utils import StringIO
 from data import load_data
@@ -94,15 +97,30 @@ def multi_job(request):
 def molecule_check(request, string):
     a = {
         "error": None,
+        "next_offset": None,
     }
     try:
         autoflip = request.REQUEST.get("autoflip")
-        molecules, warnings, errors, news = get_multi_molecule_status(
-            string, autoflip=autoflip)
+        offset = int(request.REQUEST.get("offset", 0))
+        limit = request.REQUEST.get("limit")
+        if limit is not None:
+            # Get one extra to know if there is another page
+            limit = int(limit)
+            molecules, warnings, errors, news = get_multi_molecule_status(
+                string, autoflip=autoflip, offset=offset, limit=limit + 1)
+            if len(molecules) > limit:
+                a["next_offset"] = offset + limit
+                molecules, warnings, errors, news = [x[:limit] for x in
+                                            (molecules, warnings, errors, news)]
+        else:
+            molecules, warnings, errors, news = get_multi_molecule_status(
+                string, autoflip=autoflip, offset=offset)
         # This is used to fix the issue with ( and ) not being allowed for
         # the id of an HTML tag.
         name_ids = [x.replace('(', 'z').replace(')', 'z') for x in molecules]
         a["molecules"] = zip(molecules, warnings, errors, news, name_ids)
+        if request.REQUEST.get("predict"):
+            a["properties"] = get_multi_molecule_predictions(molecules)
     except ValueError as e:
         logger.warn(str(e))
         a["error"] = str(e)
@@ -223,9 +241,10 @@ def multi_molecule_zip(request, string):
     options = [x for x in selection if request.REQUEST.get(x)]
     if request.REQUEST.get("new", ''):
         molecules = [x for i, x in enumerate(molecules) if news[i]]
-    ret_zip = get_multi_molecule(molecules, options, mol_form, job_form)
+    ret_zip = iter_multi_molecule(molecules, options, mol_form, job_form,
+                                  workers=settings.MULTI_MOLECULE_WORKERS)
 
-    response = HttpResponse(ret_zip, content_type="application/zip")
+    response = StreamingHttpResponse(ret_zip, content_type="application/zip")
     response["Content-Disposition"] = "attachment; filename=molecules.zip"
     return response
 
@@ -261,11 +280,7 @@ def write_png(request, molecule):
     mol_form = MoleculeForm(request.REQUEST)
     mol_form.is_valid()
     mol_settings = dict(mol_form.cleaned_data)
-
-    out = gjfwriter.NamedMolecule(molecule, **mol_settings)
-    response = HttpResponse(out.get_png(), content_type="image/png")
-    response['Content-Disposition'] = 'filename=%s.png' % molecule
-    return response
+    return get_image_response(request, molecule, mol_settings, "png")
 
 
 @autoflip_check
@@ -273,12 +288,7 @@ def write_svg(request, molecule):
     mol_form = MoleculeForm(request.REQUEST)
     mol_form.is_valid()
     mol_settings = dict(mol_form.cleaned_data)
-
-    out = gjfwriter.NamedMolecule(molecule, **mol_settings)
-    response = HttpResponse(
-        out.get_svg(), content_type="image/svg+xml")
-    response['Content-Disposition'] = 'filename=%s.svg' % molecule
-    return response
+    return get_image_response(request, molecule, mol_settings, "svg")
 
 ###########################################################
 ###########################################################
@@ -310,7 +320,8 @@ def upload_data(request):
 
 def parse_log(request, upload_form):
     split_iter = upload_form.cleaned_data['split_iter']
-    parser = fileparser.LogSet(split_iter=split_iter)
+    parser = fileparser.LogSet(split_iter=split_iter,
+                               cache=get_log_parse_cache())
     for f in upload_form.cleaned_data["files"]:
         parser.parse_file(f)
 
@@ -365,7 +376,7 @@ def reset_gjf(request, upload_form):
     names = []
     for f in upload_form.cleaned_data["files"]:
         try:
-            parser = fileparser.Log(f)
+            parser = fileparser.Log(f, tail=True)
 
             name, _ = os.path.splitext(f.name)
             td = False
@@ -15,26 +15,56 @@ def kuhn_exp(x, a, b):
     return a * np.sqrt(1 - b * np.cos(math.pi / (x + 1)))
 
 
-def predict_values(xvals, homovals, lumovals, gapvals):
+def fit_kuhn(x, y, offset=0., bounds=(-1., 20.), steps=201, iterations=5):
+    '''Fits kuhn_exp(x, a, b) + offset to y with least squares.
+
+    For a fixed b, the best a has a closed form, so only b has to be searched
+    for. All the b values on a grid are tried at once, and then the grid is
+    narrowed around the best one.'''
+    y = np.asarray(y, dtype=float) - offset
+    cos = np.cos(math.pi / (np.asarray(x, dtype=float) + 1))
+    low, high = bounds
+    for i in xrange(iterations):
+        b = np.linspace(low, high, steps)
+        g = np.sqrt(1 - b[:, None] * cos)
+        a = (g * y).sum(axis=1) / (g * g).sum(axis=1)
+        error = ((a[:, None] * g - y) ** 2).sum(axis=1)
+        error[~np.isfinite(error)] = np.inf
+        best = error.argmin()
+        step = (high - low) / (steps - 1.)
+        low, high = max(b[best] - step, bounds[0]), b[best] + step
+    return a[best], b[best]
+
+
+def predict_values(xvals, homovals, lumovals, gapvals, method="curve_fit"):
+    '''Fits the homo, lumo, and gap values to get their limits as xvals goes
+    to infinity. method can be "curve_fit" or "lstsq" to use fit_kuhn.'''
     x = np.array(xvals)
     maxx = max(xvals)
     if maxx > 1:
         x = 1. / x
         maxx = x.max()
 
+    if method == "lstsq":
+        def fit(func, x, y, p0):
+            return fit_kuhn(x, y, offset=func(x)), None
+    elif method == "curve_fit":
+        def fit(func, x, y, p0):
+            return curve_fit(lambda x, a, b: kuhn_exp(x, a, b) + func(x),
+                             x, y, p0=p0)
+    else:
+        raise ValueError("Unknown fit method: %s" % method)
+
     homoy = np.array(homovals)
-    homo_fit = lambda x, a, b: kuhn_exp(x, a, b)
-    (homoa, homob), var_matrix = curve_fit(homo_fit, x, homoy, p0=[-8, -.8])
+    (homoa, homob), var_matrix = fit(lambda x: 0, x, homoy, [-8, -.8])
     homo_func = lambda x: kuhn_exp(x, homoa, homob)
 
     lumoy = np.array(lumovals)
-    lumo_fit = lambda x, a, b: kuhn_exp(x, a, b) + homo_func(x)
-    (lumoa, lumob), var_matrix = curve_fit(lumo_fit, x, lumoy, p0=[5, -.8])
+    (lumoa, lumob), var_matrix = fit(homo_func, x, lumoy, [5, -.8])
     lumo_func = lambda x: kuhn_exp(x, lumoa, lumob) + homo_func(x)
 
     gapy = np.array(gapvals)
-    gap_fit = lambda x, a, b: kuhn_exp(x, a, b) + lumo_func(x)
-    (gapa, gapb), var_matrix = curve_fit(gap_fit, x, gapy, p0=[11, -.8])
+    (gapa, gapb), var_matrix = fit(lumo_func, x, gapy, [11, -.8])
     gap_func = lambda x: kuhn_exp(x, gapa, gapb) + lumo_func(x)
 
     homo_limit = homo_func(0)
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import threading
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileSystemCache(object):
+    '''Stores each value as a file in a directory on the local disk.
+
+    If max_size (in bytes) is given, the least recently used files are removed
+    once the total size of the files goes over it.'''
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # The lock can not be pickled, and the size is found again
+        return {"path": self.path, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _get_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _get_files(self):
+        files = []
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+        except IOError:
+            return None
+        if self.max_size is not None:
+            # The mtime is used to track when the file was last used
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return value
+
+    def set(self, key, value):
+        path = self._get_path(key)
+        folder = os.path.dirname(path)
+        try:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            # Write to a temp file first so readers never see partial values
+            fd, temp = tempfile.mkstemp(dir=folder)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.rename(temp, path)
+        except (IOError, OSError) as e:
+            logger.warn("Could not write to cache: %s" % e)
+            return
+
+        if self.max_size is not None:
+            with self.lock:
+                if self.size is None:
+                    self.size = sum(x[1] for x in self._get_files())
+                else:
+                    self.size += len(value)
+                if self.size > self.max_size:
+                    self.evict()
+
+    def evict(self):
+        '''Removes the least recently used files until the cache is under
+        its size limit.'''
+        files = sorted(self._get_files())
+        size = sum(x[1] for x in files)
+        # Go a bit under the limit so this does not run on every set
+        target = 0.9 * self.max_size
+        for mtime, file_size, path in files:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                size -= file_size
+            except OSError:
+                pass
+        self.size = size
+
+    def clear(self):
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                os.remove(os.path.join(root, name))
+        self.size = None
@@ -1,7 +1,15 @@
 import os
+import re
+import mmap
+import json
+import zlib
+import hashlib
+import itertools
 import multiprocessing
 import logging
 
+from filecache import FileSystemCache
+
 try:
     import numpy
 except ImportError:
@@ -230,71 +238,442 @@ class Output(object):
         raise NotImplementedError
 
 
+STARTED_TRIGGER = "******************************************"
+COMPLETED_TRIGGER = "Normal termination of Gaussian"
+INIT_TRIGGER = "Initial command"
+ORIENTATION_TRIGGER = " orientation:"
+LOG_TRIGGERS = (STARTED_TRIGGER, COMPLETED_TRIGGER, INIT_TRIGGER,
+                ORIENTATION_TRIGGER)
+
+
+class TriggerSet(object):
+    '''Finds all of the triggers in a line with one compiled alternation.
+
+    Most lines have no triggers, so a plain search is done first. After the
+    first match, a lookahead lets the matches overlap, so a trigger is found
+    even if it starts inside of another one. Only the longest trigger is
+    captured at each position, so the ones that are prefixes of it are added
+    back.'''
+
+    def __init__(self, triggers):
+        triggers = sorted(set(triggers), key=lambda x: (-len(x), x))
+        self.contained = dict((x, [y for y in triggers if x.startswith(y)])
+                              for x in triggers)
+        alternation = '|'.join(re.escape(x) for x in triggers)
+        # This never matches if there are no triggers
+        self.regex = re.compile(alternation or "(?!)")
+        self.overlap_regex = re.compile("(?=(%s))" % alternation)
+
+    def parse(self, line):
+        match = self.regex.search(line)
+        if match is None:
+            return ()
+        results = set()
+        for match in self.overlap_regex.findall(line, match.start()):
+            results.update(self.contained[match])
+        return results
+
+
+# A carriage return that is not part of a line ending
+STRAY_CR = re.compile("\r(?!\n)")
+
+
+class LogReader(object):
+    '''Iterates over the lines of a log file as (skipped, line) pairs.
+
+    If the file can be memory mapped, the reader can jump straight to the
+    next line with a trigger in it. The lines that are jumped over never
+    become strings. skipped is then the last of those lines (with any \\r
+    removed), otherwise it is None. Files that can not be mapped are read
+    line by line.'''
+
+    def __init__(self, f, triggers):
+        self.f = f
+        self.triggers = triggers
+        self.can_skip = lambda: False
+        # If any of the skipped lines had a \r in them
+        self.skipped_windows = False
+        self.mm = None
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            return
+        if STRAY_CR.search(self.mm):
+            # Lines would be split differently
+            self.mm.close()
+            self.mm = None
+
+    def __iter__(self):
+        if self.mm is None:
+            for line in self.f:
+                yield None, line
+            return
+
+        mm = self.mm
+        size = len(mm)
+        pos = 0
+        try:
+            while pos < size:
+                skipped = None
+                if self.can_skip():
+                    skipped, pos = self.skip(pos)
+                    if pos >= size:
+                        break
+                end = mm.find('\n', pos)
+                end = size if end == -1 else end + 1
+                line = mm[pos:end]
+                pos = end
+                yield skipped, line
+        finally:
+            mm.close()
+
+    def skip(self, pos):
+        '''Returns the last skipped line and the position of the start of the
+        next line with a trigger.'''
+        mm = self.mm
+        match = self.triggers.regex.search(mm, pos)
+        if match is None:
+            target = len(mm)
+        else:
+            target = max(mm.rfind('\n', pos, match.start()) + 1, pos)
+        if target == pos:
+            return None, pos
+
+        if not self.skipped_windows and mm.find('\r', pos, target) != -1:
+            self.skipped_windows = True
+        start = mm.rfind('\n', pos, target - 1) + 1 or pos
+        return mm[start:target].replace('\r', ''), target
+
+
+TAIL_BLOCK_SIZE = 64 * 1024
+# Give up on reading back from the end after this many bytes
+TAIL_MAX_SIZE = 32 * 1024 * 1024
+# These have to be done before the first orientation for the tail parse
+TAIL_START_PARSERS = ("Header", "Options", "ChargeMultiplicity")
+
+
+def read_final_step(f, size, block_size=TAIL_BLOCK_SIZE,
+                    max_size=TAIL_MAX_SIZE):
+    '''Reads blocks back from the end of the file until the start of the
+    final step (the orientation line that would start its set of parsers).
+    Returns the offset of that line and the text from it to the end, or
+    (None, None) if it could not be found.'''
+    tail = ''
+    position = size
+    while position > 0 and len(tail) < max_size:
+        read = min(block_size, position)
+        position -= read
+        f.seek(position)
+        tail = f.read(read) + tail
+
+        end = tail.rfind(ORIENTATION_TRIGGER)
+        if end == -1:
+            continue
+        # Like in previous_parsers_empty, an orientation only starts a new
+        # set of parsers if there was an energy and a step number before it
+        # (so not for a Standard orientation right after an Input one).
+        while True:
+            previous = tail.rfind(ORIENTATION_TRIGGER, 0, end)
+            between = tail[max(previous, 0):end]
+            new_set = "SCF Done" in between and "Step number" in between
+            if new_set or previous == -1:
+                break
+            end = previous
+        if not new_set and position > 0:
+            continue
+        start = tail.rfind('\n', 0, end)
+        if start == -1 and position > 0:
+            continue
+        start += 1
+        return position + start, tail[start:]
+    return None, None
+
+
+def find_in_file(f, text, start, end, block_size=TAIL_BLOCK_SIZE):
+    '''Returns the offset of the first text in the file between start and
+    end, or -1 if it is not there. The file is read a block at a time.'''
+    overlap = len(text) - 1
+    position = start
+    f.seek(position)
+    data = ''
+    while position < end:
+        read = min(block_size, end - position)
+        block = f.read(read)
+        if not block:
+            break
+        data = data[-overlap:] + block if overlap else block
+        index = data.find(text)
+        if index != -1:
+            return position + len(block) - len(data) + index
+        position += len(block)
+    return -1
+
+
+def get_archive_route(lines, delimiter):
+    '''Returns the route and the charge and multiplicity from the archive at
+    the end of a log, or None if there is no archive.'''
+    archive = ''.join(x[1:].rstrip('\n') for x in lines)
+    regex = "{0}{0}#(.*?){0}{0}.*?{0}{0}(.*?){0}".format(re.escape(delimiter))
+    matches = re.findall(regex, archive)
+    if not matches:
+        return None
+    return matches[-1]
+
+
+def normalize_options(options):
+    return re.sub(r"[\s#]", '', options).lower()
+
+
+class Dispatcher(object):
+    '''Sends each line to only the parsers that need it.
+
+    A parser gets a line if one of its TRIGGERS is in it, or if it is active
+    (in the middle of a multi line value). Parsers with no TRIGGERS get every
+    line. Parsers are dropped once they are done.'''
+
+    def __init__(self, parsers):
+        self.always = []
+        self.triggered = {}
+        self.active = []
+        for parser in parsers.values():
+            if parser.done:
+                continue
+            if parser.TRIGGERS is None:
+                self.always.append(parser)
+            else:
+                for trigger in parser.TRIGGERS:
+                    self.triggered.setdefault(trigger, []).append(parser)
+
+    def dispatch(self, line, triggers):
+        if self.active or triggers:
+            called = list(self.active)
+            for trigger in triggers:
+                for parser in self.triggered.get(trigger, ()):
+                    if parser not in called:
+                        called.append(parser)
+            self.active = []
+            for parser in called:
+                if parser.done:
+                    continue
+                parser.parse(line)
+                if parser.done:
+                    self.retire(parser)
+                elif parser.is_active():
+                    self.active.append(parser)
+
+        if self.always:
+            for parser in self.always:
+                parser.parse(line)
+            if any(x.done for x in self.always):
+                self.always = [x for x in self.always if not x.done]
+
+    def is_idle(self):
+        '''Returns True if only the lines with triggers need to be seen.'''
+        return not self.active and not self.always
+
+    def retire(self, parser):
+        for trigger in parser.TRIGGERS:
+            parsers = self.triggered[trigger]
+            parsers.remove(parser)
+            if not parsers:
+                del self.triggered[trigger]
+
+
 class Log(object):
     PARSERS = dict()
+    _trigger_set = None
     ORDER = ["ExactName", "Features", "Options", "HOMO", "LUMO",
              "HomoOrbital", "Dipole", "Energy", "BandGap", "Time",
              "DipoleVector", "ExcitationDipoleVector", "OscillatorStrength",
              "SpatialExtent", "StepNumber"]
 
-    def __init__(self, f, fname=None):
+    def __init__(self, f, fname=None, tail=False, cache=None):
         if not hasattr(f, "read"):  # filename
             f = open(f, 'r')
         with f:
             self.fname = fname if fname else f.name
             self.name = self.cleanup_name()
+            self.tail = False
 
-            self.parsers = [self.setup_parsers()]
-            self.parser_labels = [START]
-            completed = False
-            started = False
-            current_parsers = self.parsers[0]
-            self.windows_file = False
+            key = cached = None
+            if cache is not None:
+                key = cache.get_key(f, self.fname)
+                if key is not None:
+                    cached = cache.get(key)
 
-            for line in f:
-                if '\r' in line:
-                    line = line.replace('\r', '')
-                    self.windows_file = True
+            if cached is not None:
+                self.parser_labels, self.parsers, self.windows_file = cached
+            else:
+                self.tail = tail and self.parse_tail(f)
+                if not self.tail:
+                    self.parse_all(f)
 
-                if "******************************************" in line:
-                    started = True
+                # major memory saver by deleting all the line parser objects
+                self.parsers = [self.cleanup_parsers(
+                    parsers) for parsers in self.parsers]
+                # Only full parses are cached
+                if key is not None and not self.tail:
+                    cache.set(key, self)
 
-                if not started:
+        # Determine transformation
+        self.Rot = None
+        self.trans = None
+        if not self.tail:
+            # The final geometry always comes from the archive with tail
+            self.get_transformation()
+
+    def parse_all(self, f):
+        self.parsers = [self.setup_parsers()]
+        self.parser_labels = [START]
+        completed = False
+        started = False
+        current_parsers = self.parsers[0]
+        dispatcher = Dispatcher(current_parsers)
+        self.windows_file = False
+        # The line before the current one in this set of parsers
+        self.previous_line = ''
+        trigger_set = self.get_trigger_set()
+        reader = LogReader(f, trigger_set)
+        reader.can_skip = lambda: dispatcher.is_idle()
+
+        for skipped, line in reader:
+            if skipped is not None:
+                self.windows_file |= reader.skipped_windows
+                if started:
+                    self.previous_line = skipped
+            if '\r' in line:
+                line = line.replace('\r', '')
+                self.windows_file = True
+
+            triggers = trigger_set.parse(line)
+
+            if not started:
+                if STARTED_TRIGGER not in triggers:
                     continue
+                started = True
 
-                if "Normal termination of Gaussian" in line:
-                    completed = True
+            if COMPLETED_TRIGGER in triggers:
+                completed = True
 
-                init_command = "Initial command" in line
-                orientation = " orientation:" in line
-                # This check ensures that it does not create a new
-                # parser set just because it has both Input and Standard
-                # orientation geometries printed.
+            init_command = INIT_TRIGGER in triggers
+            orientation = ORIENTATION_TRIGGER in triggers
+            # This check ensures that it does not create a new
+            # parser set just because it has both Input and Standard
+            # orientation geometries printed.
+            if init_command or orientation:
                 empty = self.previous_parsers_empty()
-                if init_command or (orientation and not empty):
-                    label = START if init_command else STEP
-                    self.parser_labels.append(label)
-
-                    if not completed:
-                        current_parsers["Geometry"].value = None
-                    completed = False
-                    self.parsers.append(self.setup_parsers())
-                    current_parsers = self.parsers[-1]
-
-                for k, parser in current_parsers.items():
-                    parser.parse(line)
-
-            if not completed:
-                current_parsers["Geometry"].value = None
-
-        # major memory saver by deleting all the line parser objects
-        self.parsers = [self.cleanup_parsers(
-            parsers) for parsers in self.parsers]
+            if init_command or (orientation and not empty):
+                label = START if init_command else STEP
+                self.parser_labels.append(label)
+
+                if not completed:
+                    current_parsers["Geometry"].value = None
+                completed = False
+                self.parsers.append(self.setup_parsers())
+                current_parsers = self.parsers[-1]
+                dispatcher = Dispatcher(current_parsers)
+                self.previous_line = ''
+
+            dispatcher.dispatch(line, triggers)
+            self.previous_line = line
+
+        if not completed:
+            current_parsers["Geometry"].value = None
+
+    def parse_tail(self, f, block_size=TAIL_BLOCK_SIZE):
+        '''Parses only the start of the log and its final step.
+
+        The start has the header, the route and the charge, and the final step
+        is found by reading blocks back from the end of the file. This only
+        works if the final step has the archive and the termination line,
+        if the log has only one job (no Link1 jobs), and if the route in the
+        archive is the same as the one at the start. Returns False if the
+        whole log has to be parsed.'''
+        try:
+            f.seek(0, 2)
+            size = f.tell()
+        except (AttributeError, EnvironmentError, ValueError):
+            return False
 
-        # Determine transformation
-        self.Rot = None
-        self.trans = None
-        self.get_transformation()
+        try:
+            parsers = self.get_tail_parsers(f, size, block_size)
+        finally:
+            f.seek(0)
+        if parsers is None:
+            return False
+        self.parsers = parsers
+        self.parser_labels = [START, STEP]
+        return True
+
+    def get_tail_parsers(self, f, size, block_size):
+        offset, tail = read_final_step(f, size, block_size)
+        if tail is None:
+            return None
+        self.windows_file = '\r' in tail
+
+        f.seek(0)
+        first = self.setup_parsers()
+        dispatcher = Dispatcher(first)
+        trigger_set = self.get_trigger_set()
+        started = False
+        jobs = 0
+        self.previous_line = ''
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not line or position > offset:
+                return None
+            if '\r' in line:
+                line = line.replace('\r', '')
+                self.windows_file = True
+            triggers = trigger_set.parse(line)
+            if INIT_TRIGGER in triggers:
+                jobs += 1
+                if jobs > 1:
+                    return None
+            if not started:
+                started = STARTED_TRIGGER in triggers
+                if not started:
+                    continue
+            if ORIENTATION_TRIGGER in triggers:
+                break
+            dispatcher.dispatch(line, triggers)
+            self.previous_line = line
+        if not all(first[x].done for x in TAIL_START_PARSERS):
+            return None
+        # The start and the final step have to be from the same job. With a
+        # Link1 job the header and the labels would not match a full parse.
+        if find_in_file(f, INIT_TRIGGER, position, offset, block_size) != -1:
+            return None
+
+        final = self.setup_parsers()
+        dispatcher = Dispatcher(final)
+        completed = False
+        self.previous_line = ''
+        lines = tail.replace('\r', '').split('\n')
+        for i, line in enumerate(lines):
+            if i < len(lines) - 1:
+                line += '\n'
+            elif not line:
+                break
+            triggers = trigger_set.parse(line)
+            if INIT_TRIGGER in triggers:
+                return None
+            if COMPLETED_TRIGGER in triggers:
+                completed = True
+            dispatcher.dispatch(line, triggers)
+            self.previous_line = line
+        if not completed or not final["Geometry"].done:
+            return None
+
+        route = get_archive_route(lines, final["Geometry"].delimiter)
+        if route is None:
+            return None
+        options, charge = route
+        if (normalize_options(options) != normalize_options(first["Options"].value)
+                or charge.split(',') != first["ChargeMultiplicity"].value.split()):
+            return None
+        return [first, final]
 
     def previous_parsers_empty(self):
         prev = self.parsers[-1]
@@ -406,8 +785,20 @@ class Log(object):
     @classmethod
     def add_parser(cls, parser):
         cls.PARSERS[parser.__name__] = parser
+        cls._trigger_set = None
         return parser
 
+    @classmethod
+    def get_trigger_set(cls):
+        '''Returns the TriggerSet of the Log and of every parser. This is
+        built again whenever a parser is added.'''
+        if cls._trigger_set is None:
+            triggers = set(LOG_TRIGGERS)
+            for parser in cls.PARSERS.values():
+                triggers.update(parser.TRIGGERS or ())
+            cls._trigger_set = TriggerSet(triggers)
+        return cls._trigger_set
+
     def format_gjf(self, td=False, *args, **kwargs):
         if len(self.parsers) > 1:
             logger.warn("%s is a multistep Gaussian log file!" % self.fname)
@@ -497,18 +888,143 @@ class Log(object):
         return ','.join(nonparsed + values)
 
 
+PARSE_CACHE_VERSION = 1
+PARSE_CACHE_HASH_SIZE = 64 * 1024
+
+
+class ParseCache(object):
+    '''Stores the cleaned parser values of logs in a folder on disk, so that
+    a log that has not changed is not parsed again.
+
+    A file is found by its path, size, mtime, and a hash of its first
+    hash_size bytes. Streams that are not backed by that path (like uploads)
+    are hashed in full instead. The key also has the names of the parsers, so
+    adding a parser does not use the old values.
+
+    If max_size (in bytes) is given, the least recently used values are
+    removed once the folder goes over it.'''
+
+    def __init__(self, path, hash_size=PARSE_CACHE_HASH_SIZE, max_size=None):
+        self.path = path
+        self.hash_size = hash_size
+        self.store = FileSystemCache(path, max_size=max_size)
+
+    def get_key(self, f, fname):
+        try:
+            position = f.tell()
+        except (AttributeError, EnvironmentError, ValueError):
+            return None
+        try:
+            stat = os.fstat(f.fileno())
+            # Uploads can have a file behind them that is not at fname
+            if not os.path.samestat(stat, os.stat(fname)):
+                stat = None
+        except (AttributeError, EnvironmentError, ValueError):
+            stat = None
+
+        digest = hashlib.sha1()
+        try:
+            f.seek(0)
+            if stat is not None:
+                digest.update(f.read(self.hash_size))
+                parts = [os.path.abspath(fname), stat.st_size,
+                         repr(stat.st_mtime)]
+            else:
+                size = 0
+                for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                    digest.update(chunk)
+                    size += len(chunk)
+                parts = [fname, size]
+        finally:
+            f.seek(position)
+        parts += [digest.hexdigest(), PARSE_CACHE_VERSION,
+                  ','.join(sorted(Log.PARSERS))]
+        return hashlib.sha1('|'.join(str(x) for x in parts)).hexdigest()
+
+    def get(self, key):
+        '''Returns the parser labels, the cleaned parsers, and if the log was
+        a windows file, or None if the key is not in the cache.'''
+        value = self.store.get(key)
+        if value is None:
+            return None
+        try:
+            return self.loads(value)
+        except Exception as e:
+            logger.warn("Bad cached log values: %s - %s" % (key, e))
+            return None
+
+    def set(self, key, log):
+        self.store.set(key, self.dumps(log))
+
+    @staticmethod
+    def dumps(log):
+        '''Returns the cleaned parsers of the log as compressed JSON. The key
+        names are only stored once and the done flags as a string of 0/1.'''
+        keys = sorted(log.parsers[0])
+        data = {
+            "labels": log.parser_labels,
+            "windows": log.windows_file,
+            "keys": keys,
+            "values": [[x[k][0] for k in keys] for x in log.parsers],
+            "done": [''.join('1' if x[k][1] else '0' for k in keys)
+                     for x in log.parsers],
+        }
+        # latin-1 maps every byte, so any text in the log round trips
+        string = json.dumps(data, encoding="latin-1", separators=(',', ':'))
+        return zlib.compress(string)
+
+    @staticmethod
+    def loads(value):
+        data = json.loads(zlib.decompress(value))
+
+        def convert(x):
+            return x.encode("latin-1") if isinstance(x, unicode) else x
+
+        keys = [convert(x) for x in data["keys"]]
+        parsers = []
+        for values, done in zip(data["values"], data["done"]):
+            pairs = zip([convert(x) for x in values], [x == '1' for x in done])
+            parsers.append(dict(zip(keys, pairs)))
+        labels = [convert(x) for x in data["labels"]]
+        return labels, parsers, data["windows"]
+
+
+LOGSET_CHUNKSIZE = 16
+
+
+def parse_log_rows(args):
+    '''Parses a single log and returns its CSV rows and its error. Only
+    these strings are sent back from the workers, never the Log itself.'''
+    f, split_iter, callback, cache = args
+    try:
+        log = Log(f, cache=cache)
+        if callback is not None:
+            callback(log)
+        return log.format_data(split_iter), None
+    except Exception as e:
+        logger.info(repr(e))
+        return None, repr(e)
+
+
 class LogSet(Output):
 
-    def __init__(self, split_iter=False):
+    def __init__(self, split_iter=False, callback=None,
+                 chunksize=LOGSET_CHUNKSIZE, cache=None):
         super(LogSet, self).__init__()
-        self.logs = []
         self.header = ''
         self.split_iter = split_iter
+        # A ParseCache to skip the logs that have not changed
+        self.cache = cache
+        # This is called with each Log (in the worker) before it is dropped.
+        # It has to be picklable to be sent to the workers.
+        self.callback = callback
+        self.chunksize = chunksize
 
     @catch
     def parse_file(self, f):
-        x = Log(f)
-        self.logs.append(x)
+        x = Log(f, cache=self.cache)
+        if self.callback is not None:
+            self.callback(x)
         new = x.format_header()
         if len(new) > len(self.header):
             self.header = new
@@ -517,14 +1033,56 @@ class LogSet(Output):
     def parse_files(self, files):
         if not files:
             return
-        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-        self.logs = pool.map(Log, files)
-        pool.close()
-        pool.join()
+        self.header = Log.format_header()
+        for rows in self.iter_rows(files, ordered=True):
+            self.write(rows)
+
+    def iter_rows(self, files, ordered=False, processes=None):
+        '''Yields the CSV rows of each log as soon as it is parsed. Unless
+        ordered is set, the logs come in the order that they finish. Errors
+        are added to self.errors.'''
+        tasks = ((f, self.split_iter, self.callback, self.cache)
+                 for f in files)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        pool = None
+        if processes == 1:
+            results = itertools.imap(parse_log_rows, tasks)
+        else:
+            pool = multiprocessing.Pool(processes=processes)
+            mapper = pool.imap if ordered else pool.imap_unordered
+            results = mapper(parse_log_rows, tasks, self.chunksize)
+
+        try:
+            for rows, error in results:
+                if error is not None:
+                    self.errors.append(error)
+                else:
+                    yield rows
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def iter_output(self, files, errors=True, processes=None):
+        '''Yields the same text as format_output, but one log at a time so
+        only a single log is ever in memory. This can be given directly to a
+        StreamingHttpResponse.'''
+        yield Log.format_header() + "\n"
+        for rows in self.iter_rows(files, processes=processes):
+            yield rows + "\n"
+        if errors:
+            lines = ["\n---- Errors (%i) ----" % len(self.errors)]
+            yield '\n'.join(lines + self.errors) + "\n"
 
-        self.header = self.logs[0].format_header()
-        for log in self.logs:
-            self.write(log.format_data(self.split_iter))
+    def write_output(self, files, f, errors=True, processes=None):
+        '''Writes the output to f (a file or a filename) as it is made.'''
+        if not hasattr(f, "write"):  # filename
+            with open(f, 'w') as f2:
+                return self.write_output(files, f2, errors, processes)
+        for chunk in self.iter_output(files, errors, processes):
+            f.write(chunk)
 
     def format_output(self, errors=True):
         s = self.header + "\n"
@@ -547,6 +1105,10 @@ def is_done(fn):
 
 class LineParser(object):
     UNITS = None
+    # The parser is only given the lines with one of these in them (and the
+    # lines while it is active). None means it is given every line.
+    TRIGGERS = None
+
     def __init__(self, log):
         self.log = log
         self.done = False
@@ -556,6 +1118,11 @@ class LineParser(object):
     def parse(self, line):
         raise NotImplementedError
 
+    def is_active(self):
+        '''Returns True if the parser is in the middle of a value and needs
+        to see every line.'''
+        return bool(getattr(self, "start", False))
+
     @property
     def delimiter(self):
         if self.log.windows_file:
@@ -572,6 +1139,7 @@ class LineParser(object):
 
 @Log.add_parser
 class ExactName(LineParser):
+    TRIGGERS = ()
 
     def __init__(self, *args, **kwargs):
         super(ExactName, self).__init__(*args, **kwargs)
@@ -590,6 +1158,7 @@ class ExactName(LineParser):
 
 @Log.add_parser
 class Features(LineParser):
+    TRIGGERS = ()
 
     def __init__(self, *args, **kwargs):
         super(Features, self).__init__(*args, **kwargs)
@@ -616,6 +1185,7 @@ class Features(LineParser):
 
 @Log.add_parser
 class Options(LineParser):
+    TRIGGERS = ("#", )
 
     def __init__(self, *args, **kwargs):
         super(Options, self).__init__(*args, **kwargs)
@@ -639,6 +1209,7 @@ class Options(LineParser):
 
 @Log.add_parser
 class ChargeMultiplicity(LineParser):
+    TRIGGERS = ("Charge = ", )
 
     def __init__(self, *args, **kwargs):
         super(ChargeMultiplicity, self).__init__(*args, **kwargs)
@@ -656,11 +1227,16 @@ class ChargeMultiplicity(LineParser):
 
 @Log.add_parser
 class HomoOrbital(LineParser):
+    TRIGGERS = ("Alpha  occ. eigenvalues", )
 
     def __init__(self, *args, **kwargs):
         super(HomoOrbital, self).__init__(*args, **kwargs)
         self.value = None
 
+    def is_active(self):
+        # The count is done at the first line after the eigenvalues
+        return self.value is not None
+
     @is_done
     def parse(self, line):
         # " Alpha  occ. eigenvalues --  -88.90267 -19.16896 -19.16575 -19.15705 -19.15234"
@@ -676,15 +1252,26 @@ class HomoOrbital(LineParser):
             self.done = True
 
 
+# The ends of a line that could be the start of a split "\HF="
+SPLIT_HF_ENDS = tuple(x + y for x in ("\\", "|") for y in ('', 'H', 'HF'))
+
+
 @Log.add_parser
 class Energy(LineParser):
     UNITS = 'Hartrees'
+    TRIGGERS = ("SCF Done", "HF=", "\\", "|")
 
     def __init__(self, *args, **kwargs):
         super(Energy, self).__init__(*args, **kwargs)
         self.start = False
         self.prevline = ''
 
+    def is_active(self):
+        # The next line could finish a "\HF=" that is split over the lines
+        if self.start:
+            return True
+        return self.prevline.endswith(SPLIT_HF_ENDS)
+
     @is_done
     def parse(self, line):
         # " 36\\Version=EM64L-G09RevC.01\State=1-A\HF=-1127.8085512\RMSD=3.531e-09"
@@ -695,6 +1282,9 @@ class Energy(LineParser):
             self.done = True
             return
 
+        if not self.start:
+            # This parser does not see every line
+            self.prevline = self.log.previous_line.strip()
         modline = self.prevline + line.strip()
 
         if "{0}HF=".format(self.delimiter) in modline:
@@ -714,6 +1304,7 @@ class Energy(LineParser):
 @Log.add_parser
 class Time(LineParser):
     UNITS = 'Hours'
+    TRIGGERS = ("Job cpu time", )
 
     def __init__(self, *args, **kwargs):
         super(Time, self).__init__(*args, **kwargs)
@@ -731,6 +1322,7 @@ class Time(LineParser):
 @Log.add_parser
 class BandGap(LineParser):
     UNITS = 'eV'
+    TRIGGERS = ("Excited State   1:", )
 
     def __init__(self, *args, **kwargs):
         super(BandGap, self).__init__(*args, **kwargs)
@@ -746,6 +1338,7 @@ class BandGap(LineParser):
 @Log.add_parser
 class HOMO(LineParser):
     UNITS = 'eV'
+    TRIGGERS = ("occ. eigenvalues", "virt. eigenvalues")
 
     def __init__(self, *args, **kwargs):
         super(HOMO, self).__init__(*args, **kwargs)
@@ -766,6 +1359,7 @@ class HOMO(LineParser):
 @Log.add_parser
 class LUMO(LineParser):
     UNITS = 'eV'
+    TRIGGERS = ("occ. eigenvalues", "virt. eigenvalues")
 
     def __init__(self, *args, **kwargs):
         super(LUMO, self).__init__(*args, **kwargs)
@@ -786,6 +1380,7 @@ class LUMO(LineParser):
 @Log.add_parser
 class Geometry(LineParser):
     UNITS = 'Angstrom'
+    TRIGGERS = ("\\", "|")
 
     def __init__(self, *args, **kwargs):
         super(Geometry, self).__init__(*args, **kwargs)
@@ -845,6 +1440,7 @@ class Geometry(LineParser):
 @Log.add_parser
 class PartialGeometry(LineParser):
     UNITS = 'Angstrom'
+    TRIGGERS = ("Number       Type             X           Y           Z", )
 
     def __init__(self, *args, **kwargs):
         super(PartialGeometry, self).__init__(*args, **kwargs)
@@ -886,6 +1482,7 @@ class PartialGeometry(LineParser):
 @Log.add_parser
 class InputGeometry(LineParser):
     UNITS = 'Angstrom'
+    TRIGGERS = ("Charge =", )
 
     def __init__(self, *args, **kwargs):
         super(InputGeometry, self).__init__(*args, **kwargs)
@@ -940,6 +1537,7 @@ class InputGeometry(LineParser):
 
 @Log.add_parser
 class Header(LineParser):
+    TRIGGERS = ("%", )
 
     def __init__(self, *args, **kwargs):
         super(Header, self).__init__(*args, **kwargs)
@@ -965,6 +1563,7 @@ class Header(LineParser):
 @Log.add_parser
 class Dipole(LineParser):
     UNITS = 'Debye'
+    TRIGGERS = ("X=", )
 
     def __init__(self, *args, **kwargs):
         super(Dipole, self).__init__(*args, **kwargs)
@@ -981,6 +1580,7 @@ class Dipole(LineParser):
 @Log.add_parser
 class DipoleVector(LineParser):
     UNITS = 'Debye'
+    TRIGGERS = ("X=", )
 
     def __init__(self, *args, **kwargs):
         super(DipoleVector, self).__init__(*args, **kwargs)
@@ -998,6 +1598,7 @@ class DipoleVector(LineParser):
 @Log.add_parser
 class ExcitationDipoleVector(LineParser):
     UNITS = 'Au'
+    TRIGGERS = ("transition electric dipole", )
 
     def __init__(self, *args, **kwargs):
         super(ExcitationDipoleVector, self).__init__(*args, **kwargs)
@@ -1020,6 +1621,7 @@ class ExcitationDipoleVector(LineParser):
 
 @Log.add_parser
 class OscillatorStrength(LineParser):
+    TRIGGERS = ("Excited State   1:", )
 
     def __init__(self, *args, **kwargs):
         super(OscillatorStrength, self).__init__(*args, **kwargs)
@@ -1035,6 +1637,7 @@ class OscillatorStrength(LineParser):
 @Log.add_parser
 class SpatialExtent(LineParser):
     UNITS = 'Au'
+    TRIGGERS = ("Electronic spatial extent", )
 
     def __init__(self, *args, **kwargs):
         super(SpatialExtent, self).__init__(*args, **kwargs)
@@ -1050,6 +1653,7 @@ class SpatialExtent(LineParser):
 @Log.add_parser
 class ForceVectors(LineParser):
     UNITS = 'eV/Angstrom'
+    TRIGGERS = ("Forces (Hartrees/Bohr)", )
 
     def __init__(self, *args, **kwargs):
         super(ForceVectors, self).__init__(*args, **kwargs)
@@ -1108,6 +1712,7 @@ class ForceVectors(LineParser):
 @Log.add_parser
 class MullikenCharges(LineParser):
     UNITS = 'Au'
+    TRIGGERS = ("Mulliken", )
 
     def __init__(self, *args, **kwargs):
         super(MullikenCharges, self).__init__(*args, **kwargs)
@@ -1142,6 +1747,7 @@ class MullikenCharges(LineParser):
 @Log.add_parser
 class SumMullikenCharges(LineParser):
     UNITS = 'Au'
+    TRIGGERS = ("summed into heavy atoms", )
 
     def __init__(self, *args, **kwargs):
         super(SumMullikenCharges, self).__init__(*args, **kwargs)
@@ -1178,6 +1784,7 @@ class SumMullikenCharges(LineParser):
 
 @Log.add_parser
 class StepNumber(LineParser):
+    TRIGGERS = ("Step number", )
 
     def __init__(self, *args, **kwargs):
         super(StepNumber, self).__init__(*args, **kwargs)
@@ -1197,6 +1804,7 @@ class StepNumber(LineParser):
 
 if __name__ == "__main__":
     import argparse
+    import functools
     import sys
 
     class StandAlone(object):
@@ -1219,6 +1827,7 @@ if __name__ == "__main__":
             self.output_outx = args.outx
             self.td = args.td
             self.split_iter = args.split_iter
+            self.cache = ParseCache(args.cache) if args.cache else None
 
         def check_input_files(self, filelist):
             files = []
@@ -1257,45 +1866,49 @@ if __name__ == "__main__":
                 files += [x for x in paths if os.path.isfile(x)]
             return files
 
-        def do_writer(self, log, ending):
-            if self.td:
-                ending = "_TD" + ending
-            try:
-                # used to bubble up errors before creating the file
-                method = getattr(log, "format_" + ending.lstrip("."))
-                result = method(self.td)
-                if not isinstance(result, list):
-                    result = [result]
-
-                for i, string in enumerate(result):
-                    tail = ending
-                    if len(result) > 1:
-                        tail = ('_step%03d' % i) + ending
-
-                    with open(log.name + tail, 'w') as outputfile:
-                        outputfile.write(string)
-
-            except Exception as e:
-                logger.info(
-                    "Problem parsing file: %s - %s" % (log.name, str(e)))
-
         def write_file(self):
-            logs = LogSet(self.split_iter)
-            logs.parse_files(self.files)
-
             names = [".out", ".gjf", ".outx"]
             mask = [self.output_out, self.output_gjf, self.output_outx]
 
             endings = [x for x, y in zip(names, mask) if y]
-            for ending in endings:
-                for log in logs.logs:
-                    self.do_writer(log, ending)
+            callback = None
+            if endings:
+                callback = functools.partial(write_log_files, endings=endings,
+                                             td=self.td)
+            logs = LogSet(self.split_iter, callback=callback, cache=self.cache)
 
             if self.outputfilename:
-                with open(self.outputfilename, 'w') as outputfile:
-                    outputfile.write(logs.format_output(errors=self.error))
+                logs.write_output(self.files, self.outputfilename,
+                                  errors=self.error)
             else:
-                print logs.format_output(errors=self.error)
+                logs.write_output(self.files, sys.stdout, errors=self.error)
+
+    def write_log_files(log, endings, td=False):
+        # This runs in the LogSet workers, so it can not be a method
+        for ending in endings:
+            do_writer(log, ending, td)
+
+    def do_writer(log, ending, td=False):
+        if td:
+            ending = "_TD" + ending
+        try:
+            # used to bubble up errors before creating the file
+            method = getattr(log, "format_" + ending.lstrip("."))
+            result = method(td)
+            if not isinstance(result, list):
+                result = [result]
+
+            for i, string in enumerate(result):
+                tail = ending
+                if len(result) > 1:
+                    tail = ('_step%03d' % i) + ending
+
+                with open(log.name + tail, 'w') as outputfile:
+                    outputfile.write(string)
+
+        except Exception as e:
+            logger.info(
+                "Problem parsing file: %s - %s" % (log.name, str(e)))
 
     parser = argparse.ArgumentParser(
         description="This program extracts data from Gaussian log files.")
@@ -1329,6 +1942,8 @@ if __name__ == "__main__":
                         help='Toggles writing .out files from logs.')
     parser.add_argument('-X', action="store_true", dest="outx", default=False,
                         help='Toggles writing .outx files from logs.')
+    parser.add_argument('-C', metavar='cache', action="store", dest="cache",
+                        type=str, help='A folder to cache the parsed logs in.')
 
     if len(sys.argv) > 1:
         args = sys.argv[1:]
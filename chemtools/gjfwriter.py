@@ -2,27 +2,35 @@ import functools
 import collections
 import base64
 import logging
-import re
 
 import numpy
 from numpy.linalg import norm
+from scipy.spatial.distance import pdist, squareform
 
 import structure
+import structure_cache
 from constants import KEYWORDS, NUMBERS
 from mol_name import get_exact_name, autoflip_name, get_structure_type
 from ml import get_decay_distance_correction_feature_vector, \
     get_binary_feature_vector, get_decay_feature_vector, \
-    get_properties_from_decay_with_predictions
+    get_properties_from_decay_with_predictions, predict_properties, \
+    get_properties_from_prediction, PROPERTY_DTYPE, N_FEATURE, M_FEATURE
+from utils import LRUCache
 import dataparser
+from data.models import Predictor
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_cache_name(name):
+    return '_' + name.lstrip('get')
+
+
 def cache(f):
     @functools.wraps(f)
     def wrapper(self, *args, **kwargs):
-        name = '_' + f.__name__.lstrip('get')
+        name = get_cache_name(f.__name__)
         value = self.__dict__.get(name, None)
         if value is None:
             value = f(self, *args, **kwargs)
@@ -31,6 +39,187 @@ def cache(f):
     return wrapper
 
 
+def coulomb_matrix(coords, numbers):
+    '''Returns the Coulomb matrix of atoms with the given (N, 3) coordinates
+    and atomic numbers.'''
+    numbers = numpy.asarray(numbers, dtype=float)
+    if not len(numbers):
+        return numpy.zeros((0, 0))
+    dist = squareform(pdist(numpy.asarray(coords, dtype=float)))
+    numpy.fill_diagonal(dist, 1.)
+    data = numpy.outer(numbers, numbers) / dist
+    numpy.fill_diagonal(data, 0.5 * numbers ** 2.4)
+    return data
+
+
+# The most memory (in bytes) get_coulomb_features uses for the padded
+# matrices of one chunk of molecules
+COULOMB_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def get_coulomb_features(molecules, kind="sorted", size=None,
+                         max_bytes=COULOMB_CHUNK_BYTES):
+    '''Returns an array with the Coulomb matrix features of each molecule
+    as a row.
+
+    kind can be "sorted", the lower triangle (with the diagonal) of the
+    matrix with its rows and columns ordered by their norms, or
+    "eigenvalues", the eigenvalues ordered by their magnitudes. All the
+    matrices are zero padded to size atoms, which defaults to the size of
+    the largest molecule.
+
+    The matrices are only built for one chunk of molecules at a time, and
+    the chunks are sized so their padded matrices fit in max_bytes.'''
+    if kind not in ("sorted", "eigenvalues"):
+        raise ValueError("Unknown Coulomb matrix feature: %s" % kind)
+
+    molecules = list(molecules)
+    if size is None:
+        size = max([len(x.structure.atoms) for x in molecules] or [0])
+
+    rows, cols = numpy.tril_indices(size)
+    width = len(rows) if kind == "sorted" else size
+    features = numpy.zeros((len(molecules), width))
+
+    # Sorting makes a reordered copy of the stack, so it takes twice the space
+    copies = 2 if kind == "sorted" else 1
+    chunksize = max(1, int(max_bytes // (copies * 8 * max(size, 1) ** 2)))
+    for start in xrange(0, len(molecules), chunksize):
+        chunk = molecules[start:start + chunksize]
+        stack = numpy.zeros((len(chunk), size, size))
+        for i, mol in enumerate(chunk):
+            atoms = mol.structure.atoms
+            n = len(atoms)
+            if n > size:
+                raise ValueError("Molecule has more than %d atoms" % size)
+            numbers = [NUMBERS[x] for x in atoms.elements]
+            stack[i, :n, :n] = coulomb_matrix(atoms.coords, numbers)
+
+        if kind == "sorted":
+            order = numpy.argsort(-norm(stack, axis=2), axis=1,
+                                  kind="mergesort")
+            idx = numpy.arange(len(chunk))[:, None, None]
+            stack = stack[idx, order[:, :, None], order[:, None, :]]
+            values = stack[:, rows, cols]
+        else:
+            values = numpy.linalg.eigvalsh(stack)
+            order = numpy.argsort(-abs(values), axis=1, kind="mergesort")
+            values = values[numpy.arange(len(chunk))[:, None], order]
+        features[start:start + len(chunk)] = values
+        del stack
+    return features
+
+
+def predict_molecule_properties(molecules, predictor=None):
+    '''Returns a structured array with the predicted properties of each
+    molecule. All of the molecules are predicted in one batch, and the rows
+    of the molecules with invalid names are set to nan.
+
+    The results are also stored on the molecules, so later calls to
+    get_property_predictions do not predict them again.'''
+    features = [x.get_decay_feature_vector() for x in molecules]
+    valid = [i for i, x in enumerate(features) if x is not None]
+
+    results = numpy.zeros(len(molecules), dtype=PROPERTY_DTYPE)
+    results[:] = (numpy.nan, ) * len(PROPERTY_DTYPE.names)
+    if valid:
+        results[valid] = predict_properties([features[i] for i in valid],
+                                            predictor=predictor)
+    for i in valid:
+        properties = get_properties_from_prediction(results[i])
+        name = get_cache_name("get_property_predictions")
+        molecules[i].__dict__[name] = properties
+    return results
+
+
+LIMIT_XVALS = range(1, 5)
+LIMITS_CACHE = LRUCache(maxsize=1024)
+
+
+def get_variant_name(name, direction, value):
+    '''Returns the name with its n (or m) value set to value.'''
+    parts = [x for x in name.split('_')
+             if not (x[:1] == direction and x[1:].isdigit())]
+    return '_'.join(parts + ["%s%d" % (direction, value)])
+
+
+def get_variant_features(name, direction, xvals=LIMIT_XVALS):
+    '''Returns the decay feature vectors of the name with n (or m) set to
+    each of xvals.
+
+    Only the names with the value set to 1 and 2 are parsed. Past 1, the
+    value only changes its own entry in the feature vector, so the other
+    vectors are copies of the one for 2.'''
+    index = N_FEATURE if direction == 'n' else M_FEATURE
+    bases = {}
+    vectors = []
+    for x in xvals:
+        key = min(x, 2)
+        if key not in bases:
+            variant = get_variant_name(name, direction, key)
+            exact_name = get_exact_name(variant, spacers=True)
+            bases[key] = get_decay_feature_vector(exact_name)
+        vector = list(bases[key])
+        vector[index] = x
+        vectors.append(vector)
+    return vectors
+
+
+def get_property_limits(name, method="curve_fit", predictor=None):
+    '''Returns the predicted homo, lumo, and gap of the name in the limit of
+    infinite n and m.
+
+    All of the variants are predicted in one batch, and the results are
+    cached by exact name and predictor.'''
+    results = {
+        "n": [None, None, None],
+        "m": [None, None, None]
+    }
+    use = ["homo", "lumo", "gap"]
+    try:
+        exact_name = get_exact_name(name, spacers=True)
+    except Exception:
+        return results
+
+    if predictor is None:
+        try:
+            predictor = Predictor.get_latest()
+        except Exception as e:
+            # Without a usable predictor there are no limits to give
+            logger.warn("Could not load the predictor: %s" % e)
+            return results
+    key = (exact_name, predictor.id, method)
+    cached = LIMITS_CACHE.get(key)
+    if cached is not None:
+        return dict((x, list(y)) for x, y in cached.items())
+
+    directions = []
+    features = []
+    for direction in sorted(results):
+        try:
+            features.extend(get_variant_features(name, direction))
+            directions.append(direction)
+        except Exception:
+            logger.info("Improper property limits: %s - %s" %
+                        (name, direction))
+
+    if features:
+        predictions = predict_properties(features, predictor=predictor)
+        size = len(LIMIT_XVALS)
+        for i, direction in enumerate(directions):
+            group = predictions[i * size:(i + 1) * size]
+            try:
+                lim_results = dataparser.predict_values(
+                    LIMIT_XVALS, *[group[x] for x in use], method=method)
+                results[direction] = [lim_results[x][0] for x in use]
+            except (KeyError, TypeError, RuntimeError):
+                logger.info("Improper property limits: %s - %s" %
+                            (name, direction))
+
+    LIMITS_CACHE.set(key, results)
+    return dict((x, list(y)) for x, y in results.items())
+
+
 class Molecule(object):
 
     def __init__(self, name, **kwargs):
@@ -125,37 +314,15 @@ class Molecule(object):
 
     @cache
     def get_coulomb_matrix(self):
-        coords = []
-        other = []
-
-        for atom in self.structure.atoms:
-            coords.append(atom.xyz)
-            other.append(NUMBERS[atom.element])
-
-        N = len(self.structure.atoms)
-        data = numpy.matrix(numpy.zeros((N, N)))
-        for i, x in enumerate(coords):
-            for j, y in enumerate(coords[:i]):
-                val = (other[i] * other[j]) / norm(x - y)
-                data[i, j] = val
-                data[j, i] = val
-
-        diag = [0.5 * x ** 2.4 for x in other]
-        for i, x in enumerate(diag):
-            data[i, i] = x
-
-        return data
+        atoms = self.structure.atoms
+        numbers = [NUMBERS[x] for x in atoms.elements]
+        return numpy.matrix(coulomb_matrix(atoms.coords, numbers))
 
     @cache
     def get_coulomb_matrix_feature(self):
-        data = self.get_coulomb_matrix()
-        vector = []
-        end = []
-        for i in xrange(data.shape[0]):
-            for j in xrange(0, i):
-                vector.append(data[i, j])
-            end.append(data[i, i])
-        return vector + end
+        data = numpy.asarray(self.get_coulomb_matrix())
+        rows, cols = numpy.tril_indices(data.shape[0], -1)
+        return numpy.concatenate([data[rows, cols], data.diagonal()]).tolist()
 
     def get_element_counts(self):
         elems = [x.element for x in self.structure.atoms]
@@ -178,10 +345,7 @@ class NamedMolecule(Molecule):
     @property
     @cache
     def structure(self):
-        struct = structure.from_name(self.name)
-        if self.perturb:
-            struct.perturb(delta=self.perturb)
-        return struct
+        return structure_cache.get_structure(self.name, perturb=self.perturb)
 
     def get_exact_name(self, spacers=False):
         if self._exact_name is None:
@@ -240,41 +404,14 @@ class NamedMolecule(Molecule):
 
     @cache
     def get_property_limits(self):
-        results = {
-            "n": [None, None, None],
-            "m": [None, None, None]
-        }
-        use = ["homo", "lumo", "gap"]
-        for direction in results:
-            try:
-                groups = []
-                xvals = range(1, 5)
-                for j in xvals:
-                    if direction in self.name:
-                        expr = "%s\d+" % direction
-                        replace = "%s%d" % (direction, j)
-                        temp_name = re.sub(expr, replace, self.name)
-                    else:
-                        temp_name = self.name + "_%s%d" % (direction, j)
-                    struct = NamedMolecule(temp_name)
-                    properties = struct.get_property_predictions()
-                    groups.append([x.value for x in properties if x.short in use])
-
-                lim_results = dataparser.predict_values(xvals, *zip(*groups))
-
-                results[direction] = []
-                for prop in properties:
-                    try:
-                        x = lim_results[prop.short][0]
-                    except KeyError:
-                        x = None
-                    results[direction].append(x)
-
-            except (KeyError, TypeError):
-                logger.info("Improper property limits: %s - %s" %
-                            (self.name, direction))
-                pass
-        return results
+        try:
+            return get_property_limits(self.name)
+        except (KeyError, TypeError):
+            logger.info("Improper property limits: %s" % self.name)
+            return {
+                "n": [None, None, None],
+                "m": [None, None, None]
+            }
 
     def get_info(self):
         features = {
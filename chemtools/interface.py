@@ -3,6 +3,8 @@ import re
 from cStringIO import StringIO
 import zipfile
 import logging
+import itertools
+import multiprocessing
 
 import gjfwriter
 import mol_name
@@ -14,55 +16,131 @@ from data.models import JobTemplate
 logger = logging.getLogger(__name__)
 
 
-def get_multi_molecule(molecules, options, mol_form, job_form):
-    buff = StringIO()
-    zfile = zipfile.ZipFile(buff, "w", zipfile.ZIP_DEFLATED)
+class ZipStream(object):
+    '''A write only file object for building a zip file in pieces.
+
+    ZipFile only needs write, tell and flush when writing entries with
+    writestr, so the bytes can be handed off as soon as each entry is written
+    instead of keeping the whole archive in memory.'''
+
+    def __init__(self):
+        self.position = 0
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def build_molecule_files(args):
+    '''Returns the (filename, data) pairs of one molecule, or an error
+    string. This runs in the worker processes of iter_multi_molecule.'''
+    name, filename, options, mol_settings = args
+    try:
+        out = gjfwriter.NamedMolecule(name, **mol_settings)
+        files = []
+        if "image" in options:
+            files.append((filename + ".png", out.get_png(10)))
+        if "mol2" in options:
+            files.append((filename + ".mol2", out.get_mol2()))
+
+        others = bool(set(["image", "mol2", "job"]) & set(options))
+        if "gjf" in options or not others:
+            files.append((filename + ".gjf", out.get_gjf()))
+        return name, files, None
+    except Exception as e:
+        return name, [], str(e)
+
+
+def iter_multi_molecule(molecules, options, mol_form, job_form, workers=1,
+                        chunksize=None):
+    '''Yields the bytes of a zip file with the outputs of all the molecules.
+
+    If workers is more than 1, the molecules are built in a process pool.
+    They are still added to the zip in the order they were given, so the
+    same request always gives the same zip. Only chunksize molecules are
+    handed to the pool at a time, so the memory used does not depend on the
+    number of molecules.'''
+    stream = ZipStream()
+    zfile = zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED)
     mol_settings = dict(mol_form.cleaned_data)
+    if chunksize is None:
+        chunksize = 4 * workers
 
-    generrors = []
-    for name in molecules:
-        try:
-            dnew = job_form.get_single_data(name)
-            mol_name = dnew['name']
-        except AttributeError:
-            mol_name = name
-
-        try:
-            out = gjfwriter.NamedMolecule(name, **mol_settings)
-            others = False
-
-            if "image" in options:
-                zfile.writestr(mol_name + ".png", out.get_png(10))
-                others = True
-            if "mol2" in options:
-                zfile.writestr(mol_name + ".mol2", out.get_mol2())
-                others = True
-            if "job" in options:
-                zfile.writestr(mol_name + ".job", JobTemplate.render(**dnew))
-                others = True
-
-            if "gjf" in options or not others:
-                zfile.writestr(mol_name + ".gjf", out.get_gjf())
-
-        except Exception as e:
-            logger.warn("Multigen error: %s - %s" % (name, e))
-            generrors.append("%s - %s" % (name, e))
-    if generrors:
-        zfile.writestr("errors.txt", '\n'.join(generrors))
-
-    zfile.close()
-    buff.flush()
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(processes=workers)
 
-    ret_zip = buff.getvalue()
-    buff.close()
-    return ret_zip
+    generrors = []
+    try:
+        molecules = iter(molecules)
+        while True:
+            chunk = list(itertools.islice(molecules, chunksize))
+            if not chunk:
+                break
+
+            jobs = {}
+            tasks = []
+            for name in chunk:
+                try:
+                    dnew = job_form.get_single_data(name)
+                    filename = dnew['name']
+                    jobs[name] = dnew
+                except AttributeError:
+                    filename = name
+                tasks.append((name, filename, options, mol_settings))
+
+            if pool is not None:
+                results = pool.imap(build_molecule_files, tasks)
+            else:
+                results = itertools.imap(build_molecule_files, tasks)
+
+            for name, files, error in results:
+                try:
+                    if error is not None:
+                        raise ValueError(error)
+                    for filename, data in files:
+                        zfile.writestr(filename, data)
+                    if "job" in options:
+                        dnew = jobs[name]
+                        zfile.writestr(dnew['name'] + ".job",
+                                       JobTemplate.render(**dnew))
+                except Exception as e:
+                    logger.warn("Multigen error: %s - %s" % (name, e))
+                    generrors.append("%s - %s" % (name, e))
+                yield stream.pop()
+
+        if generrors:
+            zfile.writestr("errors.txt", '\n'.join(generrors))
+        zfile.close()
+        yield stream.pop()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def get_multi_molecule(molecules, options, mol_form, job_form, workers=1):
+    return ''.join(iter_multi_molecule(molecules, options, mol_form,
+                                       job_form, workers=workers))
 
 
 def get_multi_job(string, form):
     buff = StringIO()
     zfile = zipfile.ZipFile(buff, 'w', zipfile.ZIP_DEFLATED)
 
-    for name in mol_name.name_expansion(string):
+    for name in mol_name.iter_name_expansion(string):
         if not name:
             continue
         name, _ = os.path.splitext(name)
@@ -4,7 +4,7 @@ import logging
 
 from django.core.management.base import BaseCommand
 
-from chemtools.structure import Atom, Bond
+from chemtools.structure import Atom, Bond, clear_fragment_cache
 from chemtools.constants import NUMCORES, RGROUPS, ARYL
 
 
@@ -64,4 +64,8 @@ class Command(BaseCommand):
 	            f.write('\n')
 	            for bond in bonds:
 	                f.write(' '.join(bond.mol2.split()[1:]) + '\n')
-	        logger.debug("Converted %s to %s" % (fname, os.path.join(base, "data", name)))
\ No newline at end of file
+	        logger.debug("Converted %s to %s" % (fname, os.path.join(base, "data", name)))
+	    # The files are rewritten in place, so bump the directory mtime to let
+	    # running processes know their fragment caches are stale.
+	    os.utime(os.path.join(base, "data"), None)
+	    clear_fragment_cache()
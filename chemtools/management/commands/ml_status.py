@@ -0,0 +1,48 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from data.models import TrainingJob
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Show the status of the latest update_ml runs'
+    option_list = BaseCommand.option_list + (
+        make_option('--limit',
+                    type="int",
+                    dest='limit',
+                    default=5,
+                    help='The number of runs to show.'),
+        make_option('--clear-stale',
+                    action='store_true',
+                    dest='clear_stale',
+                    default=False,
+                    help='Mark running jobs that are stale as failed.'),
+    )
+
+    def handle(self, *args, **options):
+        if options.get("clear_stale"):
+            for job in TrainingJob.objects.filter(status=TrainingJob.RUNNING):
+                if job.is_stale():
+                    job.finish(TrainingJob.FAILED,
+                               message="Cleared as stale.")
+                    self.stdout.write("Cleared stale job %d." % job.id)
+
+        jobs = TrainingJob.objects.order_by("-started")[:options["limit"]]
+        if not jobs:
+            self.stdout.write("No runs.")
+        for job in jobs:
+            info = job.to_dict()
+            line = "%(id)d %(status)s %(progress).0f%% %(duration).1fs" % info
+            if info["stage"] and job.status == TrainingJob.RUNNING:
+                line += " stage: %s" % info["stage"]
+            if info["stale"]:
+                line += " (stale)"
+            if info["message"]:
+                line += " - %s" % info["message"]
+            self.stdout.write(line)
+            for name, lo, hi in TrainingJob.STAGES:
+                if name in info["durations"]:
+                    self.stdout.write(
+                        "    %s: %.1fs" % (name, info["durations"][name]))
@@ -1,32 +1,41 @@
-import os
 import itertools
+import logging
 import cPickle
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
 
 from django.core.management.base import BaseCommand
 from django.core.files import File
+from django.conf import settings
 import numpy
 import scipy.optimize
 from sklearn import svm
-from sklearn import cross_validation
+from sklearn.base import clone
 from sklearn.metrics import mean_absolute_error
 
-from data.models import DataPoint, Predictor
+from data.models import DataPoint, Predictor, TrainingJob
 from project.utils import StringIO
 
 
+logger = logging.getLogger(__name__)
+
+
 def lock(func):
+    '''Runs func with a new TrainingJob as its first argument, unless there
+    is already a job running. The job is marked as failed if func raises.'''
     def wrapper(*args, **kwargs):
-        # Not very safe, but it will work well enough
-        if os.path.exists(".updating_ml"):
+        job = TrainingJob.start()
+        if job is None:
             print "Already running"
             return
-        with open(".updating_ml", "w"):
-            try:
-                value = func(*args, **kwargs)
-            except Exception as e:
-                print e
-                value = None
-        os.remove(".updating_ml")
+        try:
+            value = func(job, *args, **kwargs)
+        except Exception as e:
+            logger.exception("The ML update failed")
+            job.finish(TrainingJob.FAILED, message=str(e))
+            raise
+        job.finish(TrainingJob.DONE)
         return value
     return wrapper
 
@@ -34,37 +43,164 @@ def lock(func):
 class Command(BaseCommand):
     args = ''
     help = 'Update ML data'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+                    type="int",
+                    dest='workers',
+                    default=None,
+                    help='The number of processes used for the training.'),
+        make_option('--seed',
+                    type="int",
+                    dest='seed',
+                    default=0,
+                    help='The seed used for each of the training tasks.'),
+        make_option('--incremental',
+                    action='store_true',
+                    dest='incremental',
+                    default=False,
+                    help='Reuse the cached feature matrix and skip the '
+                    'hyperparameter search if there is little new data.'),
+        make_option('--threshold',
+                    type="float",
+                    dest='threshold',
+                    default=None,
+                    help='The fraction of new data needed to run the search '
+                    'in incremental mode.'),
+    )
 
     def handle(self, *args, **options):
-        run_all()
-
-
-def test_clf_kfold(X, y, clf, folds=10):
-    train = numpy.zeros(folds)
-    cross = numpy.zeros(folds)
-    folds = cross_validation.KFold(y.shape[0], n_folds=folds)
-    for i, (train_idx, test_idx) in enumerate(folds):
-        X_train = X[train_idx]
-        X_test = X[test_idx]
-        y_train = y[train_idx].T.tolist()[0]
-        y_test = y[test_idx].T.tolist()[0]
-        clf.fit(X_train, y_train)
-        train[i] = mean_absolute_error(clf.predict(X_train), y_train)
-        cross[i] = mean_absolute_error(clf.predict(X_test), y_test)
-    return (train.mean(), train.std()), (cross.mean(), cross.std())
-
-
-def scan(X, y, function, params):
+        workers = options.get("workers")
+        if workers is None:
+            workers = getattr(settings, "ML_UPDATE_WORKERS", 1)
+        run_all(workers=workers,
+                seed=options.get("seed", 0),
+                incremental=options.get("incremental", False),
+                threshold=options.get("threshold"))
+
+
+def get_kfold_indices(n, folds=10):
+    '''Returns the (train, test) index pairs for k consecutive folds. This
+    is the same split as sklearn's KFold without shuffling.'''
+    sizes = numpy.zeros(folds, dtype=int) + n // folds
+    sizes[:n % folds] += 1
+    idxs = numpy.arange(n)
+    pairs = []
+    start = 0
+    for size in sizes:
+        test = idxs[start:start + size]
+        train = numpy.concatenate([idxs[:start], idxs[start + size:]])
+        pairs.append((train, test))
+        start += size
+    return pairs
+
+
+# The data for the training tasks. This is set before the worker processes
+# are started so that they get it when they fork instead of it being pickled
+# for every task.
+_DATA = {}
+
+
+def _run_task(task):
+    name, clf, train_idx, test_idx, seed = task
+    X, y = _DATA[name]
+    numpy.random.seed(seed)
+    clf = clone(clf)
+    if train_idx is None:
+        clf.fit(X, y)
+        return clf
+    clf.fit(X[train_idx], y[train_idx])
+    train = mean_absolute_error(clf.predict(X[train_idx]), y[train_idx])
+    test = mean_absolute_error(clf.predict(X[test_idx]), y[test_idx])
+    return train, test
+
+
+class Trainer(object):
+    '''Runs the cross validation folds and the fits of the models in a pool
+    of worker processes.
+
+    data is a dict of name -> (X, y) for each model that will be trained.
+    Every task is seeded from seed and its fold, so the results do not depend
+    on the number of workers.'''
+
+    def __init__(self, data, workers=1, seed=0):
+        self.workers = workers
+        self.seed = seed
+        self.pool = None
+        _DATA.clear()
+        for name, (X, y) in data.items():
+            _DATA[name] = (numpy.asarray(X), numpy.asarray(y).ravel())
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        _DATA.clear()
+
+    def map(self, tasks):
+        if self.pool is None:
+            return map(_run_task, tasks)
+        return self.pool.map(_run_task, tasks, chunksize=1)
+
+    def map_models(self, func, items, callback=None):
+        '''Runs func over the items at the same time so that the tasks of
+        all of them share the pool. callback is called from this thread with
+        the fraction of the items that are done after each one finishes.'''
+        results = [None] * len(items)
+        threads = None
+        if self.pool is None:
+            finished = ((i, func(x)) for i, x in enumerate(items))
+        else:
+            threads = ThreadPool(len(items))
+            finished = threads.imap_unordered(
+                lambda x: (x[0], func(x[1])), enumerate(items))
+        try:
+            for count, (i, result) in enumerate(finished, 1):
+                results[i] = result
+                if callback is not None:
+                    callback(count / float(len(items)))
+        finally:
+            if threads is not None:
+                threads.close()
+                threads.join()
+        return results
+
+    def kfold_many(self, name, clfs, folds=10):
+        n = _DATA[name][1].shape[0]
+        pairs = get_kfold_indices(n, folds)
+        tasks = []
+        for clf in clfs:
+            for i, (train_idx, test_idx) in enumerate(pairs):
+                tasks.append((name, clf, train_idx, test_idx, self.seed + i))
+        results = numpy.array(self.map(tasks)).reshape(len(clfs), folds, 2)
+
+        values = []
+        for result in results:
+            train, cross = result.T
+            values.append(((train.mean(), train.std()),
+                           (cross.mean(), cross.std())))
+        return values
+
+    def kfold(self, name, clf, folds=10):
+        return self.kfold_many(name, [clf], folds=folds)[0]
+
+    def fit(self, name, clf):
+        return self.map([(name, clf, None, None, self.seed)])[0]
+
+
+def scan(trainer, name, function, params):
     size = [len(x) for x in params.values()]
     train_results = numpy.zeros(size)
     test_results = numpy.zeros(size)
     keys = params.keys()
     values = params.values()
-    for group in itertools.product(*values):
+    groups = list(itertools.product(*values))
+    clfs = [function(**dict(zip(keys, group))) for group in groups]
+    results = trainer.kfold_many(name, clfs)
+    for group, (train, test) in zip(groups, results):
         idx = tuple([a.index(b) for a, b in zip(values, group) if len(a) > 1])
-        a = dict(zip(keys, group))
-        clf = function(**a)
-        train, test = test_clf_kfold(X, y, clf)
         train_results[idx] = train[0]
         test_results[idx] = test[0]
     return train_results, test_results
@@ -72,19 +208,24 @@ def scan(X, y, function, params):
 
 class OptimizedCLF(object):
 
-    def __init__(self, X, y, func, params):
+    def __init__(self, trainer, name, func, params, epsilon=0.1):
         self.params = params
         self.func = func
-        self.X = X
-        self.y = y
+        self.trainer = trainer
+        self.name = name
+        self.epsilon = epsilon
         self.optimized_clf = None
         self.optimized_params = None
 
-    def __call__(self, *args):
-        a = dict(zip(self.params.keys(), *args))
-        clf = self.func(**a)
-        train, test = test_clf_kfold(self.X, self.y, clf, folds=5)
-        return test[0]
+    def __call__(self, x, keys):
+        '''Returns the cross validation error at x and its forward difference
+        gradient. All of the points are run together.'''
+        points = [x] + [x + self.epsilon * e for e in numpy.eye(len(x))]
+        clfs = [self.func(**dict(zip(keys, point))) for point in points]
+        results = self.trainer.kfold_many(self.name, clfs, folds=5)
+        errors = numpy.array([test[0] for train, test in results])
+        grad = (errors[1:] - errors[0]) / self.epsilon
+        return errors[0], grad
 
     def get_optimized_clf(self):
         if not len(self.params.keys()):
@@ -98,20 +239,19 @@ class OptimizedCLF(object):
         listvalues = []
         itemvalues = []
         if listparams:
-            _, test = scan(self.X, self.y, self.func, listparams)
+            _, test = scan(self.trainer, self.name, self.func, listparams)
             listvalues = []
             temp = numpy.unravel_index(test.argmin(), test.shape)
             for i, pick in enumerate(listparams.values()):
                 listvalues.append(pick[temp[i]])
             listvalues = listvalues[::-1]
         if itemparams:
-            bounds = ((1e-8, None), ) * len(self.params.keys())
+            bounds = ((1e-8, None), ) * len(itemparams)
             results = scipy.optimize.fmin_l_bfgs_b(
                 self,
-                self.params.values(),
+                numpy.array(itemparams.values(), dtype=float),
+                args=(itemparams.keys(), ),
                 bounds=bounds,
-                approx_grad=True,
-                epsilon=0.1,
                 maxiter=15,
                 maxfun=30,
             )
@@ -123,7 +263,7 @@ class OptimizedCLF(object):
         return self.optimized_clf
 
 
-def fit_func(X, y, clf=None):
+def fit_func(trainer, name, clf=None, search=True):
     func = svm.SVR
     if clf is None:
         params = {"C": 10, "gamma": 0.05}
@@ -131,32 +271,38 @@ def fit_func(X, y, clf=None):
         print "Using previous clf"
         params = {"C": clf.C, "gamma": clf.gamma}
 
-    clf = OptimizedCLF(X, y, func, params).get_optimized_clf()
-    train, test = test_clf_kfold(X, y, clf, folds=10)
-    clf.fit(X, y.T.tolist()[0])
+    if search or clf is None:
+        clf = OptimizedCLF(trainer, name, func, params).get_optimized_clf()
+    else:
+        clf = func(**params)
+    train, test = trainer.kfold(name, clf, folds=10)
+    clf = trainer.fit(name, clf)
     clf.test_error = test
     return clf
 
 
-def get_first_layer(X, homo, lumo, gap, in_clfs=None):
+def get_first_layer(X, homo, lumo, gap, in_clfs=None, workers=1, seed=0,
+                    search=True, callback=None):
     print "Creating first layer"
-    if in_clfs is not None:
-        in_homo_clf, in_lumo_clf, in_gap_clf = in_clfs
-    else:
-        in_homo_clf, in_lumo_clf, in_gap_clf = [None] * 3
-
-    homo_clf = fit_func(X, homo, clf=in_homo_clf)
-    lumo_clf = fit_func(X, lumo, clf=in_lumo_clf)
-    gap_clf = fit_func(X, gap, clf=in_gap_clf)
-    return homo_clf, lumo_clf, gap_clf
-
-
-def get_second_layer(X, homo, lumo, gap, clfs, in_pred_clfs=None):
+    if in_clfs is None:
+        in_clfs = [None] * 3
+
+    data = {"homo": (X, homo), "lumo": (X, lumo), "gap": (X, gap)}
+    trainer = Trainer(data, workers=workers, seed=seed)
+    try:
+        items = zip(["homo", "lumo", "gap"], in_clfs)
+        return tuple(trainer.map_models(
+            lambda x: fit_func(trainer, *x, search=search), items,
+            callback=callback))
+    finally:
+        trainer.close()
+
+
+def get_second_layer(X, homo, lumo, gap, clfs, in_pred_clfs=None, workers=1,
+                     seed=0, search=True, callback=None):
     print "Creating second layer"
-    if in_pred_clfs is not None:
-        in_pred_homo, in_pred_lumo, in_pred_gap = in_pred_clfs
-    else:
-        in_pred_homo, in_pred_lumo, in_pred_gap = [None] * 3
+    if in_pred_clfs is None:
+        in_pred_clfs = [None] * 3
 
     homo_clf, lumo_clf, gap_clf = clfs
     homop = numpy.matrix(homo_clf.predict(X)).T
@@ -167,10 +313,15 @@ def get_second_layer(X, homo, lumo, gap, clfs, in_pred_clfs=None):
     X_lumo = numpy.concatenate([X, gapp, homop], 1)
     X_gap = numpy.concatenate([X, homop, lumop], 1)
 
-    pred_homo_clf = fit_func(X_homo, homo, clf=in_pred_homo)
-    pred_lumo_clf = fit_func(X_lumo, lumo, clf=in_pred_lumo)
-    pred_gap_clf = fit_func(X_gap, gap, clf=in_pred_gap)
-    return pred_homo_clf, pred_lumo_clf, pred_gap_clf
+    data = {"homo": (X_homo, homo), "lumo": (X_lumo, lumo), "gap": (X_gap, gap)}
+    trainer = Trainer(data, workers=workers, seed=seed)
+    try:
+        items = zip(["homo", "lumo", "gap"], in_pred_clfs)
+        return tuple(trainer.map_models(
+            lambda x: fit_func(trainer, *x, search=search), items,
+            callback=callback))
+    finally:
+        trainer.close()
 
 
 def save_clfs(clfs, pred_clfs):
@@ -191,17 +342,41 @@ def save_clfs(clfs, pred_clfs):
 
 
 @lock
-def run_all():
+def run_all(job, workers=1, seed=0, incremental=False, threshold=None):
     pred = Predictor.objects.latest()
     latest = DataPoint.objects.latest()
 
     if latest.created < pred.created:
         print "No Update"
+        job.message = "No Update"
         return
 
     print "Loading Data"
-    FEATURE, HOMO, LUMO, GAP = DataPoint.get_all_data()
-    in_clfs, in_pred_clfs = pred.get_predictors()
-    clfs = get_first_layer(FEATURE, HOMO, LUMO, GAP, in_clfs)
-    pred_clfs = get_second_layer(FEATURE, HOMO, LUMO, GAP, clfs, in_pred_clfs)
-    save_clfs(clfs, pred_clfs)
+    search = True
+    with job.run_stage("load"):
+        if incremental:
+            if threshold is None:
+                threshold = getattr(settings, "ML_INCREMENTAL_THRESHOLD", 0.05)
+            path = getattr(settings, "ML_FEATURE_CACHE", None)
+            FEATURE, HOMO, LUMO, GAP = DataPoint.get_all_data(cache_path=path)
+            new = DataPoint.objects.filter(created__gte=pred.created,
+                                           band_gap__isnull=False,
+                                           exact_name__isnull=False).count()
+            search = new > threshold * FEATURE.shape[0]
+            message = "%d new datapoints, search: %s" % (new, search)
+            logger.info(message)
+            job.message = message
+        else:
+            FEATURE, HOMO, LUMO, GAP = DataPoint.get_all_data()
+        in_clfs, in_pred_clfs = pred.get_predictors()
+
+    with job.run_stage("first_layer"):
+        clfs = get_first_layer(FEATURE, HOMO, LUMO, GAP, in_clfs,
+                               workers=workers, seed=seed, search=search,
+                               callback=job.set_progress)
+    with job.run_stage("second_layer"):
+        pred_clfs = get_second_layer(FEATURE, HOMO, LUMO, GAP, clfs,
+                                     in_pred_clfs, workers=workers, seed=seed,
+                                     search=search, callback=job.set_progress)
+    with job.run_stage("save"):
+        save_clfs(clfs, pred_clfs)
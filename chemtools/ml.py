@@ -2,9 +2,10 @@ from collections import namedtuple
 
 from numpy.linalg import norm
 import numpy
+import scipy.sparse
 
 from constants import CORE_COMBO, ARYL, XGROUPS, RGROUPS
-from structure import from_data
+from structure import from_data, get_fragment_version
 from data.models import Predictor
 
 
@@ -12,8 +13,42 @@ ARYL = [x for x in ARYL if len(x) == 1]
 XGROUPS = XGROUPS[:-1]
 RGROUPS = RGROUPS[:-1]
 
+# Cached by get_aryl_ratios
+_ARYL_RATIOS = {}
+
+
+# Lookup tables from the end tokens to their columns in the features
+FIRST = ARYL + XGROUPS
+SECOND = ['*'] + RGROUPS
+BOTH = FIRST + 2 * SECOND
+FIRST_COLUMNS = dict((x, i) for i, x in enumerate(FIRST))
+SECOND_COLUMNS = dict((x, i) for i, x in enumerate(SECOND))
+DECAY_COLUMNS = dict((x, BOTH.index(x)) for x in BOTH)
+# The second r-group of an aryl group uses the second copy of the r-groups
+DECAY_COLUMNS2 = dict((x, len(FIRST) + len(SECOND) + i)
+                      for i, x in enumerate(SECOND))
+
+CORE_LENGTH = 1 + sum(len(x) for x in CORE_COMBO)
+BINARY_END_LENGTH = len(FIRST) + 2 * len(SECOND)
+DECAY_END_LENGTH = len(BOTH)
+EXTRA_LENGTH = 5
+
+_CORE_FEATURES = {}
+
+
+def _get_column(columns, char):
+    try:
+        return columns[char]
+    except KeyError:
+        raise ValueError("Invalid feature token: %s" % char)
+
 
 def get_core_features(core):
+    try:
+        return list(_CORE_FEATURES[core])
+    except KeyError:
+        pass
+
     if core[0] == "T":
         corefeatures = [1]
     else:
@@ -22,6 +57,7 @@ def get_core_features(core):
         temp = [0] * len(base)
         temp[base.index(char)] = 1
         corefeatures.extend(temp)
+    _CORE_FEATURES[core] = tuple(corefeatures)
     return corefeatures
 
 
@@ -29,93 +65,126 @@ def get_extra_features(n, m, x, y, z):
     return [int(group[1:]) for group in [n, m, x, y, z]]
 
 
+def get_end_binary_columns(end, limit=4):
+    '''Returns the columns that are set in the binary features of an end,
+    and the number of features for the end.'''
+    end = end.replace('-', '')  # no support for flipping yet
+    columns = []
+    offset = 0
+    count = 0
+    for char in end:
+        if char in FIRST_COLUMNS:
+            if count == limit:
+                break
+            count += 1
+            columns.append(offset + FIRST_COLUMNS[char])
+            offset += len(FIRST)
+        else:
+            columns.append(offset + _get_column(SECOND_COLUMNS, char))
+            offset += len(SECOND)
+    return columns, offset + BINARY_END_LENGTH * (limit - count)
+
+
+def get_end_decay_columns(end):
+    '''Returns the column of each of the tokens in the decay features of an
+    end.'''
+    end = end.replace('-', '')  # no support for flipping yet
+    columns = []
+    for i, char in enumerate(end):
+        if i % 3 == 2 and char in DECAY_COLUMNS2:
+            columns.append(DECAY_COLUMNS2[char])
+        else:
+            columns.append(_get_column(DECAY_COLUMNS, char))
+    return columns
+
+
 def get_end_binary(left, center, right, limit=4):
-    first = ARYL + XGROUPS
-    second = ['*'] + RGROUPS
-    length = len(first) + 2 * len(second)
     endfeatures = []
     for end in [left, center, right]:
-        partfeatures = []
-        end = end.replace('-', '')  # no support for flipping yet
-        count = 0
-        for char in end:
-            base = second
-            if char in first:
-                if count == limit:
-                    break
-                count += 1
-                base = first
-            temp = [0] * len(base)
-            temp[base.index(char)] = 1
-            partfeatures.extend(temp)
-        partfeatures += [0] * length * (limit - count)
+        columns, length = get_end_binary_columns(end, limit=limit)
+        partfeatures = [0] * length
+        for column in columns:
+            partfeatures[column] = 1
         endfeatures.extend(partfeatures)
     return endfeatures
 
 
 def get_end_decay(left, center, right, power=1, H=1, lacunarity=1):
-    first = ARYL + XGROUPS
-    second = ['*'] + RGROUPS
-    both = first + 2 * second
-    length = len(both)
     endfeatures = []
     for end in [left, center, right]:
-        end = end.replace('-', '')  # no support for flipping yet
-
-        partfeatures = [0] * length
-        for i, char in enumerate(end):
-            count = i / 3
-            part = i % 3
-            idx = both.index(char)
-            if char in second and part == 2:
-                idx = both.index(char, idx + 1)
-            partfeatures[
-                idx] += decay_function(count + 1, power=power, H=H, lacunarity=lacunarity)
+        partfeatures = [0] * DECAY_END_LENGTH
+        for i, column in enumerate(get_end_decay_columns(end)):
+            partfeatures[column] += decay_function(
+                i / 3 + 1, power=power, H=H, lacunarity=lacunarity)
         endfeatures.extend(partfeatures)
     return endfeatures
 
 
+def get_aryl_ratios():
+    '''Returns the matrix of the ratios between the end to end lengths of
+    the aryl groups ([i, j] is length j / length i) and the index of the
+    shortest one. This is only recomputed when the fragments change.'''
+    version = get_fragment_version()
+    if _ARYL_RATIOS.get("version") != version:
+        lengths = []
+        for name in ARYL:
+            struct = from_data(name)
+            atoms = [x.atoms[1] for x in struct.open_ends("~")]
+            lengths.append(norm(atoms[0].xyz - atoms[1].xyz))
+        lengths = numpy.array(lengths)
+        _ARYL_RATIOS.update(
+            version=version,
+            ratio_matrix=lengths[None, :] / lengths[:, None],
+            minlen=lengths.argmin(),
+        )
+    return _ARYL_RATIOS["ratio_matrix"], _ARYL_RATIOS["minlen"]
+
+
 def get_end_decay_corrected(left, center, right, power=1, H=1, lacunarity=1):
-    lengths = []
-    for name in ARYL:
-        struct = from_data(name)
-        atoms = [x.atoms[1] for x in struct.open_ends("~")]
-        lengths.append(norm(atoms[0].xyz - atoms[1].xyz))
-    lengths = numpy.matrix(lengths)
-    minlen = lengths.argmin()
-    ratio_matrix = lengths / lengths.T
-
-    first = ARYL + XGROUPS
-    second = ['*'] + RGROUPS
-    both = first + 2 * second
-    length = len(both)
+    ratio_matrix, minlen = get_aryl_ratios()
+
     endfeatures = []
     for end in [left, center, right]:
+        idxs = get_end_decay_columns(end)
         end = end.replace('-', '')  # no support for flipping yet
 
-        partfeatures = [0] * length
+        partfeatures = numpy.zeros(DECAY_END_LENGTH)
+        if not end:
+            endfeatures.extend(partfeatures.tolist())
+            continue
+
         arylparts = []
-        for i, char in enumerate(end):
-            if char in ARYL:
-                arylparts.append(ARYL.index(char))
-            part = i % 3
-            idx = both.index(char)
-            if char in second and part == 2:
-                idx = both.index(char, idx + 1)  # go to the second rgroup
+        rows = []
+        counts = []
+        for char in end:
             if char in ARYL:
-                distance = ratio_matrix[arylparts[-1], arylparts].sum()
-            elif char in XGROUPS + second:
-                if arylparts:
-                    distance = ratio_matrix[minlen, arylparts].sum()
-                else:
-                    distance = 1
-
-            partfeatures[
-                idx] += decay_function(distance, power=power, H=H, lacunarity=lacunarity)
-        endfeatures.extend(partfeatures)
+                arylparts.append(FIRST_COLUMNS[char])
+                rows.append(arylparts[-1])
+            else:
+                rows.append(minlen)
+            counts.append(len(arylparts))
+
+        # Each char uses the sum of the ratios to all the aryl groups up to
+        # it, so mask out the ones that come after it.
+        counts = numpy.array(counts)
+        mask = numpy.arange(len(arylparts)) < counts[:, None]
+        ratios = ratio_matrix[numpy.array(rows)][:, numpy.array(arylparts,
+                                                                dtype=int)]
+        distances = (ratios * mask).sum(axis=1)
+        distances[counts == 0] = 1
+
+        numpy.add.at(partfeatures, idxs, decay_function(
+            distances, power=power, H=H, lacunarity=lacunarity))
+        endfeatures.extend(partfeatures.tolist())
     return endfeatures
 
 
+# Positions of n and m in the feature vectors, from the end of the vector
+# (the extra features come just before the trailing 1)
+N_FEATURE = -6
+M_FEATURE = -5
+
+
 def get_binary_feature_vector(exactname, limit=4):
     left, core, center, right, n, m, x, y, z = exactname.split('_')
     endfeatures = get_end_binary(left, center, right, limit=limit)
@@ -146,29 +215,130 @@ def decay_function(distance, power=1, H=1, lacunarity=1):
     return (lacunarity * (distance ** -H)) ** power
 
 
-def get_properties_from_decay_with_predictions(feature):
-    pred = Predictor.objects.latest()
-    clfs, pred_clfs = pred.get_predictors()
+def _add_core_extra_features(i, core, extras, width, entries):
+    corefeatures = get_core_features(core)
+    if len(corefeatures) != CORE_LENGTH:
+        raise ValueError("Invalid core: %s" % core)
+    extrafeatures = get_extra_features(*extras) + [1]
+    start = width - len(extrafeatures)
+    for columns, values in [(xrange(CORE_LENGTH), corefeatures),
+                            (xrange(start, width), extrafeatures)]:
+        for column, value in zip(columns, values):
+            if value:
+                entries.append((i, column, value))
+
+
+def _build_feature_matrix(entries, shape, sparse=False):
+    if entries:
+        rows, columns, values = zip(*entries)
+    else:
+        rows, columns, values = (), (), ()
+    if sparse:
+        matrix = scipy.sparse.coo_matrix((values, (rows, columns)),
+                                         shape=shape)
+        return matrix.tocsr()
+    matrix = numpy.zeros(shape)
+    numpy.add.at(matrix, (numpy.array(rows, dtype=int),
+                          numpy.array(columns, dtype=int)), values)
+    return matrix
+
+
+def get_binary_feature_matrix(exactnames, limit=4, sparse=False):
+    '''Returns the binary feature vectors of the exact names as the rows of
+    an array, or a scipy.sparse CSR matrix if sparse is True.'''
+    end_length = BINARY_END_LENGTH * limit
+    width = CORE_LENGTH + 3 * end_length + EXTRA_LENGTH + 1
+    entries = []
+    for i, exactname in enumerate(exactnames):
+        left, core, center, right, n, m, x, y, z = exactname.split('_')
+        _add_core_extra_features(i, core, (n, m, x, y, z), width, entries)
+        offset = CORE_LENGTH
+        for end in [left, center, right]:
+            columns, length = get_end_binary_columns(end, limit=limit)
+            if length != end_length:
+                raise ValueError("Invalid end: %s" % end)
+            entries.extend((i, offset + column, 1) for column in columns)
+            offset += length
+    return _build_feature_matrix(entries, (len(exactnames), width),
+                                 sparse=sparse)
+
+
+def get_decay_feature_matrix(exactnames, power=1, H=1, lacunarity=1,
+                             sparse=False):
+    '''Returns the decay feature vectors of the exact names as the rows of
+    an array, or a scipy.sparse CSR matrix if sparse is True.'''
+    width = CORE_LENGTH + 3 * DECAY_END_LENGTH + EXTRA_LENGTH + 1
+    decays = {}
+    entries = []
+    for i, exactname in enumerate(exactnames):
+        left, core, center, right, n, m, x, y, z = exactname.split('_')
+        _add_core_extra_features(i, core, (n, m, x, y, z), width, entries)
+        offset = CORE_LENGTH
+        for end in [left, center, right]:
+            for j, column in enumerate(get_end_decay_columns(end)):
+                count = j / 3 + 1
+                if count not in decays:
+                    decays[count] = decay_function(
+                        count, power=power, H=H, lacunarity=lacunarity)
+                entries.append((i, offset + column, decays[count]))
+            offset += DECAY_END_LENGTH
+    return _build_feature_matrix(entries, (len(exactnames), width),
+                                 sparse=sparse)
+
+
+Property = namedtuple("Property", ("title", "short", "units", "value", "error"))
+
+# (title, short, units, error) of each of the predicted properties
+PROPERTIES = (
+    ("HOMO", "homo", "eV", 0.09),
+    ("LUMO", "lumo", "eV", 0.08),
+    ("Band Gap", "gap", "eV", 0.10),
+)
+PROPERTY_DTYPE = numpy.dtype([(x[1], float) for x in PROPERTIES])
+
+
+def predict_properties(features, predictor=None):
+    '''Returns a structured array with the predicted homo, lumo, and gap for
+    each row of features.
+
+    Each of the six classifiers is only run once for the whole array. If
+    predictor is not given, the latest one is used.'''
+    if features is None:
+        raise ValueError("No features to predict.")
+    features = numpy.asarray(features, dtype=float)
+    if features.ndim == 1:
+        features = features.reshape(1, -1)
+    if features.ndim != 2:
+        raise ValueError("The features must be a vector or a 2-D array.")
+    results = numpy.zeros(features.shape[0], dtype=PROPERTY_DTYPE)
+    if not features.shape[0]:
+        return results
+
+    if predictor is None:
+        predictor = Predictor.get_latest()
+    clfs, pred_clfs = predictor.get_predictors()
     (HOMO_CLF, LUMO_CLF, GAP_CLF) = clfs
     (PRED_HOMO_CLF, PRED_LUMO_CLF, PRED_GAP_CLF) = pred_clfs
 
-    homo = HOMO_CLF.predict(feature)[0]
-    lumo = LUMO_CLF.predict(feature)[0]
-    gap = GAP_CLF.predict(feature)[0]
+    homo = HOMO_CLF.predict(features)
+    lumo = LUMO_CLF.predict(features)
+    gap = GAP_CLF.predict(features)
+
+    feature_gap = numpy.column_stack([features, homo, lumo])
+    feature_homo = numpy.column_stack([features, lumo, gap])
+    feature_lumo = numpy.column_stack([features, gap, homo])
 
-    feature_gap = numpy.concatenate([feature, [homo, lumo]])
-    feature_homo = numpy.concatenate([feature, [lumo, gap]])
-    feature_lumo = numpy.concatenate([feature, [gap, homo]])
+    results["gap"] = PRED_GAP_CLF.predict(feature_gap)
+    results["homo"] = PRED_HOMO_CLF.predict(feature_homo)
+    results["lumo"] = PRED_LUMO_CLF.predict(feature_lumo)
+    return results
 
-    gap = PRED_GAP_CLF.predict(feature_gap)
-    homo = PRED_HOMO_CLF.predict(feature_homo)
-    lumo = PRED_LUMO_CLF.predict(feature_lumo)
 
-    Property = namedtuple("Property", ("title", "short", "units", "value", "error"))
+def get_properties_from_prediction(prediction):
+    return [Property(title, short, units, prediction[short], error)
+            for title, short, units, error in PROPERTIES]
 
-    return [
-        Property("HOMO", "homo", "eV", homo[0], 0.09),
-        Property("LUMO", "lumo", "eV", lumo[0], 0.08),
-        Property("Band Gap", "gap", "eV", gap[0], 0.10),
-    ]
 
+def get_properties_from_decay_with_predictions(feature):
+    prediction = predict_properties(feature)[0]
+    return get_properties_from_prediction(prediction)
@@ -6,96 +6,176 @@ import random
 from constants import SCORES, DCORES, CORES, RGROUPS, XGROUPS, ARYL, ARYL0, \
     ARYL2, NEEDSPACE, TURNING, VALID_SIDE_TOKENS, BENZO_MULTI, BENZO_ONE, \
     BENZO_TWO, CHAIN, UNKNOWN
+from utils import LRUCache, memoize
 
 
-def name_expansion(string, rand=None):
-    braceparse = re.compile(r"""(\{[^\{\}]*\})""")
-    varparse = re.compile(r"\$\w*")
-
-    variables = {
-        "SCORES":   ','.join(SCORES),
-        "DCORES":   ','.join(DCORES),
-        "CORES":    ','.join(CORES),
-        "RGROUPS":  ','.join(RGROUPS),
-        "XGROUPS":  ','.join(XGROUPS),
-        "ARYL":     ','.join(ARYL),
-        "ARYL0":    ','.join(ARYL0),
-        "ARYL2":    ','.join(ARYL2),
-    }
-
-    def get_var(name):
-        newname = name.group(0).lstrip("$")
+# Shared by the name parsing functions. These get called many times with the
+# same names for a single request.
+NAME_CACHE = LRUCache(maxsize=4096)
+
+
+BRACE_PARSE = re.compile(r"""(\{[^\{\}]*\})""")
+VAR_PARSE = re.compile(r"\$\w*")
+TOKEN_PARSE = re.compile(r"(1?\d|\(-?\d+\)|-|[%s])" %
+                         ''.join(XGROUPS + RGROUPS))
+
+EXPANSION_VARIABLES = {
+    "SCORES":   ','.join(SCORES),
+    "DCORES":   ','.join(DCORES),
+    "CORES":    ','.join(CORES),
+    "RGROUPS":  ','.join(RGROUPS),
+    "XGROUPS":  ','.join(XGROUPS),
+    "ARYL":     ','.join(ARYL),
+    "ARYL0":    ','.join(ARYL0),
+    "ARYL2":    ','.join(ARYL2),
+}
+
+EXPANSION_OPERATIONS = {
+    "": lambda x: x,
+    "L": lambda x: x.lower(),
+    "U": lambda x: x.upper()
+}
+
+
+def _get_var(name):
+    newname = name.group(0).lstrip("$")
+    try:
+        x = EXPANSION_VARIABLES[newname]
+    except:
         try:
-            x = variables[newname]
+            int(newname)  # internal variable
+            x = '$' + newname
         except:
-            try:
-                int(newname)  # internal variable
-                x = '$' + newname
-            except:
-                x = ''
-        return x
-
-    def split_molecules(string):
-        count = 0
-        parts = ['']
-        for i, char in enumerate(string):
-            if char == "," and not count:
-                parts.append('')
-            else:
-                if char == "{":
-                    count += 1
-                elif char == "}":
-                    count -= 1
-                parts[-1] += char
-        assert not count
-        return parts
-
-    def expand(items):
-        swapped = [re.sub(varparse, get_var, x) for x in items]
-        withbrace = swapped[1::2]  # every other one has {}
-        withoutbrace = swapped[::2]
-
-        # remove {} from x and split
-        cleaned = [x[1:-1].split(',') for x in withbrace]
-        operations = {
-            "": lambda x: x,
-            "L": lambda x: x.lower(),
-            "U": lambda x: x.upper()
-        }
-
-        out = []
-        for group in itertools.product(*cleaned):
-            currentvalues = []
-            for i, item in enumerate(group):
-                if '$' in item:
-                    split = item.strip('$').split('.')
-                    num = int(split[0])
-                    if len(split) > 1:
-                        op = operations[split[1].upper()]
-                    else:
-                        op = operations['']
-                    x = op(currentvalues[num])
-                else:
-                    x = group[i]
-                currentvalues.append(x)
-            out.append(currentvalues)
+            x = ''
+    return x
+
+
+def _split_molecules(string):
+    count = 0
+    parts = ['']
+    for i, char in enumerate(string):
+        if char == "," and not count:
+            parts.append('')
+        else:
+            if char == "{":
+                count += 1
+            elif char == "}":
+                count -= 1
+            parts[-1] += char
+    assert not count
+    return parts
 
-        return [''.join(sum(zip(withoutbrace, y), ()) + (swapped[-1], ))
-                for y in out]
 
-    braces = []
-    for part in split_molecules(string):
+def _parse_expansion(string):
+    '''Splits the string into its molecules. Each one is returned as the
+    text between the braces and the list of options for each brace.'''
+    parsed = []
+    for part in _split_molecules(string):
         if set('{}').intersection(part):
-            split = re.split(braceparse, part)
-            braces.extend(expand(split))
+            split = re.split(BRACE_PARSE, part)
+            swapped = [re.sub(VAR_PARSE, _get_var, x) for x in split]
+            withoutbrace = swapped[::2]
+            # remove {} from x and split
+            cleaned = [x[1:-1].split(',') for x in swapped[1::2]]
+            parsed.append((withoutbrace, cleaned))
         else:
-            braces.append(part)
-    temp = collections.OrderedDict(zip(braces, itertools.repeat(True)))
+            parsed.append(([part], []))
+    return parsed
+
+
+def _join_group(withoutbrace, group):
+    currentvalues = []
+    for item in group:
+        if '$' in item:
+            split = item.strip('$').split('.')
+            num = int(split[0])
+            if len(split) > 1:
+                op = EXPANSION_OPERATIONS[split[1].upper()]
+            else:
+                op = EXPANSION_OPERATIONS['']
+            item = op(currentvalues[num])
+        currentvalues.append(item)
+    return ''.join(sum(zip(withoutbrace, currentvalues), ()) +
+                   (withoutbrace[-1], ))
+
+
+def _get_size(cleaned):
+    size = 1
+    for options in cleaned:
+        size *= len(options)
+    return size
+
+
+def _get_combination(cleaned, index):
+    '''Returns the index-th element of itertools.product(*cleaned) without
+    generating any of the ones before it.'''
+    group = []
+    for options in reversed(cleaned):
+        index, i = divmod(index, len(options))
+        group.append(options[i])
+    return group[::-1]
+
+
+def iter_name_expansion(string):
+    '''Yields the unique names from the expansion of string, in the same
+    order as name_expansion, without building the whole list first.'''
+    seen = set()
+    for withoutbrace, cleaned in _parse_expansion(string):
+        for group in itertools.product(*cleaned):
+            name = _join_group(withoutbrace, group)
+            if name not in seen:
+                seen.add(name)
+                yield name
+
+
+def count_name_expansion(string):
+    '''Returns the number of names in the expansion of string.
+
+    This is computed from the sizes of the braces, so it does not account for
+    duplicate names and is an upper bound on len(name_expansion(string)).'''
+    return sum(_get_size(cleaned) for _, cleaned in _parse_expansion(string))
+
+
+def sample_name_expansion(string, k):
+    '''Returns k random unique names from the expansion of string.
+
+    The names are picked by index and mapped directly to their combination,
+    so only the sampled names are ever built.'''
+    parsed = _parse_expansion(string)
+    sizes = [_get_size(cleaned) for _, cleaned in parsed]
+    total = sum(sizes)
+    # When a large part of the names is wanted, it is faster to build them all
+    if total <= 2 * k:
+        names = list(iter_name_expansion(string))
+        if k < len(names):
+            return random.sample(names, k)
+        return names
+
+    names = collections.OrderedDict()
+    tried = set()
+    while len(names) < k and len(tried) < total:
+        index = random.randrange(total)
+        if index in tried:
+            continue
+        tried.add(index)
+        for (withoutbrace, cleaned), size in zip(parsed, sizes):
+            if index < size:
+                group = _get_combination(cleaned, index)
+                names[_join_group(withoutbrace, group)] = True
+                break
+            index -= size
+    return names.keys()
+
+
+def get_name_cache_info():
+    '''Returns the hits, misses and size of the name parsing cache.'''
+    return NAME_CACHE.info()
 
-    if rand is not None and rand < len(temp.keys()):
-        return random.sample(temp.keys(), rand)
-    else:
-        return temp.keys()
+
+def name_expansion(string, rand=None):
+    if rand is not None:
+        return sample_name_expansion(string, rand)
+    return list(iter_name_expansion(string))
 
 
 def parse_options(parts):
@@ -132,9 +212,7 @@ def parse_cores(parts):
 
 
 def tokenize(string):
-    rxgroups = ''.join(XGROUPS + RGROUPS)
-    match = '(1?\d|\(-?\d+\)|-|[%s])' % rxgroups
-    tokens = [x for x in re.split(match, string) if x and x != '_']
+    tokens = [x for x in TOKEN_PARSE.split(string) if x and x != '_']
 
     invalid_idxs = [x for i, x in enumerate(
         tokens) if x not in VALID_SIDE_TOKENS and not x.startswith("(")]
@@ -262,6 +340,7 @@ def get_sides(parts, core_idx):
     return (left, middle, right)
 
 
+@memoize(NAME_CACHE)
 def parse_name(name):
     '''Parses a molecule name and returns the edge part names.
 
@@ -331,6 +410,7 @@ def parse_name(name):
     return output, nm, xyz
 
 
+@memoize(NAME_CACHE)
 def get_structure_type(name):
     try:
         output, nm, xyz = parse_name(name)
@@ -350,6 +430,7 @@ def get_structure_type(name):
     return structure_type
 
 
+@memoize(NAME_CACHE)
 def get_exact_name(name, spacers=False):
     output, nm, xyz = parse_name(name)
     sidefuncs = (
@@ -418,6 +499,7 @@ def autoflip_end_name(name):
     return ''.join(new_tokens)
 
 
+@memoize(NAME_CACHE)
 def autoflip_name(name):
     parts = name.split("_")
 
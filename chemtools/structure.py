@@ -1,5 +1,6 @@
 import os
 import math
+import hashlib
 import copy
 import string
 from itertools import product
@@ -8,7 +9,8 @@ import logging
 import numpy
 import cairo
 
-from constants import COLORS2, CONNECTIONS, DATAPATH, ARYL, XGROUPS, MASSES
+from constants import COLORS2, CONNECTIONS, DATAPATH, ARYL, XGROUPS, MASSES, \
+    CORES, RGROUPS
 from mol_name import parse_name
 from utils import get_full_rotation_matrix, get_angles, replace_geom_vars, \
     convert_zmatrix_to_cart, calculate_bonds, \
@@ -19,10 +21,23 @@ import fileparser
 
 logger = logging.getLogger(__name__)
 
+# Parsed fragment templates keyed by the name given to from_data (the name
+# includes the XX/YY substitution for cores). Each value is a tuple of
+# (coords, elements, bonds) arrays.
+_FRAGMENTS = {}
+_FRAGMENTS_MTIME = None
+# Incremented every time the fragment cache is cleared
+_FRAGMENTS_VERSION = 0
+# The (mtime, digest) of the data directory for get_data_version
+_DATA_VERSION = (None, None)
+
+# Marks the start (and format version) of Structure.to_binary output
+BINARY_MAGIC = "CTS1"
+
 
 def from_xyz(file):
-    atoms = []
-    bonds = []
+    atoms = AtomList()
+    bonds = IndexedList()
     state = 0
     for line in file:
         if line == "\n":
@@ -43,8 +58,137 @@ def from_xyz(file):
     return Structure(atoms, bonds)
 
 
+def from_arrays(coords, elements, bonds, bond_orders=None, frozen=None):
+    '''Builds a structure from an (N, 3) coordinate array, a list of N
+    elements, and a list of (atom index, atom index, bond type) tuples.
+
+    See Structure.get_state for bond_orders and frozen.'''
+    atoms = AtomList.from_arrays(coords, elements)
+    bonds = IndexedList(Bond((atoms[i], atoms[j]), t) for i, j, t in bonds)
+    for i, order in bond_orders or []:
+        atoms[i].bonds = [bonds[x] for x in order]
+    structure = Structure(atoms, bonds)
+    structure.frozen = [(atoms[a], atoms[b]) for a, b in frozen or []]
+    return structure
+
+
+def from_binary(data):
+    '''Loads a structure from the output of Structure.to_binary.'''
+    if not data.startswith(BINARY_MAGIC):
+        raise ValueError("Not a binary structure")
+    start = len(BINARY_MAGIC)
+
+    def read(dtype, count):
+        values = numpy.frombuffer(data, dtype=dtype, count=count,
+                                  offset=read.offset)
+        read.offset += values.nbytes
+        return values
+    read.offset = start
+
+    natoms, nbonds, norders, nfrozen = read("<i4", 4)
+    coords = read("<f8", 3 * natoms).reshape(natoms, 3)
+    pairs = read("<i4", 2 * nbonds).reshape(nbonds, 2).tolist()
+    orders = read("<i4", norders).tolist()
+    frozen = read("<i4", 2 * nfrozen).reshape(nfrozen, 2).tolist()
+    elements, types = data[read.offset:].split('\n')
+
+    elements = elements.split(' ') if natoms else []
+    types = types.split(' ') if nbonds else []
+    bonds = [(i, j, t) for (i, j), t in zip(pairs, types)]
+
+    bond_orders = []
+    i = 0
+    while i < len(orders):
+        idx, count = orders[i:i + 2]
+        bond_orders.append((idx, orders[i + 2:i + 2 + count]))
+        i += 2 + count
+    return from_arrays(coords, elements, bonds, bond_orders, frozen)
+
+
+def _get_data_mtime():
+    try:
+        return os.stat(DATAPATH).st_mtime
+    except OSError:
+        return None
+
+
+def clear_fragment_cache():
+    '''Drops all of the cached fragment templates. This should be called
+    whenever the fragments in the data directory change.'''
+    global _FRAGMENTS_MTIME, _FRAGMENTS_VERSION
+    _FRAGMENTS.clear()
+    _FRAGMENTS_MTIME = _get_data_mtime()
+    _FRAGMENTS_VERSION += 1
+
+
+def get_fragment_version():
+    '''Returns a number that changes whenever the fragments change. This can
+    be used to invalidate values computed from the fragments.'''
+    if _get_data_mtime() != _FRAGMENTS_MTIME:
+        clear_fragment_cache()
+    return _FRAGMENTS_VERSION
+
+
+def get_data_version():
+    '''Returns a hash of the fragment files in the data directory.
+
+    Unlike get_fragment_version, this is the same in every process and on
+    every host with the same fragments, so it can be used in persistent cache
+    keys. It is only recomputed when the data directory has been modified.'''
+    global _DATA_VERSION
+    mtime = _get_data_mtime()
+    if _DATA_VERSION[0] != mtime or _DATA_VERSION[1] is None:
+        digest = hashlib.sha1()
+        try:
+            names = sorted(os.listdir(DATAPATH))
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                with open(os.path.join(DATAPATH, name), "rb") as f:
+                    data = f.read()
+            except IOError:
+                continue
+            digest.update("%s|%d|" % (name, len(data)))
+            digest.update(data)
+        _DATA_VERSION = (mtime, digest.hexdigest())
+    return _DATA_VERSION[1]
+
+
+def warm_fragment_cache(names=None):
+    '''Loads all of the fragments so later calls to from_data do not have to
+    touch the disk.'''
+    if names is None:
+        names = CORES + XGROUPS + RGROUPS + ARYL
+    for name in names:
+        try:
+            from_data(name)
+        except Exception as e:
+            logger.warn("Could not load fragment: %s - %s" % (name, e))
+
+
 def from_data(filename):
-    '''Reads basic data files.'''
+    '''Reads basic data files.
+
+    The parsed fragments are cached, so this only reads the file the first
+    time a fragment is used. The cache is dropped if the data directory has
+    been modified since it was filled.'''
+    if _get_data_mtime() != _FRAGMENTS_MTIME:
+        clear_fragment_cache()
+    try:
+        coords, elements, bonds = _FRAGMENTS[filename]
+    except KeyError:
+        structure = _read_data(filename)
+        atoms = structure.atoms
+        coords = atoms.coords.copy()
+        elements = atoms.elements.copy()
+        bonds = [(atoms.index(x.atoms[0]), atoms.index(x.atoms[1]), x.type)
+                 for x in structure.bonds]
+        _FRAGMENTS[filename] = (coords, elements, bonds)
+    return from_arrays(coords, elements, bonds)
+
+
+def _read_data(filename):
     atomtypes = {'C': '4', 'N': '3', 'O': '2', 'P': '3', 'S': '2'}
     if len(filename) == 3:
         convert = {"XX": filename[1], "YY": filename[2]}
@@ -153,7 +297,7 @@ def from_gjf(file):
 
 
 def from_log(file):
-    out = fileparser.Log(file)
+    out = fileparser.Log(file, tail=True)
     return from_gjf(StringIO(out.format_gjf()))
 
 
@@ -290,20 +434,242 @@ def from_name(name):
     return structure
 
 
+class IndexedList(list):
+    '''A list that records the position of each item on the item itself.
+
+    This makes index lookups (and so the ids of atoms and bonds) O(1) instead
+    of a scan over the whole list. The positions are kept in step when items
+    are added or removed.
+    '''
+
+    def __init__(self, items=None):
+        super(IndexedList, self).__init__()
+        if items is not None:
+            self.extend(items)
+
+    def _bind(self, item, idx):
+        item.parent = self
+        item._idx = idx
+
+    def index(self, item, *args):
+        idx = getattr(item, "_idx", None)
+        if idx is not None and not args and \
+                getattr(item, "parent", None) is self:
+            try:
+                if list.__getitem__(self, idx) is item:
+                    return idx
+            except IndexError:
+                pass
+        return list.index(self, item, *args)
+
+    def append(self, item):
+        self._bind(item, len(self))
+        list.append(self, item)
+
+    def extend(self, items):
+        items = list(items)
+        for i, item in enumerate(items, len(self)):
+            self._bind(item, i)
+        list.extend(self, items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def pop(self, idx=-1):
+        n = len(self)
+        if idx < 0:
+            idx += n
+        item = list.pop(self, idx)
+        for i in xrange(idx, n - 1):
+            other = list.__getitem__(self, i)
+            if other.parent is self:
+                other._idx = i
+        return item
+
+    def __delitem__(self, idx):
+        self.pop(idx)
+
+    def remove(self, item):
+        self.pop(self.index(item))
+
+    def __deepcopy__(self, memo):
+        new = type(self)()
+        memo[id(self)] = new
+        list.extend(new, [copy.deepcopy(x, memo) for x in self])
+        return new
+
+
+class AtomList(IndexedList):
+    '''A list of atoms that keeps all of their coordinates in one contiguous
+    (N, 3) array and their elements in a parallel array.
+
+    Atoms that are added to the list become views into these arrays, so
+    operations over the whole structure can be done as single array
+    operations instead of looping over the atoms.
+    '''
+
+    def __init__(self, atoms=None):
+        super(AtomList, self).__init__()
+        self._coords = numpy.zeros((0, 3))
+        self._elements = numpy.zeros(0, dtype=object)
+        if atoms is not None:
+            self.extend(atoms)
+
+    @property
+    def coords(self):
+        return self._coords[:len(self)]
+
+    @property
+    def elements(self):
+        return self._elements[:len(self)]
+
+    def _reserve(self, size):
+        if size <= self._coords.shape[0]:
+            return
+        size = max(size, 2 * self._coords.shape[0], 8)
+        n = len(self)
+        coords = numpy.zeros((size, 3))
+        coords[:n] = self._coords[:n]
+        elements = numpy.zeros(size, dtype=object)
+        elements[:n] = self._elements[:n]
+        self._coords = coords
+        self._elements = elements
+
+    def _bind(self, atom, idx):
+        atom._bind(self, idx)
+
+    def append(self, atom):
+        n = len(self)
+        self._reserve(n + 1)
+        self._coords[n] = atom._row()
+        self._elements[n] = atom.element
+        atom._bind(self, n)
+        list.append(self, atom)
+
+    def extend(self, atoms):
+        if isinstance(atoms, AtomList) and \
+                all(atom._store is atoms for atom in atoms):
+            coords = atoms.coords
+            elements = atoms.elements
+        else:
+            atoms = list(atoms)
+            coords = [atom._row() for atom in atoms]
+            elements = [atom.element for atom in atoms]
+
+        n = len(self)
+        m = len(atoms)
+        if not m:
+            return
+        self._reserve(n + m)
+        self._coords[n:n + m] = coords
+        self._elements[n:n + m] = elements
+        for i, atom in enumerate(atoms, n):
+            atom._bind(self, i)
+        list.extend(self, atoms)
+
+    def pop(self, idx=-1):
+        n = len(self)
+        if idx < 0:
+            idx += n
+        atom = self[idx]
+        if atom._store is self:
+            atom._detach()
+        super(AtomList, self).pop(idx)
+
+        self._coords[idx:n - 1] = self._coords[idx + 1:n].copy()
+        self._elements[idx:n - 1] = self._elements[idx + 1:n].copy()
+        return atom
+
+    @classmethod
+    def from_arrays(cls, coords, elements):
+        '''Builds a list of atoms from copies of the given arrays.'''
+        atoms = cls()
+        atoms._coords = numpy.array(coords, dtype=float).reshape(-1, 3)
+        atoms._elements = numpy.array(elements, dtype=object)
+        for i in xrange(atoms._coords.shape[0]):
+            list.append(atoms, Atom._view(atoms, i))
+        return atoms
+
+    def __deepcopy__(self, memo):
+        new = AtomList()
+        memo[id(self)] = new
+        new._coords = self._coords.copy()
+        new._elements = self._elements.copy()
+        for atom in self:
+            list.append(new, copy.deepcopy(atom, memo))
+        return new
+
+
 class Atom(object):
 
     def __init__(self, x, y, z, element, parent=None):
         self.parent = parent
-        self.element = element
-        self.xyz = numpy.matrix([x, y, z], dtype=float).T
+        self._store = None
+        self._idx = 0
+        self._coords = numpy.array([[x, y, z]], dtype=float)
+        self._element = element
         self.bonds = []
 
+    @classmethod
+    def _view(cls, store, idx):
+        '''Creates an atom that is a view of row idx of the store.'''
+        atom = cls.__new__(cls)
+        atom.bonds = []
+        atom._bind(store, idx)
+        return atom
+
+    def _bind(self, store, idx):
+        '''Turns this atom into a view of row idx of the store.'''
+        self.parent = store
+        self._store = store
+        self._idx = idx
+        self._coords = None
+        self._element = None
+
+    def _detach(self):
+        '''Moves the data for this atom out of its store.'''
+        self._coords = self._row().copy().reshape(1, 3)
+        self._element = self.element
+        self._store = None
+        self._idx = 0
+
+    def _row(self):
+        if self._store is None:
+            return self._coords[0]
+        return self._store._coords[self._idx]
+
+    @property
+    def xyz(self):
+        if self._store is None:
+            row = self._coords
+        else:
+            row = self._store._coords[self._idx:self._idx + 1]
+        return numpy.asmatrix(row).T
+
+    @xyz.setter
+    def xyz(self, value):
+        self._row()[:] = numpy.asarray(value).ravel()
+
+    @property
+    def element(self):
+        if self._store is None:
+            return self._element
+        return self._store._elements[self._idx]
+
+    @element.setter
+    def element(self, value):
+        if self._store is None:
+            self._element = value
+        else:
+            self._store._elements[self._idx] = value
+
     def remove(self):
         self.parent.remove(self)
 
     @property
     def xyz_tuple(self):
-        return tuple(self.xyz.T.tolist()[0])
+        return tuple(self._row().tolist())
 
     @property
     def id(self):
@@ -356,6 +722,7 @@ class Bond(object):
 
     def __init__(self, atoms, type_, parent=None):
         self.parent = parent
+        self._idx = None
 
         self._atoms = atoms
         self.type = type_
@@ -416,6 +783,10 @@ class Bond(object):
 class Structure(object):
 
     def __init__(self, atoms, bonds):
+        if not isinstance(atoms, AtomList):
+            atoms = AtomList(atoms)
+        if not isinstance(bonds, IndexedList):
+            bonds = IndexedList(bonds)
         self.atoms = atoms
         self.bonds = bonds
         self.frozen = []
@@ -424,15 +795,74 @@ class Structure(object):
     def concatenate(cls, structures):
         struct = Structure([], [])
         for frag in structures:
-            for atom in frag.atoms:
-                atom.parent = struct.atoms
-                struct.atoms.append(atom)
-            for bond in frag.bonds:
-                bond.parent = struct.bonds
-                struct.bonds.append(bond)
+            struct.atoms.extend(frag.atoms)
+            struct.bonds.extend(frag.bonds)
             struct.frozen.extend(frag.frozen)
         return struct
 
+    def get_bond_table(self):
+        '''Returns the bonds as a list of (atom index, atom index, type).'''
+        index = self.atoms.index
+        return [(index(x.atoms[0]), index(x.atoms[1]), x.type)
+                for x in self.bonds]
+
+    def clone(self):
+        '''Returns a copy of the structure.'''
+        return self.clone_many(1)[0]
+
+    def clone_many(self, k):
+        '''Returns a list of k copies of the structure.
+
+        This copies the coordinate array and the bond table and then rebuilds
+        the atom and bond objects by index, instead of walking the whole
+        object graph like copy.deepcopy.'''
+        state = self.get_state()
+        return [from_arrays(*state) for i in xrange(k)]
+
+    def get_state(self):
+        '''Returns all of the data needed to rebuild the structure with
+        from_arrays.
+
+        This is (coords, elements, bonds, bond_orders, frozen) where bonds is
+        the bond table, bond_orders lists (atom index, [bond indices]) for any
+        atoms whose bonds are not in bond order, and frozen is a list of
+        (atom index, atom index) pairs.'''
+        index = self.atoms.index
+        frozen = [(index(a), index(b)) for a, b in self.frozen]
+
+        # from_arrays adds bonds to the atoms in bond order, so only atoms
+        # whose bonds were added in some other order need to be fixed up.
+        bond_index = self.bonds.index
+        bond_orders = []
+        for i, atom in enumerate(self.atoms):
+            order = [bond_index(x) for x in atom.bonds]
+            if order != sorted(order):
+                bond_orders.append((i, order))
+        return (self.atoms.coords, self.atoms.elements, self.get_bond_table(),
+                bond_orders, frozen)
+
+    def to_binary(self):
+        '''Returns a compact binary string of the structure that can be
+        loaded with from_binary.'''
+        coords, elements, bonds, bond_orders, frozen = self.get_state()
+        orders = []
+        for i, order in bond_orders:
+            orders.extend([i, len(order)] + order)
+
+        header = [len(coords), len(bonds), len(orders), len(frozen)]
+        parts = [
+            BINARY_MAGIC,
+            numpy.array(header, dtype="<i4").tostring(),
+            numpy.asarray(coords, dtype="<f8").tostring(),
+            numpy.array([x[:2] for x in bonds], dtype="<i4").tostring(),
+            numpy.array(orders, dtype="<i4").tostring(),
+            numpy.array(frozen, dtype="<i4").tostring(),
+            ' '.join(elements) + '\n' + ' '.join(x[2] for x in bonds),
+        ]
+        # The names can end up as unicode if the molecule name was unicode
+        parts[-1] = parts[-1].encode("utf-8")
+        return ''.join(parts)
+
     ###########################################################################
     # DISPLAY
     ###########################################################################
@@ -473,8 +903,8 @@ class Structure(object):
             if colors:
                 ctx.set_source_rgb(*COLORS2[bond.type])
 
-            coords1 = numpy.matrix(bond.atoms[0].xyz_tuple[:2]).T
-            coords2 = numpy.matrix(bond.atoms[1].xyz_tuple[:2]).T
+            coords1 = numpy.matrix(bond.atoms[0]._row()[:2]).T
+            coords2 = numpy.matrix(bond.atoms[1]._row()[:2]).T
 
             temp = (coords2 - coords1)
             mag = numpy.linalg.norm(temp)
@@ -494,11 +924,10 @@ class Structure(object):
             else:
                 draw_bond(ctx, coords1, coords2, unit, [0.0])
 
-        for atom in self.atoms:
-            if not hydrogens and atom.element == 'H':
+        for element, point in zip(self.atoms.elements, self.atoms.coords):
+            if not hydrogens and element == 'H':
                 continue
-            ctx.set_source_rgb(*COLORS2[atom.element])
-            point = atom.xyz_tuple
+            ctx.set_source_rgb(*COLORS2[element])
             ctx.arc(point[0], point[1], 0.25, 0, 2 * math.pi)
             ctx.fill()
 
@@ -557,14 +986,15 @@ class Structure(object):
     ###########################################################################
 
     def rotate_3d(self, rotation_matrix, point, offset):
-        for atom in self.atoms:
-            coords = atom.xyz - point
-            atom.xyz = rotation_matrix * coords + offset
+        coords = self.atoms.coords
+        point = numpy.asarray(point).ravel()
+        offset = numpy.asarray(offset).ravel()
+        rotation = numpy.asarray(rotation_matrix)
+        coords[:] = numpy.dot(coords - point, rotation.T) + offset
 
     def displace(self, displacement):
         '''Runs a uniform displacement on all the atoms in the structure.'''
-        for atom in self.atoms:
-            atom.xyz += displacement
+        self.atoms.coords[:] += numpy.asarray(displacement).ravel()
 
     def reflect_ends(self, angle=180):
         bonds = self.open_ends('~')
@@ -576,9 +1006,9 @@ class Structure(object):
 
     def bounding_box(self):
         '''Returns the bounding box of the structure.'''
-        coords = numpy.concatenate([x.xyz for x in self.atoms], 1)
-        mins = numpy.min(coords, 1)
-        maxs = numpy.max(coords, 1)
+        coords = self.atoms.coords
+        mins = numpy.matrix(coords.min(0)).T
+        maxs = numpy.matrix(coords.max(0)).T
         return mins, maxs
 
     def get_dimensions(self):
@@ -614,9 +1044,10 @@ class Structure(object):
 
     def close_ends(self):
         '''Converts any non-standard atoms into Hydrogens.'''
-        for atom in self.atoms:
-            if atom.element[0] in CONNECTIONS:
-                atom.element = "H"
+        elements = self.atoms.elements
+        for i, element in enumerate(elements):
+            if element[0] in CONNECTIONS:
+                elements[i] = "H"
 
     def merge(self, bond1, bond2, fragment, freeze=False):
         '''Merges two bonds. Bond1 is the bond being bonded to.'''
@@ -686,8 +1117,7 @@ class Structure(object):
 
         idxs = [self.bonds.index(x) for x in ends]
         structures = []
-        for i in xrange(n):
-            struct = copy.deepcopy(self)
+        for struct in self.clone_many(n):
             newends = [struct.bonds[x] for x in idxs]
             # newends twice to keep on single axis
             structures.append((struct, newends * 2))
@@ -702,38 +1132,37 @@ class Structure(object):
             # means there is nothing to stack
             if axis <= 1:
                 continue
-            axisfrags = copy.deepcopy(frags)
+            axisfrags = list(frags)
             for num in xrange(1, axis):
                 use = [0, 0, 0]
                 use[i] = num * (2 + size[i])
                 for f in axisfrags:
-                    a = copy.deepcopy(f)
+                    a = f.clone()
                     a.displace(numpy.matrix(use).T)
                     frags.append(a)
         return Structure.concatenate(frags)
 
     def perturb(self, delta=0.1):
-        for atom in self.atoms:
-            atom.xyz += numpy.matrix(numpy.random.uniform(-delta, delta, size=(3, 1)))
+        coords = self.atoms.coords
+        coords[:] += numpy.random.uniform(-delta, delta, size=coords.shape)
 
     ###########################################################################
     # Properties
     ###########################################################################
 
     def get_center(self):
-        totals = numpy.matrix([0.0, 0.0, 0.0]).T
-        for atom in self.atoms:
-            totals += atom.xyz
-        return totals / len(self.atoms)
+        return numpy.matrix(self.atoms.coords.mean(0)).T
+
+    def get_masses(self):
+        return numpy.array([MASSES[x] for x in self.atoms.elements])
 
     def get_mass(self):
-        return sum(MASSES[atom.element] for atom in self.atoms)
+        return sum(MASSES[x] for x in self.atoms.elements)
 
     def get_mass_center(self):
-        totals = numpy.matrix([0.0, 0.0, 0.0]).T
-        for atom in self.atoms:
-            totals += atom.xyz * MASSES[atom.element]
-        return totals / self.get_mass()
+        masses = self.get_masses()
+        totals = numpy.dot(masses, self.atoms.coords)
+        return numpy.matrix(totals).T / self.get_mass()
 
     def get_moment_of_inertia(self, direction=None, offset=None):
         if direction is None:
@@ -741,11 +1170,10 @@ class Structure(object):
         if offset is None:
             offset = self.get_mass_center()
 
+        direction = numpy.asarray(direction, dtype=float).ravel()
         direction = direction / numpy.linalg.norm(direction)
+        offset = numpy.asarray(offset, dtype=float).ravel()
 
-        total = 0
-        for atom in self.atoms:
-            dist = numpy.linalg.norm(
-                numpy.cross((atom.xyz - offset).T, direction.T))
-            total += MASSES[atom.element] * dist ** 2
-        return total
+        cross = numpy.cross(self.atoms.coords - offset, direction)
+        dists = (cross ** 2).sum(1)
+        return (self.get_masses() * dists).sum()
@@ -0,0 +1,89 @@
+import hashlib
+import logging
+
+from django.conf import settings
+
+import structure
+from utils import LRUCache
+from filecache import FileSystemCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class DjangoCache(object):
+    '''Uses one of the caches configured in the Django CACHES setting.'''
+
+    def __init__(self, alias='default', timeout=None):
+        from django.core.cache import get_cache
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        if self.timeout is None:
+            self.cache.set(key, value)
+        else:
+            self.cache.set(key, value, self.timeout)
+
+    def clear(self):
+        self.cache.clear()
+
+
+BACKENDS = {
+    "memory": LRUCache,
+    "filesystem": FileSystemCache,
+    "django": DjangoCache,
+}
+
+_backend = None
+
+
+def get_backend():
+    '''Returns the backend set by the STRUCTURE_CACHE setting. This defaults to
+    an in-memory LRU cache.'''
+    global _backend
+    if _backend is None:
+        config = dict(getattr(settings, "STRUCTURE_CACHE", {}))
+        name = config.pop("BACKEND", "memory")
+        _backend = BACKENDS[name](**config.get("OPTIONS", {}))
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def get_key(name):
+    '''Returns the content address of a built structure. This includes the
+    version of the fragments, so the structures are rebuilt after the
+    fragments change.'''
+    string = "structure|%s|%s" % (name, structure.get_data_version())
+    return hashlib.sha1(string.encode("utf-8")).hexdigest()
+
+
+def get_structure(name, perturb=0.0):
+    '''Returns the structure for the given name, only building it if it is
+    not already in the cache.
+
+    Only the unperturbed structure is cached. A perturbed structure is a
+    perturbed copy of it, so each one gets a new random geometry.'''
+    backend = get_backend()
+    key = get_key(name)
+    data = backend.get(key)
+    struct = None
+    if data is not None:
+        try:
+            struct = structure.from_binary(data)
+        except Exception as e:
+            logger.warn("Bad cached structure: %s - %s" % (name, e))
+
+    if struct is None:
+        struct = structure.from_name(name)
+        backend.set(key, struct.to_binary())
+    if perturb:
+        struct.perturb(delta=perturb)
+    return struct
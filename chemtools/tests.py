@@ -1,5 +1,8 @@
 import os
+import shutil
+import tempfile
 import hashlib
+import pickle
 from itertools import product
 import csv
 
@@ -7,6 +10,8 @@ from django.test import TestCase
 from django.conf import settings
 from django.core.management import call_command
 import numpy
+import scipy.sparse
+from sklearn import svm
 
 import gjfwriter
 import utils
@@ -15,9 +20,13 @@ import mol_name
 import ml
 import structure
 import fileparser
+import dataparser
 import graph
 import interface
 import random_gen
+import structure_cache
+from management.commands import update_ml
+from data.models import TrainingJob, Predictor
 from project.utils import StringIO
 
 # TON
@@ -446,6 +455,64 @@ class StructureTestCase(TestCase):
             }
         self.assertEqual(atom.json, data)
 
+    def test_atom_list_view(self):
+        struct = structure.from_name("TON")
+        atom = struct.atoms[3]
+        atom.xyz += numpy.matrix([1.0, 2.0, 3.0]).T
+        self.assertTrue(numpy.allclose(struct.atoms.coords[3],
+                                       atom.xyz.T))
+        atom.element = "S"
+        self.assertEqual(struct.atoms.elements[3], "S")
+
+    def test_atom_list_remove(self):
+        struct = structure.from_name("TON")
+        atom = struct.atoms[0]
+        xyz = atom.xyz.copy()
+        last = struct.atoms[-1].xyz.copy()
+        atom.remove()
+        self.assertEqual(len(struct.atoms.coords), len(struct.atoms))
+        self.assertTrue(numpy.allclose(atom.xyz, xyz))
+        self.assertTrue(numpy.allclose(struct.atoms[-1].xyz, last))
+
+    def test_ids_after_remove(self):
+        struct = structure.from_name("TON")
+        struct.atoms[2].remove()
+        struct.bonds[4].remove()
+        for i, atom in enumerate(struct.atoms):
+            self.assertEqual(atom.id, i + 1)
+        for i, bond in enumerate(struct.bonds):
+            self.assertEqual(bond.id, i + 1)
+
+    def test_clone(self):
+        struct = structure.from_name("4a_TON_35_2_m3")
+        clone = struct.clone()
+        self.assertEqual(struct.gjf, clone.gjf)
+        self.assertEqual(len(struct.frozen), len(clone.frozen))
+        clone.displace(numpy.matrix([1.0, 0.0, 0.0]).T)
+        clone.atoms[0].element = "S"
+        self.assertNotEqual(struct.gjf, clone.gjf)
+        self.assertNotEqual(struct.atoms[0].element, "S")
+
+    def test_clone_many(self):
+        struct = structure.from_name("TON")
+        clones = struct.clone_many(3)
+        self.assertEqual(len(clones), 3)
+        self.assertEqual(len(set(id(x.atoms) for x in clones)), 3)
+        for clone in clones:
+            self.assertEqual(struct.mol2, clone.mol2)
+
+    def test_large_stack(self):
+        struct = structure.from_name("24a_TON_n8_x2_y2")
+        self.assertEqual(len(struct.atoms), 904)
+
+    def test_displace(self):
+        struct = structure.from_name("TON")
+        mins, maxs = struct.bounding_box()
+        struct.displace(numpy.matrix([1.0, 0.0, -1.0]).T)
+        new_mins, new_maxs = struct.bounding_box()
+        self.assertTrue(numpy.allclose(new_mins - mins,
+                                       numpy.matrix([1.0, 0.0, -1.0]).T))
+
     def test_get_mass(self):
         struct = structure.from_name("TON")
         result = struct.get_mass()
@@ -504,6 +571,16 @@ class StructureTestCase(TestCase):
         with self.assertRaises(Exception):
             structure.from_data("filename")
 
+    def test_from_data_cache(self):
+        structure.clear_fragment_cache()
+        struct1 = structure.from_data("TON")
+        struct1.displace(numpy.matrix([1.0, 1.0, 1.0]).T)
+        struct1.atoms[0].element = "S"
+        struct2 = structure.from_data("TON")
+        self.assertIn("TON", structure._FRAGMENTS)
+        self.assertNotEqual(struct1.gjf, struct2.gjf)
+        self.assertEqual(struct2.gjf, structure._read_data("TON").gjf)
+
     def test_from_gjf(self):
         path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.gjf")
         s = structure.from_gjf(open(path, 'r'))
@@ -818,6 +895,39 @@ class NamedMoleculeTestCase(TestCase):
         self.assertTrue(numpy.allclose(obj.get_coulomb_matrix_feature(),
                                        COULOMB_MATRIX_FEATURE))
 
+    def test_get_coulomb_features(self):
+        mols = [gjfwriter.NamedMolecule(x) for x in ("TON", "24a_TON")]
+        sizes = [len(x.structure.atoms) for x in mols]
+
+        values = gjfwriter.get_coulomb_features(mols, kind="eigenvalues")
+        self.assertEqual(values.shape, (2, max(sizes)))
+        expected = numpy.linalg.eigvalsh(COULOMB_MATRIX)
+        expected = sorted(expected, key=lambda x: -abs(x))
+        self.assertTrue(numpy.allclose(values[0, :sizes[0]], expected))
+        self.assertTrue(numpy.allclose(values[0, sizes[0]:], 0))
+
+        values = gjfwriter.get_coulomb_features(mols, kind="sorted")
+        n = max(sizes)
+        self.assertEqual(values.shape, (2, n * (n + 1) / 2))
+        data = numpy.array(COULOMB_MATRIX)
+        order = numpy.argsort(-numpy.linalg.norm(data, axis=1),
+                              kind="mergesort")
+        data = data[order][:, order]
+        # The first rows of the lower triangle are the same when padded
+        rows, cols = numpy.tril_indices(sizes[0])
+        length = len(rows)
+        self.assertTrue(numpy.allclose(values[0, :length], data[rows, cols]))
+
+        # Chunks of one molecule give the same features
+        small = gjfwriter.get_coulomb_features(mols, kind="sorted",
+                                               max_bytes=1)
+        self.assertTrue(numpy.allclose(values, small))
+
+        with self.assertRaises(ValueError):
+            gjfwriter.get_coulomb_features(mols, size=sizes[0])
+        with self.assertRaises(ValueError):
+            gjfwriter.get_coulomb_features(mols, kind="bad")
+
     def test_get_exact_name(self):
         obj = gjfwriter.NamedMolecule("TON")
         value = obj.get_exact_name()
@@ -886,6 +996,61 @@ class NamedMoleculeTestCase(TestCase):
         results = obj.get_property_limits()
         self.assertEqual(expected, results)
 
+    def test_get_property_limits_no_predictor(self):
+        def get_latest():
+            raise Predictor.DoesNotExist("There are no predictors.")
+
+        original = Predictor.__dict__["get_latest"]
+        Predictor.get_latest = staticmethod(get_latest)
+        try:
+            obj = gjfwriter.NamedMolecule("24c_TON")
+            results = obj.get_property_limits()
+        finally:
+            Predictor.get_latest = original
+        self.assertEqual(results, {"n": [None] * 3, "m": [None] * 3})
+
+    def test_get_property_limits_batch(self):
+        predictor = FakePredictor(len(DECAY_FEATURE_VECTOR))
+        gjfwriter.LIMITS_CACHE.clear()
+        for name in ("24b_TON", "24b_TON_n2", "A_TON_A_A"):
+            expected = {}
+            for direction in ("n", "m"):
+                try:
+                    groups = []
+                    for j in gjfwriter.LIMIT_XVALS:
+                        temp = gjfwriter.get_variant_name(name, direction, j)
+                        exact_name = mol_name.get_exact_name(temp, True)
+                        feature = ml.get_decay_feature_vector(exact_name)
+                        values = ml.predict_properties(feature,
+                                                       predictor=predictor)
+                        groups.append(list(values[0]))
+                    lim = dataparser.predict_values(gjfwriter.LIMIT_XVALS,
+                                                    *zip(*groups))
+                    value = [lim[x][0] for x in ("homo", "lumo", "gap")]
+                except Exception:
+                    value = [None, None, None]
+                expected[direction] = value
+
+            results = gjfwriter.get_property_limits(name, predictor=predictor)
+            for direction in expected:
+                if expected[direction][0] is None:
+                    self.assertEqual(results[direction], [None] * 3)
+                else:
+                    self.assertTrue(numpy.allclose(results[direction],
+                                                   expected[direction]))
+
+            lstsq = gjfwriter.get_property_limits(name, method="lstsq",
+                                                  predictor=predictor)
+            for direction in expected:
+                if expected[direction][0] is not None:
+                    self.assertTrue(numpy.allclose(lstsq[direction],
+                                                   expected[direction],
+                                                   atol=1e-4))
+
+        hits = gjfwriter.LIMITS_CACHE.hits
+        gjfwriter.get_property_limits("24b_TON", predictor=predictor)
+        self.assertEqual(gjfwriter.LIMITS_CACHE.hits, hits + 1)
+
     def test_autoflip_name(self):
         names = (
             ("5555", "55-55-"),
@@ -1117,6 +1282,50 @@ class MolNameTestCase(TestCase):
         for name, result in names:
             self.assertEqual(set(mol_name.name_expansion(name)), set(result))
 
+    def test_iter_name_expansion(self):
+        string = "{a,b}{c,d},{a,a}c,e"
+        names = mol_name.iter_name_expansion(string)
+        self.assertEqual(next(names), "ac")
+        self.assertEqual(list(names), ["ad", "bc", "bd", "e"])
+
+    def test_count_name_expansion(self):
+        names = [
+            ("a", 1),
+            ("{a,b}{c,d},e", 5),
+            ("24{$RGROUPS}_{$CORES}",
+                len(constants.RGROUPS) * len(constants.CORES)),
+        ]
+        for name, result in names:
+            self.assertEqual(mol_name.count_name_expansion(name), result)
+
+    def test_sample_name_expansion(self):
+        string = "{$ARYL}{$RGROUPS}{$RGROUPS}_{$CORES}_{$ARYL}{$RGROUPS}"
+        names = mol_name.name_expansion(string, rand=20)
+        self.assertEqual(len(set(names)), 20)
+        prefix = "{$ARYL}{$RGROUPS}{$RGROUPS}_{$CORES}"
+        for name in names:
+            start, end = name.rsplit('_', 1)
+            self.assertIn(start, mol_name.name_expansion(prefix))
+            self.assertIn(end, mol_name.name_expansion("{$ARYL}{$RGROUPS}"))
+
+        small = mol_name.name_expansion("{a,b,a}", rand=5)
+        self.assertEqual(sorted(small), ["a", "b"])
+
+    def test_name_cache(self):
+        mol_name.NAME_CACHE.clear()
+        name = "24a_TON_35b_24c"
+        expected = mol_name.get_exact_name(name)
+        self.assertEqual(mol_name.get_exact_name(name), expected)
+        info = mol_name.get_name_cache_info()
+        # parse_name and get_exact_name miss once each
+        self.assertEqual(info["misses"], 2)
+        self.assertEqual(info["hits"], 1)
+
+        for i in xrange(2):
+            with self.assertRaises(ValueError):
+                mol_name.get_exact_name("ASADA")
+        self.assertEqual(mol_name.get_name_cache_info()["hits"], 2)
+
     def test_get_exact_name(self):
         for name, expected in self.pairs:
             a = mol_name.get_exact_name(name)
@@ -1159,6 +1368,107 @@ class ExtractorTestCase(TestCase):
         call_command("extract")
 
 
+class UpdateMLTestCase(TestCase):
+
+    def setUp(self):
+        state = numpy.random.RandomState(0)
+        self.X = numpy.matrix(state.rand(30, 4))
+        self.homo = numpy.matrix(state.rand(30, 1))
+        self.lumo = numpy.matrix(state.rand(30, 1))
+        self.gap = self.homo - self.lumo
+
+    def test_get_kfold_indices(self):
+        pairs = update_ml.get_kfold_indices(23, folds=10)
+        self.assertEqual(len(pairs), 10)
+        self.assertEqual([len(test) for train, test in pairs],
+                         [3, 3, 3, 2, 2, 2, 2, 2, 2, 2])
+        tests = numpy.concatenate([test for train, test in pairs])
+        self.assertEqual(tests.tolist(), range(23))
+        for train, test in pairs:
+            self.assertEqual(sorted(train.tolist() + test.tolist()), range(23))
+
+    def test_trainer_workers(self):
+        results = []
+        for workers in [1, 2]:
+            clfs = update_ml.get_first_layer(
+                self.X, self.homo, self.lumo, self.gap, workers=workers)
+            pred_clfs = update_ml.get_second_layer(
+                self.X, self.homo, self.lumo, self.gap, clfs, workers=workers)
+            results.append([(x.C, x.gamma, x.test_error)
+                            for x in clfs + pred_clfs])
+        self.assertEqual(results[0], results[1])
+
+    def test_fit_func_no_search(self):
+        data = {"homo": (self.X, self.homo)}
+        trainer = update_ml.Trainer(data, workers=1)
+        try:
+            previous = svm.SVR(C=3.0, gamma=0.2)
+            clf = update_ml.fit_func(trainer, "homo", clf=previous,
+                                     search=False)
+        finally:
+            trainer.close()
+        self.assertEqual((clf.C, clf.gamma), (3.0, 0.2))
+        self.assertEqual(len(clf.test_error), 2)
+        self.assertTrue(hasattr(clf, "support_"))
+
+    def test_lock(self):
+        @update_ml.lock
+        def func(job, value):
+            self.assertEqual(job.status, TrainingJob.RUNNING)
+            self.assertIsNone(TrainingJob.start())
+            return value
+
+        self.assertEqual(func(3), 3)
+        job = TrainingJob.objects.latest()
+        self.assertEqual(job.status, TrainingJob.DONE)
+
+        @update_ml.lock
+        def fail(job):
+            raise ValueError("bad")
+
+        with self.assertRaises(ValueError):
+            fail()
+        job = TrainingJob.objects.latest()
+        self.assertEqual(job.status, TrainingJob.FAILED)
+        self.assertEqual(job.message, "bad")
+
+    def test_map_models_callback(self):
+        trainer = update_ml.Trainer({}, workers=1)
+        values = []
+        results = trainer.map_models(lambda x: x * 2, [1, 2, 3, 4],
+                                     callback=values.append)
+        self.assertEqual(results, [2, 4, 6, 8])
+        self.assertEqual(values, [0.25, 0.5, 0.75, 1.0])
+
+    def test_trainer_kfold(self):
+        data = {"homo": (self.X, self.homo)}
+        trainer = update_ml.Trainer(data, workers=1)
+        try:
+            clf = svm.SVR()
+            (train, _), (cross, _) = trainer.kfold("homo", clf, folds=5)
+            fit = trainer.fit("homo", clf)
+        finally:
+            trainer.close()
+        self.assertLess(train, cross)
+        self.assertTrue(hasattr(fit, "support_"))
+        self.assertFalse(hasattr(clf, "support_"))
+
+
+class FakePredictor(object):
+    '''A Predictor with small classifiers fit to random data.'''
+    id = None
+
+    def __init__(self, size):
+        state = numpy.random.RandomState(0)
+        X = state.rand(20, size)
+        self.clfs = [svm.SVR().fit(X, state.rand(20)) for i in xrange(3)]
+        X = state.rand(20, size + 2)
+        self.pred_clfs = [svm.SVR().fit(X, state.rand(20)) for i in xrange(3)]
+
+    def get_predictors(self):
+        return self.clfs, self.pred_clfs
+
+
 class MLTestCase(TestCase):
 
     def test_get_core_features(self):
@@ -1199,9 +1509,176 @@ class MLTestCase(TestCase):
         self.assertEqual(ml.get_decay_distance_correction_feature_vector(name),
                          DECAY_DISTANCE_CORRECTION_FEATURE_VECTOR)
 
+    def test_get_aryl_ratios(self):
+        ratio_matrix, minlen = ml.get_aryl_ratios()
+        self.assertEqual(ratio_matrix.shape, (len(ml.ARYL), len(ml.ARYL)))
+        self.assertTrue(numpy.allclose(ratio_matrix.diagonal(), 1))
+        self.assertTrue((ratio_matrix[minlen] >= 1).all())
+        self.assertIs(ml.get_aryl_ratios()[0], ratio_matrix)
+
+        structure.clear_fragment_cache()
+        new_matrix, _ = ml.get_aryl_ratios()
+        self.assertIsNot(new_matrix, ratio_matrix)
+        self.assertTrue(numpy.allclose(new_matrix, ratio_matrix))
+
+    def test_get_feature_matrix(self):
+        names = ["24a_TON", "A_TON_A_A", "CON_24a", "4a_TON_n2",
+                 "5aa_TON_4bc_4", "4aa_TON_n2"]
+        exactnames = [mol_name.get_exact_name(x, True) for x in names]
+        pairs = [
+            (ml.get_binary_feature_matrix, ml.get_binary_feature_vector),
+            (ml.get_decay_feature_matrix, ml.get_decay_feature_vector),
+        ]
+        for matrix_func, vector_func in pairs:
+            matrix = matrix_func(exactnames)
+            expected = numpy.array([vector_func(x) for x in exactnames])
+            self.assertEqual(matrix.shape, expected.shape)
+            self.assertTrue((matrix == expected).all())
+
+            sparse = matrix_func(exactnames, sparse=True)
+            self.assertTrue(scipy.sparse.issparse(sparse))
+            self.assertTrue((sparse.toarray() == matrix).all())
+
+            self.assertEqual(matrix_func([]).shape, (0, matrix.shape[1]))
+
+    def test_get_feature_matrix_invalid(self):
+        for func in [ml.get_binary_feature_matrix,
+                     ml.get_decay_feature_matrix]:
+            with self.assertRaises(ValueError):
+                func(["4z_TON_A_A_n1_m1_x1_y1_z1"])
+
+    def test_predict_properties(self):
+        predictor = FakePredictor(len(DECAY_FEATURE_VECTOR))
+        names = ["24a_TON", "A_TON_A_A", "CON_24a", "4a_TON_n2"]
+        features = numpy.array([
+            ml.get_decay_feature_vector(mol_name.get_exact_name(x, True))
+            for x in names])
+        results = ml.predict_properties(features, predictor=predictor)
+        self.assertEqual(results.dtype.names, ("homo", "lumo", "gap"))
+        self.assertEqual(results.shape, (len(names), ))
+
+        homo_clf, lumo_clf, gap_clf = predictor.clfs
+        pred_homo_clf, pred_lumo_clf, pred_gap_clf = predictor.pred_clfs
+        for feature, result in zip(features, results):
+            feature = feature.reshape(1, -1)
+            homo = homo_clf.predict(feature)[0]
+            lumo = lumo_clf.predict(feature)[0]
+            gap = gap_clf.predict(feature)[0]
+            expected = [
+                clf.predict(numpy.hstack([feature, [pair]]))[0]
+                for clf, pair in [(pred_homo_clf, [lumo, gap]),
+                                  (pred_lumo_clf, [gap, homo]),
+                                  (pred_gap_clf, [homo, lumo])]
+            ]
+            self.assertTrue(numpy.allclose(tuple(result), expected))
+
+        single = ml.predict_properties(features[0], predictor=predictor)
+        self.assertEqual(single.shape, (1, ))
+        self.assertTrue(numpy.allclose(tuple(single[0]), tuple(results[0])))
+
+        empty = ml.predict_properties(numpy.zeros((0, features.shape[1])))
+        self.assertEqual(empty.shape, (0, ))
+
+        for bad in (None, 1.0, numpy.zeros((1, 1, 1))):
+            with self.assertRaises(ValueError):
+                ml.predict_properties(bad, predictor=predictor)
+
+    def test_get_property_predictions_invalid(self):
+        mol = gjfwriter.NamedMolecule("BAD_NAME")
+        self.assertIsNone(mol.get_decay_feature_vector())
+        self.assertEqual(mol.get_property_predictions(), {})
+
+    def test_predict_molecule_properties(self):
+        predictor = FakePredictor(len(DECAY_FEATURE_VECTOR))
+        mols = [gjfwriter.NamedMolecule(x) for x in ("24a_TON", "BAD")]
+        results = gjfwriter.predict_molecule_properties(mols,
+                                                        predictor=predictor)
+        self.assertFalse(numpy.isnan(tuple(results[0])).any())
+        self.assertTrue(numpy.isnan(tuple(results[1])).all())
+
+        properties = mols[0].get_property_predictions()
+        self.assertEqual([x.short for x in properties],
+                         ["homo", "lumo", "gap"])
+        self.assertEqual([x.value for x in properties], list(results[0]))
+
 
 class FileParserTestCase(TestCase):
 
+    def test_trigger_set(self):
+        trigger_set = fileparser.TriggerSet(
+            ["Charge =", "Charge = ", "occ. eigenvalues", "Alpha  occ",
+             "X="])
+        self.assertEqual(trigger_set.parse("nothing here"), ())
+        self.assertEqual(trigger_set.parse(" Charge =  0 Multiplicity = 1"),
+                         set(["Charge =", "Charge = "]))
+        self.assertEqual(
+            trigger_set.parse(" Alpha  occ. eigenvalues --  -0.27 X=1"),
+            set(["Alpha  occ", "occ. eigenvalues", "X="]))
+        self.assertEqual(fileparser.TriggerSet([]).parse("X="), ())
+
+    def test_log_reader(self):
+        triggers = fileparser.TriggerSet(["b"])
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("a1\r\na2\r\nb3\r\na4\nb5\na6")
+            f.flush()
+            with open(f.name, 'r') as f2:
+                reader = fileparser.LogReader(f2, triggers)
+                reader.can_skip = lambda: True
+                lines = list(reader)
+        self.assertEqual(lines, [("a2\n", "b3\r\n"), ("a4\n", "b5\n")])
+        self.assertTrue(reader.skipped_windows)
+
+    def test_log_reader_stream(self):
+        triggers = fileparser.TriggerSet(["b"])
+        reader = fileparser.LogReader(StringIO("a1\nb2\n"), triggers)
+        reader.can_skip = lambda: True
+        self.assertEqual(list(reader), [(None, "a1\n"), (None, "b2\n")])
+
+    def test_log_mmap_matches_stream(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        for name in ["A_TON_A_A.log", "transform.log", "methane_windows.log",
+                     "crazy.log"]:
+            path = os.path.join(base, name)
+            log = fileparser.Log(path)
+            with open(path, 'r') as f:
+                stream = fileparser.Log(StringIO(f.read()), fname=path)
+            self.assertEqual(log.parsers, stream.parsers)
+            self.assertEqual(log.parser_labels, stream.parser_labels)
+            self.assertEqual(log.windows_file, stream.windows_file)
+
+    def test_dispatcher(self):
+        calls = []
+
+        class Fake(object):
+            def __init__(self, name, triggers, lines=1):
+                self.name = name
+                self.TRIGGERS = triggers
+                self.done = False
+                self.lines = lines
+
+            def parse(self, line):
+                calls.append((self.name, line))
+                self.lines -= 1
+                self.done = not self.lines
+
+            def is_active(self):
+                return self.name == "multi"
+
+        parsers = {
+            "once": Fake("once", ("a", )),
+            "multi": Fake("multi", ("b", ), lines=2),
+            "every": Fake("every", None, lines=3),
+        }
+        dispatcher = fileparser.Dispatcher(parsers)
+        for line in ["x", "a", "a", "b", "y", "b"]:
+            dispatcher.dispatch(line, set(line))
+        self.assertEqual(sorted(calls), sorted([
+            ("every", "x"), ("every", "a"), ("every", "a"),
+            ("once", "a"),
+            ("multi", "b"), ("multi", "y"),
+        ]))
+        self.assertEqual(dispatcher.triggered, {})
+
     def test_parse_files(self):
         base = os.path.join(settings.MEDIA_ROOT, "tests")
         files = [
@@ -1250,6 +1727,113 @@ class FileParserTestCase(TestCase):
         logset.parse_files([])
         self.assertEqual("\n\n", logset.format_output(errors=False))
 
+    def test_iter_output(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        paths = [os.path.join(base, x) for x in
+                 ["A_TON_A_A.log", "A.log", "missing.log", "crazy.log"]]
+        logset = fileparser.LogSet()
+        logset.parse_files(paths)
+        expected = logset.format_output().split("\n")
+
+        for processes in (1, 2):
+            streamed = fileparser.LogSet(chunksize=1)
+            chunks = list(streamed.iter_output(iter(paths),
+                                               processes=processes))
+            self.assertEqual(len(chunks), 5)
+            lines = ''.join(chunks).split("\n")
+            self.assertEqual(lines[0], expected[0])
+            self.assertEqual(sorted(lines), sorted(expected))
+            self.assertEqual(len(streamed.errors), 1)
+            self.assertIn("IOError", streamed.errors[0])
+
+    def test_parse_cache(self):
+        parsed = []
+
+        class CountingLog(fileparser.Log):
+            def parse_all(self, f):
+                parsed.append(self.name)
+                return super(CountingLog, self).parse_all(f)
+
+        folder = tempfile.mkdtemp()
+        try:
+            cache = fileparser.ParseCache(os.path.join(folder, "cache"))
+            path = os.path.join(folder, "A_TON_A_A.log")
+            shutil.copy(os.path.join(settings.MEDIA_ROOT, "tests",
+                                     "A_TON_A_A.log"), path)
+            log = CountingLog(path, cache=cache)
+            cached = CountingLog(path, cache=cache)
+            self.assertEqual(parsed, ["A_TON_A_A"])
+            self.assertEqual(log.parsers, cached.parsers)
+            self.assertEqual(log.parser_labels, cached.parser_labels)
+            self.assertEqual(log.format_data(), cached.format_data())
+            self.assertEqual(log.format_gjf(), cached.format_gjf())
+            self.assertIsInstance(cached.parser_labels[0], str)
+
+            with open(path, 'r') as f:
+                data = f.read()
+            # Streams are found by their contents
+            CountingLog(StringIO(data), fname=path, cache=cache)
+            CountingLog(StringIO(data), fname=path, cache=cache)
+            self.assertEqual(len(parsed), 2)
+
+            with open(path, 'a') as f:
+                f.write(" Normal termination of Gaussian\n")
+            CountingLog(path, cache=cache)
+            self.assertEqual(len(parsed), 3)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_parse_cache_max_size(self):
+        folder = tempfile.mkdtemp()
+        try:
+            base = os.path.join(settings.MEDIA_ROOT, "tests")
+            cache = fileparser.ParseCache(folder, max_size=1)
+            cache = pickle.loads(pickle.dumps(cache))
+            for name in ["A.log", "A_TON_A_A.log"]:
+                fileparser.Log(os.path.join(base, name), cache=cache)
+            sizes = [os.path.getsize(os.path.join(root, x))
+                     for root, dirs, files in os.walk(folder) for x in files]
+            self.assertEqual(sizes, [])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_parse_cache_dumps(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A.log")
+        log = fileparser.Log(path)
+        log.parsers[0]["Header"] = ("%chk=\xe9\xff.chk", True)
+        value = fileparser.ParseCache.dumps(log)
+        labels, parsers, windows = fileparser.ParseCache.loads(value)
+        self.assertEqual(labels, log.parser_labels)
+        self.assertEqual(parsers, log.parsers)
+        self.assertEqual(windows, log.windows_file)
+
+    def test_parse_cache_logset(self):
+        folder = tempfile.mkdtemp()
+        try:
+            cache = fileparser.ParseCache(folder)
+            path = os.path.join(settings.MEDIA_ROOT, "tests", "A.log")
+            outputs = []
+            for i in xrange(2):
+                logset = fileparser.LogSet(cache=cache)
+                logset.parse_files([path])
+                outputs.append(logset.format_output())
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertEqual(len(os.listdir(folder)), 1)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_write_output(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        names = []
+        logset = fileparser.LogSet(callback=lambda log: names.append(log.name))
+        f = StringIO()
+        logset.write_output([path], f, errors=False, processes=1)
+        lines = f.getvalue().split("\n")
+        self.assertEqual(lines[0], fileparser.Log.format_header())
+        self.assertEqual(lines[1], fileparser.Log(path).format_data())
+        self.assertEqual(lines[2:], [''])
+        self.assertEqual(names, ["A_TON_A_A"])
+
     def test_format_header(self):
         path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
         log = fileparser.Log(path)
@@ -1392,6 +1976,60 @@ class FileParserTestCase(TestCase):
         ]
         self.assertEqual(expected, actual)
 
+    def test_parse_log_tail(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        for name in ["A_TON_A_A.log", "transform.log", "methane_windows.log",
+                     "A_CON_A_A_TDDFT.log", "crazy.log"]:
+            path = os.path.join(base, name)
+            log = fileparser.Log(path)
+            tail = fileparser.Log(path, tail=True)
+            self.assertTrue(tail.tail)
+            self.assertEqual(log.format_gjf(), tail.format_gjf())
+            self.assertEqual(log.format_out(), tail.format_out())
+            self.assertEqual(log["Energy"], tail["Energy"])
+
+    def test_read_final_step(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests", "A_TON_A_A.log")
+        with open(path, 'r') as f:
+            data = f.read()
+        f = StringIO(data)
+        offset, tail = fileparser.read_final_step(f, len(data))
+        self.assertEqual(data[offset:], tail)
+        self.assertIn("Input orientation:", tail.split('\n')[0])
+        self.assertEqual(tail.count(" orientation:"), 2)
+
+        small = fileparser.read_final_step(f, len(data), block_size=100)
+        self.assertEqual((offset, tail), small)
+        self.assertEqual((None, None), fileparser.read_final_step(
+            f, len(data), block_size=100, max_size=1000))
+
+    def test_parse_log_tail_fallback(self):
+        base = os.path.join(settings.MEDIA_ROOT, "tests")
+        # Link1 jobs (the second one only has a different %chk) and a log
+        # without an archive
+        for name in ["A.log", "A_TON_A_A_link1.log", "invalid.log"]:
+            path = os.path.join(base, name)
+            log = fileparser.Log(path, tail=True)
+            self.assertFalse(log.tail)
+            self.assertEqual(log.parsers, fileparser.Log(path).parsers)
+
+    def test_parse_log_tail_link1_header(self):
+        path = os.path.join(settings.MEDIA_ROOT, "tests",
+                            "A_TON_A_A_link1.log")
+        log = fileparser.Log(path)
+        tail = fileparser.Log(path, tail=True)
+        self.assertIn("%chk=A_TON_A_A_2.chk", log["Header"])
+        self.assertEqual(log["Header"], tail["Header"])
+        self.assertEqual(log.format_gjf(), tail.format_gjf())
+
+    def test_find_in_file(self):
+        f = StringIO("abc Initial command def Initial command")
+        self.assertEqual(fileparser.find_in_file(f, "Initial", 0, 39), 4)
+        self.assertEqual(fileparser.find_in_file(f, "Initial", 5, 39), 24)
+        self.assertEqual(fileparser.find_in_file(f, "Initial", 5, 39,
+                                                 block_size=3), 24)
+        self.assertEqual(fileparser.find_in_file(f, "Initial", 5, 30), -1)
+
     def test_parse_log_transform(self):
         name = "transform.log"
         path = os.path.join(settings.MEDIA_ROOT, "tests", name)
@@ -1450,6 +2088,85 @@ class FileParserTestCase(TestCase):
         self.assertEqual(test.format_output(errors=True), expected)
 
 
+class StructureCacheTestCase(TestCase):
+
+    def test_binary_round_trip(self):
+        for name in ["TON", "4(25)4_TON", "24a_TON_35b_24c_n2", u"TPN_4a"]:
+            struct = structure.from_name(name)
+            new = structure.from_binary(struct.to_binary())
+            self.assertEqual(struct.gjf, new.gjf)
+            self.assertEqual(struct.mol2, new.mol2)
+
+    def test_from_binary_invalid(self):
+        with self.assertRaises(ValueError):
+            structure.from_binary("not a structure")
+
+    def test_lru_cache(self):
+        cache = structure_cache.LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_filesystem_cache(self):
+        path = tempfile.mkdtemp()
+        try:
+            cache = structure_cache.FileSystemCache(path)
+            key = structure_cache.get_key("TON")
+            self.assertIsNone(cache.get(key))
+            cache.set(key, "\x00data")
+            self.assertEqual(cache.get(key), "\x00data")
+        finally:
+            shutil.rmtree(path)
+
+    def test_get_key(self):
+        key1 = structure_cache.get_key("TON")
+        self.assertEqual(key1, structure_cache.get_key("TON"))
+        self.assertNotEqual(key1, structure_cache.get_key("CON"))
+
+    def test_get_key_data_version(self):
+        key1 = structure_cache.get_key("TON")
+        old = structure._DATA_VERSION
+        structure._DATA_VERSION = (old[0], "other")
+        try:
+            key2 = structure_cache.get_key("TON")
+        finally:
+            structure._DATA_VERSION = old
+        self.assertNotEqual(key1, key2)
+
+    def test_get_structure(self):
+        old = structure_cache.get_backend()
+        backend = structure_cache.LRUCache()
+        structure_cache.set_backend(backend)
+        try:
+            struct1 = structure_cache.get_structure("24a_TON")
+            self.assertEqual(len(backend.data), 1)
+            struct2 = structure_cache.get_structure("24a_TON")
+            self.assertIsNot(struct1, struct2)
+            self.assertEqual(struct1.gjf, struct2.gjf)
+        finally:
+            structure_cache.set_backend(old)
+
+    def test_get_structure_perturb(self):
+        old = structure_cache.get_backend()
+        backend = structure_cache.LRUCache()
+        structure_cache.set_backend(backend)
+        try:
+            base = structure_cache.get_structure("24a_TON")
+            struct1 = structure_cache.get_structure("24a_TON", perturb=0.1)
+            struct2 = structure_cache.get_structure("24a_TON", perturb=0.1)
+            self.assertEqual(len(backend.data), 1)
+            self.assertNotEqual(struct1.gjf, struct2.gjf)
+            self.assertNotEqual(base.gjf, struct1.gjf)
+            again = structure_cache.get_structure("24a_TON")
+            self.assertEqual(base.gjf, again.gjf)
+        finally:
+            structure_cache.set_backend(old)
+
+
 class UtilsTestCase(TestCase):
 
     def test_replace_geom_vars(self):
@@ -1,4 +1,8 @@
 import math
+import collections
+import threading
+from functools import wraps
+
 import numpy
 
 from constants import BOND_LENGTHS
@@ -197,3 +201,73 @@ def find_repeating(string):
         if all(items[0] == x for x in items):
             break
     return string[:factor], len(string) / factor
+
+
+class LRUCache(object):
+    '''Keeps the most recently used values in memory.'''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+        }
+
+
+def memoize(cache):
+    '''Caches the results of a pure function in the given cache. Exceptions
+    are cached as well and raised again on later calls.
+
+    The cache can be shared between functions because the function name is
+    part of the key. The argument types are also part of it so str and
+    unicode names do not share results.'''
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = (f.__name__, args, tuple(type(x) for x in args),
+                   tuple(sorted(kwargs.items())))
+            result = cache.get(key)
+            if result is None:
+                try:
+                    result = (True, f(*args, **kwargs))
+                except Exception as e:
+                    result = (False, e)
+                cache.set(key, result)
+            success, value = result
+            if not success:
+                raise value
+            return value
+        return wrapper
+    return decorator
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from models import DataPoint, FeatureVector, Predictor
+from models import DataPoint, FeatureVector, Predictor, TrainingJob
 
 
 class DataPointAdmin(admin.ModelAdmin):
@@ -16,6 +16,11 @@ class PredictorAdmin(admin.ModelAdmin):
         "pickle", "homo_error", "lumo_error", "gap_error", "created")
 
 
+class TrainingJobAdmin(admin.ModelAdmin):
+    list_display = ("started", "ended", "status", "stage", "progress", "host")
+
+
 admin.site.register(DataPoint, DataPointAdmin)
 admin.site.register(FeatureVector, FeatureVectorAdmin)
 admin.site.register(Predictor, PredictorAdmin)
+admin.site.register(TrainingJob, TrainingJobAdmin)
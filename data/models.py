@@ -1,10 +1,19 @@
 import ast
 import cPickle
+import errno
+import json
 import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 
 import numpy
 
-from django.db import models
+from django.db import models, transaction
 from django.template import Template, Context
 from django.utils import timezone
 from django.conf import settings
@@ -43,35 +52,176 @@ class DataPoint(models.Model):
         return super(DataPoint, self).save(*args, **kwargs)
 
     @classmethod
-    def get_all_data(cls, type=1):
-        data = DataPoint.objects.filter(band_gap__isnull=False,
-                                        exact_name__isnull=False,
-                                        vectors__type=type)
-        M = len(data)
-        HOMO = numpy.zeros((M, 1))
-        LUMO = numpy.zeros((M, 1))
-        GAP = numpy.zeros((M, 1))
-        vectors = []
-        for i, x in enumerate(data):
-            HOMO[i] = x.homo
-            LUMO[i] = x.lumo
-            GAP[i] = x.band_gap
-            vectors.append(x.vectors.get(type=type).vector)
-        FEATURE = numpy.matrix(vectors)
-        return FEATURE, HOMO, LUMO, GAP
-
-
-class VectorField(models.TextField):
+    def get_all_data(cls, type=1, cache_path=None):
+        '''Returns the feature matrix and the HOMO, LUMO and GAP columns of
+        all the complete DataPoints.
+
+        If cache_path is given, the decoded vectors are kept in that file and
+        only the vectors that are not already in it are read from the
+        database.'''
+        if cache_path is None:
+            vector_field = "featurevector__vector"
+        else:
+            vector_field = "featurevector"
+        # Go through the m2m table so everything comes back in one query
+        Through = cls.vectors.through
+        rows = Through.objects.filter(
+            datapoint__band_gap__isnull=False,
+            datapoint__exact_name__isnull=False,
+            featurevector__type=type,
+        ).order_by("datapoint").values_list(
+            "datapoint__homo",
+            "datapoint__lumo",
+            "datapoint__band_gap",
+            vector_field,
+        )
+        rows = list(rows)
+
+        HOMO = numpy.array([x[0] for x in rows], dtype=float).reshape(-1, 1)
+        LUMO = numpy.array([x[1] for x in rows], dtype=float).reshape(-1, 1)
+        GAP = numpy.array([x[2] for x in rows], dtype=float).reshape(-1, 1)
+        values = [x[3] for x in rows]
+        if cache_path is None:
+            FEATURE = stack_vectors(values)
+        else:
+            FEATURE = get_cached_vectors(values, cache_path)
+        return numpy.asmatrix(FEATURE), HOMO, LUMO, GAP
+
+
+# magic, dtype char, number of values
+VECTOR_HEADER = struct.Struct("<4scI")
+VECTOR_MAGIC = "\x93VEC"
+
+
+def encode_vector(vector, dtype=numpy.float64):
+    '''Packs a vector into bytes with a small header giving its dtype and
+    length.'''
+    array = numpy.asarray(vector, dtype=numpy.dtype(dtype).newbyteorder("<"))
+    if array.ndim != 1:
+        raise ValueError("Only 1-D vectors can be stored.")
+    header = VECTOR_HEADER.pack(VECTOR_MAGIC, array.dtype.char, len(array))
+    return header + array.tostring()
+
+
+def decode_vector(value):
+    '''Returns the stored value as a numpy array. The bytes are used
+    directly, so the array is read only. Vectors that were stored as text are
+    also read.'''
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    else:
+        value = bytes(value)
+    if not value.startswith(VECTOR_MAGIC):
+        return numpy.array(ast.literal_eval(value), dtype=numpy.float64)
+
+    if len(value) < VECTOR_HEADER.size:
+        raise ValueError("The stored vector is truncated.")
+    magic, char, length = VECTOR_HEADER.unpack_from(value)
+    dtype = numpy.dtype(char).newbyteorder("<")
+    if len(value) != VECTOR_HEADER.size + length * dtype.itemsize:
+        raise ValueError("The stored vector has the wrong length.")
+    return numpy.frombuffer(value, dtype=dtype, count=length,
+                            offset=VECTOR_HEADER.size)
+
+
+def stack_vectors(values):
+    '''Decodes the stored vectors into the rows of one matrix.'''
+    FEATURE = None
+    for i, value in enumerate(values):
+        vector = decode_vector(value)
+        if FEATURE is None:
+            FEATURE = numpy.zeros((len(values), len(vector)))
+        if len(vector) != FEATURE.shape[1]:
+            raise ValueError("The feature vectors have different lengths.")
+        FEATURE[i] = vector
+    if FEATURE is None:
+        FEATURE = numpy.zeros((0, 0))
+    return FEATURE
+
+
+def get_cached_vectors(ids, path, chunksize=500):
+    '''Returns a matrix with the vectors of the FeatureVectors with the given
+    ids as its rows.
+
+    The vectors are cached in a .npz file at path. Only the ones that are
+    missing from it are read from the database, and then the file is
+    rewritten with just the vectors of ids.'''
+    if not ids:
+        return numpy.zeros((0, 0))
+    try:
+        with numpy.load(path) as data:
+            cached_ids = data["ids"].tolist()
+            cached = data["vectors"]
+    except (IOError, KeyError, ValueError):
+        cached_ids = []
+        cached = numpy.zeros((0, 0))
+    index = dict((x, i) for i, x in enumerate(cached_ids))
+
+    missing = sorted(set(x for x in ids if x not in index))
+    if not missing:
+        return cached[[index[x] for x in ids]]
+
+    values = {}
+    for i in xrange(0, len(missing), chunksize):
+        vectors = FeatureVector.objects.filter(id__in=missing[i:i + chunksize])
+        values.update(vectors.values_list("id", "vector"))
+    new = stack_vectors([values[x] for x in missing])
+    if len(cached_ids) and cached.shape[1] != new.shape[1]:
+        logger.info("The cached vectors have changed length, removing them.")
+        os.remove(path)
+        return get_cached_vectors(ids, path, chunksize=chunksize)
+
+    all_vectors = numpy.concatenate([cached.reshape(-1, new.shape[1]), new])
+    index.update((x, len(cached_ids) + i) for i, x in enumerate(missing))
+    keep = sorted(set(ids))
+    keep_vectors = all_vectors[[index[x] for x in keep]]
+
+    folder = os.path.dirname(path)
+    try:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        fd, temp = tempfile.mkstemp(dir=folder)
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez(f, ids=numpy.array(keep, dtype=int),
+                        vectors=keep_vectors)
+        os.rename(temp, path)
+    except (IOError, OSError) as e:
+        logger.warn("Could not write the vector cache: %s" % e)
+
+    keep_index = dict((x, i) for i, x in enumerate(keep))
+    return keep_vectors[[keep_index[x] for x in ids]]
+
+
+class BinaryVectorField(models.BinaryField):
+    '''Stores a vector as packed floats (float64 by default) instead of
+    text. The value is always given back as a numpy array.'''
     __metaclass__ = models.SubfieldBase
 
+    def __init__(self, *args, **kwargs):
+        self.dtype = numpy.dtype(kwargs.pop("dtype", numpy.float64))
+        super(BinaryVectorField, self).__init__(*args, **kwargs)
+
     def to_python(self, value):
-        if type(value) != list:
-            return ast.literal_eval(value)
-        else:
+        if value is None or isinstance(value, numpy.ndarray):
             return value
+        if isinstance(value, (list, tuple)):
+            return numpy.array(value, dtype=self.dtype)
+        return decode_vector(value)
 
     def get_prep_value(self, value):
-        return str(value)
+        if value is None:
+            return None
+        return encode_vector(value, dtype=self.dtype)
+
+    def value_to_string(self, obj):
+        # Serialized as a list so dumpdata output can be read back with
+        # to_python, the same as the old text vectors
+        value = self._get_val_from_obj(obj)
+        if value is None:
+            return None
+        return repr(numpy.asarray(value).tolist())
 
 
 class FeatureVector(models.Model):
@@ -87,7 +237,7 @@ class FeatureVector(models.Model):
     )
     type = models.IntegerField(choices=VECTOR_NAMES)
     exact_name = models.CharField(max_length=1000, null=True, blank=True)
-    vector = VectorField()
+    vector = BinaryVectorField()
     created = models.DateTimeField()
 
     def __unicode__(self):
@@ -120,6 +270,202 @@ class Predictor(models.Model):
             self.pred_clfs = pred_clfs
             return clfs, pred_clfs
 
+    @classmethod
+    def get_latest(cls):
+        '''Returns the latest Predictor with its classifiers already loaded.
+        This is shared by the whole process.'''
+        return predictor_registry.get()
+
+
+class PredictorRegistry(object):
+    '''Keeps the latest Predictor loaded for the whole process.
+
+    The database is checked for a newer Predictor at most once every interval
+    seconds, and only the id and created time are fetched. A new Predictor is
+    loaded completely before it replaces the old one, so other threads keep
+    using the old one until then.'''
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.predictor = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def get_interval(self):
+        if self.interval is not None:
+            return self.interval
+        return getattr(settings, "PREDICTOR_CHECK_INTERVAL", 10)
+
+    def get(self):
+        current = self.predictor
+        now = time.time()
+        if current is not None and now - self.checked < self.get_interval():
+            return current
+
+        latest = Predictor.objects.order_by("-created")
+        latest = list(latest.values_list("id", "created")[:1])
+        if not latest:
+            raise Predictor.DoesNotExist("There are no predictors.")
+
+        if current is None or (current.id, current.created) != latest[0]:
+            with self.lock:
+                if self.predictor is current:
+                    logger.info("Loading predictor %d" % latest[0][0])
+                    predictor = Predictor.objects.get(id=latest[0][0])
+                    predictor.get_predictors()
+                    self.predictor = predictor
+        self.checked = now
+        return self.predictor
+
+    def clear(self):
+        with self.lock:
+            self.predictor = None
+            self.checked = None
+
+
+predictor_registry = PredictorRegistry()
+
+
+class TrainingJob(models.Model):
+    '''A record of one run of update_ml. This is also used as the lock so
+    that only one of them runs at a time.'''
+    RUNNING = 0
+    DONE = 1
+    FAILED = 2
+    STATUS_NAMES = (
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+    # The range of the progress that each stage covers
+    STAGES = (
+        ("load", 0.0, 10.0),
+        ("first_layer", 10.0, 55.0),
+        ("second_layer", 55.0, 95.0),
+        ("save", 95.0, 100.0),
+    )
+
+    status = models.IntegerField(choices=STATUS_NAMES, default=RUNNING)
+    started = models.DateTimeField()
+    ended = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField()
+    stage = models.CharField(max_length=30, blank=True)
+    progress = models.FloatField(default=0.0)
+    durations = models.TextField(blank=True)
+    host = models.CharField(max_length=255)
+    pid = models.IntegerField()
+    message = models.TextField(blank=True)
+
+    class Meta:
+        get_latest_by = "started"
+
+    def __unicode__(self):
+        return u"%s %s" % (self.started, self.get_status_display())
+
+    def save(self, *args, **kwargs):
+        now = timezone.now()
+        if not self.id and not self.started:
+            self.started = now
+        self.updated = now
+        return super(TrainingJob, self).save(*args, **kwargs)
+
+    @classmethod
+    def start(cls):
+        '''Returns a new running job, or None if there is already one
+        running. Running jobs that are stale are marked as failed first.'''
+        with transaction.atomic():
+            # Lock the running rows so two starters can not both pass
+            running = cls.objects.select_for_update().filter(
+                status=cls.RUNNING)
+            for job in running:
+                if not job.is_stale():
+                    return None
+                logger.warn("Removing stale training job %d" % job.id)
+                job.finish(cls.FAILED, message="The job stopped responding.")
+            return cls.objects.create(host=socket.gethostname(),
+                                      pid=os.getpid())
+
+    def is_stale(self):
+        '''A running job on this host is stale if its process is gone, or if
+        it started more than ML_JOB_MAX_AGE seconds ago (so a reused pid can
+        not hold the lock forever). A running job on another host is stale if
+        it has not been updated within ML_JOB_TIMEOUT seconds.'''
+        if self.status != self.RUNNING:
+            return False
+        if self.host == socket.gethostname():
+            try:
+                os.kill(self.pid, 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    return True
+            max_age = getattr(settings, "ML_JOB_MAX_AGE", 7 * 24 * 60 * 60)
+            return (timezone.now() - self.started).total_seconds() > max_age
+        timeout = getattr(settings, "ML_JOB_TIMEOUT", 24 * 60 * 60)
+        return (timezone.now() - self.updated).total_seconds() > timeout
+
+    def get_durations(self):
+        if not self.durations:
+            return {}
+        return json.loads(self.durations)
+
+    def get_duration(self):
+        end = self.ended or timezone.now()
+        return (end - self.started).total_seconds()
+
+    @contextmanager
+    def run_stage(self, name):
+        '''Records the time spent in the stage and moves the progress to the
+        end of it.'''
+        stages = dict((x, (lo, hi)) for x, lo, hi in self.STAGES)
+        self.stage = name
+        self.progress = stages[name][0]
+        self.save()
+        start = time.time()
+        yield
+        durations = self.get_durations()
+        durations[name] = time.time() - start
+        self.durations = json.dumps(durations)
+        self.progress = stages[name][1]
+        self.save()
+
+    def set_progress(self, fraction):
+        '''Sets how far along the current stage is, from 0 to 1.'''
+        stages = dict((x, (lo, hi)) for x, lo, hi in self.STAGES)
+        lo, hi = stages[self.stage]
+        self.progress = lo + fraction * (hi - lo)
+        self.save()
+
+    def finish(self, status, message=None):
+        self.status = status
+        self.ended = timezone.now()
+        if message is not None:
+            self.message = message
+        if status == self.DONE:
+            self.progress = 100.0
+        self.save()
+
+    def to_dict(self, details=True):
+        '''Returns the job as a dict. Without details, the host, pid and
+        message are left out.'''
+        value = {
+            "id": self.id,
+            "status": self.get_status_display(),
+            "stage": self.stage,
+            "progress": self.progress,
+            "started": self.started.isoformat(),
+            "ended": self.ended.isoformat() if self.ended else None,
+            "duration": self.get_duration(),
+            "durations": self.get_durations(),
+            "host": self.host,
+            "pid": self.pid,
+            "message": self.message,
+            "stale": self.is_stale(),
+        }
+        if not details:
+            for key in ("host", "pid", "message"):
+                del value[key]
+        return value
+
 
 class JobTemplate(models.Model):
     name = models.CharField(max_length=60)
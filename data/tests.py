@@ -1,11 +1,15 @@
 from itertools import product
 import os
+import json
+import shutil
+import tempfile
 
 import numpy
 from django.conf import settings
 from django.test import Client, TestCase
 from django.core.urlresolvers import reverse
 from django.core.management import call_command
+from django.core import serializers
 from django.contrib.auth import get_user_model
 from django.core.files import File
 from django.core.management.base import CommandError
@@ -236,6 +240,109 @@ class ModelTestCase(TestCase):
         self.assertTrue((LUMO == numpy.matrix([[2.0]])).all())
         self.assertTrue((GAP == numpy.matrix([[2.0]])).all())
 
+    def test_get_all_data_one_query(self):
+        with self.assertNumQueries(1):
+            models.DataPoint.get_all_data()
+
+    def test_get_all_data_cache(self):
+        expected = models.DataPoint.get_all_data()
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "features.npz")
+        try:
+            with self.assertNumQueries(2):
+                results = models.DataPoint.get_all_data(cache_path=path)
+            for x, y in zip(expected, results):
+                self.assertTrue((x == y).all())
+            self.assertTrue(os.path.exists(path))
+
+            with self.assertNumQueries(1):
+                results = models.DataPoint.get_all_data(cache_path=path)
+            for x, y in zip(expected, results):
+                self.assertTrue((x == y).all())
+
+            # Only the new vector is read
+            vector = models.FeatureVector(type=1, vector=[4, 5, 6])
+            vector.save()
+            point = models.DataPoint.objects.get(name="Garbage")
+            point.vectors.add(vector)
+            ids = list(models.FeatureVector.objects.filter(
+                type=1).values_list("id", flat=True).order_by("id"))
+            with self.assertNumQueries(1):
+                FEATURE = models.get_cached_vectors(ids, path)
+            self.assertEqual(FEATURE.tolist(), [[1, 2, 3], [4, 5, 6]])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_feature_vector_binary(self):
+        vector = models.FeatureVector.objects.get(type=1)
+        self.assertIsInstance(vector.vector, numpy.ndarray)
+        self.assertEqual(vector.vector.tolist(), [1.0, 2.0, 3.0])
+
+        raw = models.FeatureVector.objects.filter(type=1).values_list(
+            "vector", flat=True)[0]
+        self.assertEqual(len(raw), models.VECTOR_HEADER.size + 3 * 8)
+
+    def test_feature_vector_serialize(self):
+        vectors = models.FeatureVector.objects.all()
+        data = serializers.serialize("json", vectors)
+        self.assertIn("[1.0, 2.0, 3.0]", data)
+        objs = list(serializers.deserialize("json", data))
+        self.assertEqual(len(objs), len(vectors))
+        for obj, vector in zip(objs, vectors):
+            self.assertIsInstance(obj.object.vector, numpy.ndarray)
+            self.assertEqual(obj.object.vector.tolist(),
+                             vector.vector.tolist())
+            obj.save()
+        vector = models.FeatureVector.objects.get(type=1)
+        self.assertEqual(vector.vector.tolist(), [1.0, 2.0, 3.0])
+
+    def test_encode_vector(self):
+        vector = [0.1, 2.5, -3.0]
+        data = models.encode_vector(vector)
+        self.assertEqual(models.decode_vector(data).tolist(), vector)
+
+        data = models.encode_vector(vector, dtype=numpy.float32)
+        self.assertEqual(len(data), models.VECTOR_HEADER.size + 3 * 4)
+        result = models.decode_vector(data)
+        self.assertEqual(result.dtype, numpy.float32)
+        self.assertTrue(numpy.allclose(result, vector))
+
+        self.assertEqual(models.decode_vector("[1, 2]").tolist(), [1.0, 2.0])
+        with self.assertRaises(ValueError):
+            models.decode_vector(data[:-1])
+        with self.assertRaises(ValueError):
+            models.encode_vector([[1, 2]])
+
+    def test_predictor_registry(self):
+        registry = models.PredictorRegistry(interval=0)
+        first = registry.get()
+        self.assertEqual(first.id, 1)
+        self.assertTrue(hasattr(first, "clfs"))
+        self.assertIs(registry.get(), first)
+
+        second = models.Predictor(pickle="predictors/decay_predictors.pkl",
+                                  homo_error=0.1, lumo_error=0.1, gap_error=0.1)
+        second.save()
+        latest = registry.get()
+        self.assertEqual(latest.id, second.id)
+        self.assertTrue(hasattr(latest, "clfs"))
+
+    def test_predictor_registry_interval(self):
+        registry = models.PredictorRegistry(interval=60)
+        first = registry.get()
+        models.Predictor(pickle="predictors/decay_predictors.pkl",
+                         homo_error=0.1, lumo_error=0.1, gap_error=0.1).save()
+        self.assertIs(registry.get(), first)
+
+        registry.checked -= 60
+        self.assertIsNot(registry.get(), first)
+
+    def test_predictor_registry_empty(self):
+        models.Predictor.objects.all().delete()
+        registry = models.PredictorRegistry(interval=0)
+        with self.assertRaises(models.Predictor.DoesNotExist):
+            registry.get()
+
     def test_jobtemplate(self):
         data = OPTIONS.copy()
         data["custom_template"] = True
@@ -267,6 +374,114 @@ class ModelTestCase(TestCase):
         self.assertIn(data["name"], string)
 
 
+class TrainingJobTestCase(TestCase):
+
+    def test_start(self):
+        job = models.TrainingJob.start()
+        self.assertEqual(job.status, models.TrainingJob.RUNNING)
+        self.assertEqual(job.pid, os.getpid())
+        self.assertFalse(job.is_stale())
+        self.assertIsNone(models.TrainingJob.start())
+
+        job.finish(models.TrainingJob.DONE)
+        self.assertEqual(job.progress, 100.0)
+        self.assertIsNotNone(job.ended)
+        self.assertIsNotNone(models.TrainingJob.start())
+
+    def test_start_stale(self):
+        job = models.TrainingJob.start()
+        # A pid that can not be running
+        job.pid = 2 ** 22 + 1
+        job.save()
+        self.assertTrue(job.is_stale())
+
+        new = models.TrainingJob.start()
+        self.assertIsNotNone(new)
+        job = models.TrainingJob.objects.get(id=job.id)
+        self.assertEqual(job.status, models.TrainingJob.FAILED)
+
+    def test_start_stale_timeout(self):
+        job = models.TrainingJob.start()
+        job.host = "some.other.host"
+        job.save()
+        self.assertFalse(job.is_stale())
+        with self.settings(ML_JOB_TIMEOUT=-1):
+            self.assertTrue(job.is_stale())
+
+    def test_start_same_host_no_timeout(self):
+        job = models.TrainingJob.start()
+        with self.settings(ML_JOB_TIMEOUT=-1):
+            self.assertFalse(job.is_stale())
+            self.assertIsNone(models.TrainingJob.start())
+
+    def test_start_same_host_max_age(self):
+        job = models.TrainingJob.start()
+        with self.settings(ML_JOB_MAX_AGE=-1):
+            # The pid is alive, but the job is too old to still be running
+            self.assertTrue(job.is_stale())
+            self.assertIsNotNone(models.TrainingJob.start())
+
+    def test_run_stage(self):
+        job = models.TrainingJob.start()
+        with job.run_stage("load"):
+            self.assertEqual(job.stage, "load")
+            self.assertEqual(job.progress, 0.0)
+        self.assertEqual(job.progress, 10.0)
+        with job.run_stage("first_layer"):
+            job.set_progress(0.5)
+            self.assertEqual(job.progress, 32.5)
+        job = models.TrainingJob.objects.get(id=job.id)
+        self.assertEqual(sorted(job.get_durations()), ["first_layer", "load"])
+        self.assertEqual(job.progress, 55.0)
+
+    def test_ml_status(self):
+        response = self.client.get(reverse(views.ml_status))
+        self.assertEqual(json.loads(response.content),
+                         {"running": False, "jobs": []})
+
+        job = models.TrainingJob.start()
+        with job.run_stage("load"):
+            pass
+        response = self.client.get(reverse(views.ml_status))
+        data = json.loads(response.content)
+        self.assertTrue(data["running"])
+        self.assertEqual(data["jobs"][0]["id"], job.id)
+        self.assertEqual(data["jobs"][0]["status"], "Running")
+        self.assertIn("load", data["jobs"][0]["durations"])
+        for key in ("host", "pid", "message"):
+            self.assertNotIn(key, data["jobs"][0])
+
+    def test_ml_status_limit(self):
+        for i in xrange(3):
+            models.TrainingJob.start().finish(models.TrainingJob.DONE)
+        for limit, count in (("-1", 1), ("0", 1), ("2", 2), ("1000", 3),
+                             ("bad", 3)):
+            response = self.client.get(reverse(views.ml_status),
+                                       {"limit": limit})
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.content)
+            self.assertEqual(len(data["jobs"]), count)
+
+    def test_ml_status_staff(self):
+        job = models.TrainingJob.start()
+        user = get_user_model().objects.create_superuser(**USER)
+        user.save()
+        self.client.login(**USER_LOGIN)
+        response = self.client.get(reverse(views.ml_status))
+        data = json.loads(response.content)
+        self.assertEqual(data["jobs"][0]["pid"], job.pid)
+        self.assertIn("host", data["jobs"][0])
+
+    def test_ml_status_command(self):
+        job = models.TrainingJob.start()
+        job.pid = 2 ** 22 + 1
+        job.save()
+        out = StringIO()
+        call_command("ml_status", clear_stale=True, stdout=out)
+        self.assertIn("Cleared stale job %d." % job.id, out.getvalue())
+        self.assertIn("Failed", out.getvalue())
+
+
 class LoadDataTestCase(TestCase):
 
     def test_load_data(self):
@@ -8,4 +8,5 @@ urlpatterns = patterns('data.views',
                        url(r"^frag/$", "frag_index"),
                        url(r"^frag/(?P<frag>[A-Za-z0-9]*)/$", "get_frag"),
                        url(r"^template/$", "template_index"),
+                       url(r"^ml/status/$", "ml_status"),
                        )
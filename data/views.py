@@ -1,4 +1,5 @@
 import os
+import json
 import logging
 
 from django.shortcuts import render, redirect
@@ -7,7 +8,7 @@ from django.core.servers.basehttp import FileWrapper
 from django.contrib.auth.decorators import login_required
 
 from chemtools.constants import NUMCORES, RGROUPS, ARYL
-from data.models import JobTemplate
+from data.models import JobTemplate, TrainingJob
 from data.forms import JobTemplateForm
 from account.utils import add_account_page, PAGES
 from utils import get_templates_from_request
@@ -40,6 +41,27 @@ def get_frag(request, frag):
         return redirect(frag_index)
 
 
+ML_STATUS_LIMIT = 100
+
+
+def ml_status(request):
+    try:
+        limit = int(request.REQUEST.get("limit", 10))
+    except ValueError:
+        limit = 10
+    limit = min(max(limit, 1), ML_STATUS_LIMIT)
+    jobs = TrainingJob.objects.order_by("-started")[:limit]
+    # Only staff get to see where the jobs run and their errors
+    details = request.user.is_staff
+    jobs = [x.to_dict(details=details) for x in jobs]
+    a = {
+        "running": any(x["status"] == "Running" and not x["stale"]
+                       for x in jobs),
+        "jobs": jobs,
+    }
+    return HttpResponse(json.dumps(a), content_type="application/json")
+
+
 def template_index(request):
     c = {"templates": JobTemplate.objects.all()}
     return render(request, "data/template_index.html", c)
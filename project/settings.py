@@ -1,6 +1,7 @@
 import os
 import random
 import hashlib
+import multiprocessing
 
 from Crypto.Cipher import AES
 from Crypto import Random
@@ -192,6 +193,62 @@ except ImportError:
 
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
 
+# Built molecule structures are cached so that all of the output formats of a
+# molecule share one build. BACKEND can be "memory" (a per process LRU),
+# "filesystem" (OPTIONS: path), or "django" (OPTIONS: alias, timeout) which
+# uses one of the CACHES.
+STRUCTURE_CACHE = {
+    "BACKEND": "memory",
+    "OPTIONS": {
+        "maxsize": 256,
+    },
+}
+
+# Rendered png/svg images are stored on disk and served with ETags. The least
+# recently used images are removed when the folder goes over MAX_SIZE bytes.
+IMAGE_CACHE = {
+    "PATH": os.path.join(ROOT_PATH, "cache", "images"),
+    "MAX_SIZE": 256 * 1024 * 1024,
+}
+
+# The number of processes used to build the molecules in a multi molecule zip.
+# With 1 (the default) the molecules are built in the request process, so no
+# pool is forked inside the web worker.
+MULTI_MOLECULE_WORKERS = 1
+
+# The largest name expansion that will be checked, and how many names are
+# checked (and looked up in the database) at a time.
+MULTI_MOLECULE_LIMIT = 10000
+MULTI_MOLECULE_CHUNK_SIZE = 500
+
+# The loaded predictor is shared by each process. This is how often (in
+# seconds) the database is checked for a newer one from update_ml.
+PREDICTOR_CHECK_INTERVAL = 10
+
+# The number of processes update_ml uses to fit the models.
+ML_UPDATE_WORKERS = multiprocessing.cpu_count()
+
+# With update_ml --incremental the decoded feature vectors are cached in this
+# file, and the hyperparameters are only searched again when the fraction of
+# new datapoints is over the threshold.
+ML_FEATURE_CACHE = os.path.join(ROOT_PATH, "cache", "features.npz")
+ML_INCREMENTAL_THRESHOLD = 0.05
+
+# The parsed values of uploaded logs are kept in this folder, so uploading the
+# same log again does not parse it again. None turns this off. The least
+# recently used values are removed when the folder goes over
+# LOG_PARSE_CACHE_MAX_SIZE bytes.
+LOG_PARSE_CACHE = os.path.join(ROOT_PATH, "cache", "logs")
+LOG_PARSE_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+# A running update_ml job on another host is treated as stale (and its lock
+# is removed) if it has not been updated in this many seconds.
+ML_JOB_TIMEOUT = 24 * 60 * 60
+# A running update_ml job on this host is treated as stale if its process is
+# gone, or if it started more than this many seconds ago (in case its pid was
+# reused by another process).
+ML_JOB_MAX_AGE = 7 * 24 * 60 * 60
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
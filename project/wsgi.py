@@ -24,6 +24,11 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "project.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Load the structure fragments up front so the first requests do not have to
+# read them from disk.
+from chemtools.structure import warm_fragment_cache
+warm_fragment_cache()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)